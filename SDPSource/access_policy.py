@@ -1,50 +1,22 @@
 import threading
-import copy
+import queue
 import random
+import traceback
+import collections
 from log import get_logger
 from params import params
+from key_rotation import key_ring
 
-SEED = '1234567890qwertyuiopasdfghjklzxcvbnmQWERTYUIOPASDFGHJKLZXCVBNM'
-
-class signal:
-    def __init__(self):
-        self._v_lock = threading.Lock()
-        self._value = None
-        self._events = {}
-
-    def get(self, timeout=None):
-        with self._v_lock:
-            caller = threading.current_thread()
-            if not caller in self._events:
-                self._events[caller] = threading.Event()
-
-        if self._events[caller].wait(timeout):
-            self._events[caller].clear()
-            with self._v_lock:
-                return copy.copy(self._value)
-        else:
-            return None
-
-    def set(self, value):
-        with self._v_lock:
-            self._value = value
-
-        died = []
-        for t, e in self._events.items():
-            if t.is_alive():
-                e.set()
-            else:
-                died.append(t)
-        for t in died:
-            self._events.pop(t, None)
-
+# access set versions are (ACCESS_EPOCH, n), versions of an earlier process never match
+ACCESS_EPOCH = random.getrandbits(62)
+# access set changes kept per member for resuming proxies
+CHANGE_LOG_SIZE = 256
 
 class monitored_dict(dict):
     def __init__(self):
         dict.__init__(self)
         self.lock = threading.Lock()
         self._logger = get_logger()
-        self._dirt_sig = signal()
 
     def get_all(self):
         if len(self) > 0:
@@ -52,24 +24,12 @@ class monitored_dict(dict):
         else:
             return set()
 
-    def set_dirt(self):
-        self._dirt_sig.set(self.get_all())
-
-    def __setitem__(self, key, value):
-        dict.__setitem__(self, key, value)
-        self.set_dirt()
-
     def pop(self, key, default=None):
         r = dict.pop(self, key, default)
-        if r:
-            self.set_dirt()
-        else:
+        if not r:
             self._logger.warning("Try to pop element which is not exist.")
         return r
 
-    def change_signal(self):
-        return self._dirt_sig
-
     def diff(self, d):
         if not isinstance(d, dict):
             raise ValueError("Need a dict!")
@@ -80,54 +40,147 @@ class monitored_dict(dict):
 
         return r
 
-    def update(self, d):
-        dict.update(self, d)
-        self.set_dirt()
-
     def remove(self, d):
         if not isinstance(d, dict):
             raise ValueError("Need a dict!")
         for k in d:
             dict.pop(self, k, None)
 
-        self.set_dirt()
-
     def refresh(self, d):
         dict.clear(self)
         self.update(d)
 
 
+class change_dispatcher:
+    """Propagates group changes to member access sets on a single worker thread.
+
+    Groups queue their changes in the order they happen, each with the members
+    it goes to, so a member's access set only ever takes deltas.
+    """
+    _instance_lock = threading.Lock()
+
+    def __init__(self):
+        if not hasattr(self, '_queue'):
+            self._logger = get_logger()
+            self._lock = threading.Lock()
+            self._queue = queue.Queue()
+            self._worker = None
+
+    def __new__(cls, *args, **kwargs):
+        if not hasattr(change_dispatcher, "_instance"):
+            with change_dispatcher._instance_lock:
+                if not hasattr(change_dispatcher, "_instance"):
+                    change_dispatcher._instance = object.__new__(cls)
+        return change_dispatcher._instance
+
+    def _start(self):
+        # caller holds self._lock
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._run, name='change_dispatcher')
+            self._worker.setDaemon(True)
+            self._worker.start()
+
+    def _put(self, change):
+        with self._lock:
+            self._start()
+        self._queue.put(change)
+
+    def notify(self, g, m, gained=(), lost=()):
+        """Queue the members m gains or loses access to by joining or leaving group g.
+
+        Args:
+            g (group): The group m joined or left.
+            m (member): The joining or leaving member.
+            gained (set): Whole access set m gets from g when joining.
+            lost (set): Whole access set m had from g when leaving.
+        """
+        self._put((g, (m,), gained, lost, False))
+
+    def notify_delta(self, g, members, added=(), removed=()):
+        """Queue members going online or offline in group g.
+
+        Args:
+            g (group): The changed group.
+            members (tuple): Members of g at the time of the change.
+            added (set): Members which went online.
+            removed (set): Members which went offline.
+        """
+        self._put((g, members, added, removed, True))
+
+    def join(self):
+        """Wait until every queued change is propagated."""
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            g, members, added, removed, policy = self._queue.get()
+            try:
+                for m in members:
+                    if policy:
+                        m.apply_access_delta(*g.get_access_delta(m.get_id(), added, removed))
+                    else:
+                        m.apply_access_delta(added, removed)
+            except BaseException:
+                self._logger.error("Catch unhandled exception in change dispatcher.")
+                traceback.print_exc()
+            finally:
+                self._queue.task_done()
+
+
 class group:
     def __init__(self, name):
         self._name = name
-        self._l = threading.Lock()
+        # reentrant, get_access_hosts is called with it held
+        self._l = threading.RLock()
         self._member_set = set()
-        self._online_dict = monitored_dict()
+        # members at the last membership change, handed to the dispatcher as is
+        self._member_tuple = ()
+        self._online_dict = {}
         self._offline_dict = {}
         self._logger = get_logger()
 
     def get_access_hosts(self, ID):
-        """Overwrite this function to change access policy.
+        """Overwrite this function and get_access_delta to change access policy.
+
+        Called with the group locked when ID joins or leaves the group.
 
         Args:
             ID (str): ID of member who initiate this query.
 
         Returns:
-            monitored_dict: Which contains all members can access by the initiator。
+            set: All members the initiator can access.
+        """
+
+        return self.get_online_members()
+
+    def get_access_delta(self, ID, added, removed):
+        """Overwrite together with get_access_hosts to change access policy.
+
+        Args:
+            ID (str): ID of member who receives this change.
+            added (set): Members which went online in this group.
+            removed (set): Members which went offline in this group.
+
+        Returns:
+            (set, set): Members the receiver gains and loses access to.
         """
 
-        return self.get_online_members(), self._online_dict.change_signal()
+        return added, removed
 
     def get_name(self):
         return self._name
 
+    def get_members(self):
+        with self._l:
+            return list(self._member_set)
+
     def get_offline_members(self):
         with self._l:
             return self._offline_dict
 
     def get_online_members(self):
         with self._l:
-            return self._online_dict.get_all()
+            return set(self._online_dict.values())
 
     def add_member(self, m):
         if not isinstance(m, member):
@@ -139,9 +192,12 @@ class group:
             if m in self._member_set:
                 return m
             self._member_set.add(m)
+            self._member_tuple = tuple(self._member_set)
             m.add_group(self)
+            change_dispatcher().notify(self, m, gained=self.get_access_hosts(m.get_id()))
             if m.ifonline():
                 self._online_dict[m.get_id()] = m
+                change_dispatcher().notify_delta(self, self._member_tuple, added={m})
             else:
                 self._offline_dict[m.get_id()] = m
             self._logger.info("Added member %s to group %s." %
@@ -158,8 +214,11 @@ class group:
             if not m in self._member_set:
                 return m
             self._member_set.discard(m)
+            self._member_tuple = tuple(self._member_set)
             m.remove_group(self)
-            self._online_dict.pop(m.get_id(), None)
+            change_dispatcher().notify(self, m, lost=self.get_access_hosts(m.get_id()))
+            if self._online_dict.pop(m.get_id(), None):
+                change_dispatcher().notify_delta(self, self._member_tuple, removed={m})
             self._offline_dict.pop(m.get_id(), None)
             self._logger.info("Removed member %s from group %s." %
                               (m.get_id(), self._name))
@@ -171,6 +230,7 @@ class group:
             if ID in self._offline_dict:
                 member = self._offline_dict.pop(ID, None)
                 self._online_dict[ID] = member
+                change_dispatcher().notify_delta(self, self._member_tuple, added={member})
                 self._logger.info(
                     "Member %s is online in group %s." % (ID, self._name))
             elif ID in self._online_dict:
@@ -185,6 +245,7 @@ class group:
             if ID in self._online_dict:
                 member = self._online_dict.pop(ID, None)
                 self._offline_dict[ID] = member
+                change_dispatcher().notify_delta(self, self._member_tuple, removed={member})
             elif ID in self._offline_dict:
                 self._logger.warning(
                     "Try to offline an offlined device %s in group %s" % (ID, self._name))
@@ -198,7 +259,7 @@ class group:
 
     def print(self, level=1):
         with self._l:
-            online = self._online_dict.get_all()
+            online = set(self._online_dict.values())
             offline = self._offline_dict
         r = 'group %s' % self._name
         r += '--online (%d)\n' % len(online)
@@ -216,31 +277,21 @@ class group:
 class member:
     def __init__(self, ID, key=None, address=None, online=False):
         self._ID = ID
-        self._key = []
-        if key is None:
-            self._key.append(ID)
-        else:
-            self._key.append(key)
+        self._keys = key_ring(ID if key is None else key)
         self._address = address
         self._online = online
         self._state_lock = threading.Lock()
         self._group_lock = threading.Lock()
-        self._key_lock = threading.Lock()
         self._groups = set()
         self._logger = get_logger()
         self._access_sets_lock = threading.Lock()
-        # group as key and access set as value, only modified in self.monitor_func()
-        self._access_sets = {}
-        self._access_host_change_sig = signal()
-
-        self._monitor_threads = {}
-
-    def _rand_string(self, len):
-        s = ''
-        for _ in range(len):
-            s += random.choice(SEED)
-
-        return s
+        # accessible member as key and number of groups granting the access as
+        # value, only modified by the change dispatcher
+        self._refcounts = {}
+        self._watchers = []
+        self._version = 0
+        # (version, gained, lost) of the latest changes
+        self._change_log = collections.deque(maxlen=CHANGE_LOG_SIZE)
 
     def auth(self, key):
         if params.test_mode:
@@ -249,61 +300,102 @@ class member:
             else:
                 return False
 
-        with self._key_lock:
-            for i in range(len(self._key)):
-                if self._key[i] == key:
-                    self._key = self._key[i:i+1]
-                    new_key = self._rand_string(8)
-                    self._key.append(new_key)
-
-                    return new_key
-            
-            return False
-
-    def merge_sets(self):
-        """Merge access set of all group containing this member and set 
-
-        Returns:
-            set: The access set.
+        return self._keys.rotate(key)
+
+    def _update_access_set(self, added, removed):
+        # caller holds self._access_sets_lock
+        gained = set()
+        lost = set()
+        for m in added:
+            count = self._refcounts.get(m, 0)
+            if count == 0:
+                gained.add(m)
+            self._refcounts[m] = count + 1
+        for m in removed:
+            count = self._refcounts.get(m, 0) - 1
+            if count > 0:
+                self._refcounts[m] = count
+            elif count == 0:
+                del self._refcounts[m]
+                lost.add(m)
+
+        if gained or lost:
+            self._version += 1
+            self._change_log.append((self._version, gained, lost))
+            version = (ACCESS_EPOCH, self._version)
+            for callback in self._watchers:
+                callback((gained, lost, version))
+
+    def apply_access_delta(self, added, removed):
+        """Count the access one group grants to added and no longer grants to removed.
+
+        Only called by the change dispatcher.
         """
-
+        if not added and not removed:
+            return
         with self._access_sets_lock:
-            merged = set()
-            for d in self._access_sets.values():
-                merged |= d
-        self._access_host_change_sig.set(merged)
+            self._update_access_set(added, removed)
 
-        return merged
-
-    def monitor_func(self, group):
-        self._logger.info("Monitor thread in member %s for group %s start." % (
-            self._ID, group.get_name()))
-        self._access_sets[group], change_signal = group.get_access_hosts(
-            self._ID)
+    def _changes_since(self, since):
+        # caller holds self._access_sets_lock
+        if not isinstance(since, tuple) or len(since) != 2 or since[0] != ACCESS_EPOCH:
+            return None
+        n = since[1]
+        if n == self._version:
+            return set(), set()
+        oldest = self._change_log[0][0] if self._change_log else self._version + 1
+        if not oldest - 1 <= n < self._version:
+            return None
 
-        self.merge_sets()
+        # A member lost first was accessible at since, it must be removed if it
+        # is gone or has been gained again with a possibly new address.
+        first_lost = {}
+        touched = set()
+        for version, gained, lost in self._change_log:
+            if version <= n:
+                continue
+            for m in lost:
+                first_lost.setdefault(m, True)
+            for m in gained:
+                first_lost.setdefault(m, False)
+                touched.add(m)
+        gained = set(m for m in touched if m in self._refcounts)
+        lost = set(m for m, first in first_lost.items() if first)
+        return gained, lost
+
+    def watch_access_hosts(self, callback, since=None):
+        """Watch changes of the access set.
 
-        while True:
-            new_online_members = change_signal.get()
-            self._logger.info("Group %s has %d online members." % (
-                group.get_name(), int(len(new_online_members))))
-            with self._group_lock:
-                if not group in self._groups:
-                    break
-            with self._access_sets_lock:
-                self._access_sets[group] = new_online_members
-            self.merge_sets()
+        Args:
+            callback (callable): Called with (gained, lost, version) on every
+                change, or with 'deleted' when this member is deleted. It runs
+                with the access set locked and must not block.
+            since (tuple): Version of the access set the watcher already knows.
 
+        Returns:
+            tuple: (version, gained, lost), the current version and the members
+                gained and lost since version since. lost is None and gained is
+                the whole access set if since is None or no longer in the log.
+        """
         with self._access_sets_lock:
-            self._access_sets.pop(group, None)
-        self._logger.info("Monitor thread in member %s for group %s stop." % (
-            self._ID, group.get_name()))
+            self._watchers.append(callback)
+            version = (ACCESS_EPOCH, self._version)
+            changes = self._changes_since(since)
+            if changes is None:
+                return version, set(self._refcounts), None
+            return (version,) + changes
+
+    def unwatch_access_hosts(self, callback):
+        with self._access_sets_lock:
+            if callback in self._watchers:
+                self._watchers.remove(callback)
 
     def get_id(self):
         return self._ID
 
     def get_access_hosts(self):
-        return self.merge_sets(), self._access_host_change_sig
+        with self._access_sets_lock:
+            return set(self._refcounts)
 
     def add_group(self, g):
         with self._group_lock:
@@ -312,10 +404,6 @@ class member:
             self._groups.add(g)
         self._logger.info("Add group %s to member %s." %
                           (g.get_name(), self._ID))
-        monitor_thread = threading.Thread(target=self.monitor_func, args=[g])
-        monitor_thread.setDaemon(True)
-        self._monitor_threads[g] = monitor_thread
-        monitor_thread.start()
 
     def join_group(self, g):
         g.add_member(self)
@@ -363,7 +451,9 @@ class member:
         with self._group_lock:
             with self._state_lock:
                 self._groups.clear()
-                self._access_host_change_sig.set('deleted')
+        with self._access_sets_lock:
+            for callback in self._watchers:
+                callback('deleted')
 
     def print(self):
         r = 'ID: %s' % self._ID
@@ -0,0 +1,74 @@
+#!/usr/bin/python3
+"""Fan-out latency of access set changes in access_policy.
+
+A group of N members is built with every member online. One more member then
+goes online and the time until every member of the group has been signalled is
+reported, together with the number of threads of the process. Then every
+member reconnects, going offline and online again: the time spent in the
+online/offline calls of the reconnecting devices and the time until the
+dispatcher has propagated all changes are shown per reconnect.
+
+Usage: access_policy_bench.py [group_size ...]
+"""
+
+import os
+os.environ.setdefault('M_SDP_LOG_LEVEL', 'ERROR')
+
+import sys
+import time
+import threading
+from access_policy import group, member, change_dispatcher
+
+
+def run(size):
+    g = group('bench-%d' % size)
+    members = [member('bench-%d-%d' % (size, i)) for i in range(size + 1)]
+    for i, m in enumerate(members[:-1]):
+        m.online('10.0.%d.%d:4444' % (i >> 8, i & 0xff))
+        g.add_member(m)
+    late = members[-1]
+    g.add_member(late)
+    change_dispatcher().join()
+
+    remaining = [size]
+    done = threading.Event()
+    lock = threading.Lock()
+
+    def on_change(change):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                done.set()
+
+    for m in members[:-1]:
+        m.watch_access_hosts(on_change)
+
+    start = time.perf_counter()
+    late.online('10.1.0.1:4444')
+    g.online(late.get_id())
+    done.wait()
+    elapsed = time.perf_counter() - start
+
+    for m in members[:-1]:
+        m.unwatch_access_hosts(on_change)
+    start = time.perf_counter()
+    for i, m in enumerate(members):
+        m.offline()
+        m.online('10.2.%d.%d:4444' % (i >> 8, i & 0xff))
+    calls = time.perf_counter() - start
+    change_dispatcher().join()
+    storm = time.perf_counter() - start
+
+    print('group size: %5d, fan-out: %8.2f ms, threads: %d, reconnect storm: calls %7.1f us '
+          'and propagated %8.1f us per reconnect' % (
+              size, elapsed * 1e3, threading.active_count(),
+              calls / len(members) * 1e6, storm / len(members) * 1e6))
+
+
+def main(*sizes):
+    for size in sizes or (10, 100, 1000, 3000):
+        run(size)
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
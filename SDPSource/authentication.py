@@ -1,116 +1,90 @@
 import socket
-import threading
-import time
-import os
-import pickle
+import asyncio
 import traceback
-import shutil
 from log import get_logger
 from access_policy import access_table
+from key_store import key_store
 from params import params
 
-TIMEOUT = 10
-
-
-class ReturnThread(threading.Thread):
-    def __init__(self, *args, **kwargs):
-        threading.Thread.__init__(self, *args, **kwargs)
-        self._return = None
-
-    def run(self):
-        if self._target is not None:
-            self._return = self._target(*self._args, **self._kwargs)
-
-    def join(self, timeout=None):
-        threading.Thread.join(self, timeout)
-        return self._return
-
-
-def time_limited(time_limit):
-    '''
-    一个规定函数执行时间的装饰器
-    '''
-    def wrapper(func):
-        def _wrapper(*args, **kwargs):
-            # 通过设置守护线程强制规定函数的运行时间
-            t = ReturnThread(target=func, args=args, kwargs=kwargs)
-            t.setDaemon(True)
-            t.start()
-            r = t.join(time_limit)
-            if t.is_alive():
-                # 若在规定的运行时间未结束守护进程，则主动抛出异常
-                raise TimeoutError
-            else:
-                return r
-        return _wrapper
-    return wrapper
-
 
 class auth_packet:
-    def __init__(self, deviceID, userID, key):
+    def __init__(self, deviceID, userID, key, sync_version=None):
         self.deviceID = deviceID
         self.userID = userID
         self.key = key
+        # version of the firewall state a reconnecting proxy still holds
+        self.sync_version = sync_version
 
 
 class reply_packet:
-    def __init__(self, passed, new_key=None):
+    def __init__(self, passed, new_key=None, retry_after=None):
         self.passed = passed
         self.new_key = new_key
+        # seconds to wait before connecting again, sent when the controller is busy
+        self.retry_after = retry_after
 
 
 class client_end:
-    def __init__(self, server_sock, device_sock=None, pack=None, timeout=10):
+    def __init__(self, server_sock, device_sock=None, pack=None, timeout=10, sync=None,
+                 identity=None, keys=None):
+        """
+        Args:
+            sync (tuple): (deviceID, version) of the firewall state held by a
+                proxy, the version is relayed if the same device authenticates.
+            identity (str): Device ID to authenticate as, the host name by default.
+            keys (key_store): Where the device keeps its keys, ./keyfile by default.
+        """
         self._logger = get_logger()
         self._server_sock = server_sock
         self._device_sock = device_sock
         self._auth_info = pack
         self._timeout = timeout
-        self._key_path = os.path.join('.', 'keyfile')
-        self._backup_key_path = self._key_path + '.backup'
-        global TIMEOUT
-        TIMEOUT = timeout
+        self._sync = sync
+        self.deviceID = None
+        # seconds the controller asked to wait before trying again
+        self.retry_after = None
+        self._identity = identity
+        self._keys = keys
+
+    def _key_store(self):
+        if self._keys is None:
+            self._keys = key_store()
+        return self._keys
 
-    
+    @property
+    def identity(self):
+        return self._identity or socket.gethostname()
 
     @property
     def key(self):
-        try:
-            with open(self._key_path, 'rb') as f:
-                return pickle.load(f)
-        except:
-            try:
-                shutil.copy(self._backup_key_path, self._key_path)
-                with open(self._key_path, 'rb') as f:
-                    return pickle.load(f)
-            except:
-                k = socket.gethostname()
-                with open(self._key_path, 'wb' if os.path.exists(self._key_path) else 'xb') as f:
-                    pickle.dump(k, f)
-                with open(self._backup_key_path, 'wb' if os.path.exists(self._backup_key_path) else 'xb') as f:
-                    pickle.dump(k, f)
-                return k
-
+        return self._key_store().get(self.identity)
 
     @key.setter
     def key(self, v):
-        with open(self._backup_key_path, 'wb' if os.path.exists(self._backup_key_path) else 'xb') as f:
-            pickle.dump(v, f)
-        shutil.copy(self._backup_key_path, self._key_path)
+        self._key_store().set(self.identity, v)
 
     def get_auto_info(self):
-        device_id = socket.gethostname()
-        pack = auth_packet(device_id, None, self.key)
+        pack = auth_packet(self.identity, None, self.key)
         return pack
 
-    @time_limited(TIMEOUT)
     def auth_to_server(self):
+        """
+        Raises:
+            TimeoutError: The exchange took longer than the timeout.
+        """
+        socks = [s for s in (self._server_sock, self._device_sock) if s]
+        for s in socks:
+            s.set_deadline(self._timeout)
         try:
             while True:
                 if self._auth_info:  # not used
                     auth_info = self._auth_info
                 elif self._device_sock:  # which means this is a proxy
                     auth_info = self._device_sock.recv_obj()
+                    if isinstance(auth_info, auth_packet):
+                        self.deviceID = auth_info.deviceID
+                        if self._sync and self._sync[0] == auth_info.deviceID:
+                            auth_info.sync_version = self._sync[1]
                 else:  # which means this is the device
                     auth_info = self.get_auto_info()
                 self._logger.info("Send auth packet...[ID: %s, KEY: %s]" % (auth_info.deviceID, auth_info.key))
@@ -120,14 +94,20 @@ class client_end:
                     if self._device_sock:
                         self._device_sock.send_obj(reply_packet('retry'))
                 else:
+                    self.retry_after = getattr(reply_data, 'retry_after', None)
                     if self._device_sock:
                         self._device_sock.send_obj(reply_data)
-                    else:
+                    elif reply_data.passed:
                         self.key = reply_data.new_key
                     return reply_data.passed
+        except TimeoutError:
+            raise
         except:
             traceback.print_exc()
             return False
+        finally:
+            for s in socks:
+                s.set_deadline(None)
 
 
 class server_end:
@@ -137,34 +117,85 @@ class server_end:
         self._sock = sock
         self._timeout = timeout
         self._max_try_times = max_try_times
-        global TIMEOUT
-        TIMEOUT = timeout
-
-    @time_limited(TIMEOUT)
-    def authenticate(self):
+        self.sync_version = None
+
+    def _check(self, auth_info):
+        """Check one received object.
+
+        Returns:
+            tuple: The reply to send and (passed, ID), the latter is None when the device should retry.
+        """
+        if not isinstance(auth_info, auth_packet):
+            return reply_packet('retry'), None
+
+        self._logger.info(
+            "Recive auth packet from device %s" % auth_info.deviceID)
+
+        m = self._a_table.get_member(auth_info.deviceID)
+
+        if m:
+            new_key = m.auth(auth_info.key)
+            if new_key:
+                self.sync_version = getattr(auth_info, 'sync_version', None)
+                return reply_packet(True, new_key=new_key), (True, auth_info.deviceID)
+        elif params.test_mode:
+            self._a_table.add_member(auth_info.deviceID)
+            self._a_table.add_relation(auth_info.deviceID, str(hash(auth_info.deviceID) % params.test_group_num))
+            return reply_packet(True, auth_info.deviceID), (True, auth_info.deviceID)
+
+        return reply_packet(False), (False, None)
+
+    def authenticate(self, first=None):
+        """
+        Args:
+            first: Object already received from the socket.
+
+        Raises:
+            TimeoutError: The exchange took longer than the timeout.
+        """
+        self._sock.set_deadline(self._timeout)
         try:
             for _ in range(self._max_try_times):
-                auth_info = self._sock.recv_obj()
-                if isinstance(auth_info, auth_packet):
-                    self._logger.info(
-                        "Recive auth packet from device %s" % auth_info.deviceID)
-
-                    m = self._a_table.get_member(auth_info.deviceID)
-                    
-                    if m:
-                        new_key = m.auth(auth_info.key)
-                        if new_key:
-                            self._sock.send_obj(reply_packet(True, new_key=new_key))
-                            return True, auth_info.deviceID
-                    elif params.test_mode:
-                        self._a_table.add_member(auth_info.deviceID)
-                        self._a_table.add_relation(auth_info.deviceID, str(hash(auth_info.deviceID) % params.test_group_num))
-                        self._sock.send_obj(reply_packet(True, auth_info.deviceID))
-                        return True, auth_info.deviceID
-
-                    self._sock.send_obj(reply_packet(False))
-                    return False, None
+                if first is not None:
+                    auth_info, first = first, None
                 else:
-                    self._sock.send_obj(reply_packet('retry'))
+                    auth_info = self._sock.recv_obj()
+                reply, result = self._check(auth_info)
+                self._sock.send_obj(reply)
+                if result:
+                    return result
+        except TimeoutError:
+            raise
         except:
-            return False, None
+            pass
+        finally:
+            self._sock.set_deadline(None)
+        return False, None
+
+    async def _authenticate_async(self, first):
+        try:
+            for _ in range(self._max_try_times):
+                if first is not None:
+                    auth_info, first = first, None
+                else:
+                    auth_info = await self._sock.recv_obj()
+                reply, result = self._check(auth_info)
+                await self._sock.send_obj(reply)
+                if result:
+                    return result
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            pass
+        return False, None
+
+    async def authenticate_async(self, first=None):
+        """authenticate() for an async_secure_stream, the deadline is kept by the event loop.
+
+        Args:
+            first: Object already received from the stream.
+        """
+        try:
+            return await asyncio.wait_for(self._authenticate_async(first), self._timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError
@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+"""Thread and file descriptor count over many timed out authentications.
+
+Half of the peers connect and never send anything, the other half only
+answer with garbage, so every server_end.authenticate() and every
+client_end.auth_to_server() runs into its deadline. Both ends must come back
+to the thread and descriptor count they started with.
+
+Usage: authentication_soak.py [auth_count] [timeout_ms]
+"""
+
+import os
+os.environ.setdefault('M_SDP_LOG_LEVEL', 'CRITICAL')
+
+import sys
+import time
+import socket
+import threading
+from authentication import server_end, client_end, auth_packet
+from secure_socket import secure_socket
+
+
+def _fds():
+    return len(os.listdir('/proc/self/fd'))
+
+
+def _pair():
+    a, b = socket.socketpair()
+    return secure_socket(sock=a, secure=False), secure_socket(sock=b, secure=False)
+
+
+def _one(i, timeout):
+    local, peer = _pair()
+    try:
+        if i % 4 == 0:
+            server_end(local, timeout=timeout).authenticate()
+        elif i % 4 == 1:
+            client_end(local, pack=auth_packet('soak', None, 'key'), timeout=timeout).auth_to_server()
+        elif i % 4 == 2:
+            peer.sendall(b'\x80')
+            server_end(local, timeout=timeout).authenticate()
+        else:
+            peer.sendall(b'\x80')
+            client_end(local, pack=auth_packet('soak', None, 'key'), timeout=timeout).auth_to_server()
+    except TimeoutError:
+        return True
+    finally:
+        local.close()
+        peer.close()
+    return False
+
+
+def main(count=10000, timeout_ms=1):
+    timeout = timeout_ms / 1000
+    threads, fds = threading.active_count(), _fds()
+    print('start: threads %d, fds %d' % (threads, fds))
+    timed_out = 0
+    start = time.perf_counter()
+    for i in range(count):
+        timed_out += _one(i, timeout)
+        if (i + 1) % (count // 5 or 1) == 0:
+            print('%6d auths: threads %d, fds %d' % (i + 1, threading.active_count(), _fds()))
+    elapsed = time.perf_counter() - start
+    print('timed out: %d/%d in %.1f s, threads %d -> %d, fds %d -> %d' % (
+        timed_out, count, elapsed, threads, threading.active_count(), fds, _fds()))
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:3]))
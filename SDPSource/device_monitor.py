@@ -1,7 +1,6 @@
 #!/usr/bin/python3
 from secure_socket import secure_socket
 from multiprocessing import Process
-from threading import Thread
 import threading
 from socketserver import ThreadingTCPServer, StreamRequestHandler, TCPServer
 from log import get_logger
@@ -10,9 +9,10 @@ import socket
 from access_policy import monitored_dict
 from params import params
 import traceback
-import time
 import signal
-from mqtt_client import mqtt_client
+from mqtt_client import mqtt_client, mqtt_bridge, pooled_client
+from payload_codec import PayloadCodecError
+from peer_fanout import peer_fanout
 
 LOGGER = get_logger()
 
@@ -36,38 +36,19 @@ class device_handler(StreamRequestHandler):
     def __init__(self, *args, **kwargs):
         self._logger = get_logger()
         self._availiable_hosts = {}
-        self._peer_socks_lock = threading.Lock()
-        self._peer_socket = {}
-        self._mqtt_client = mqtt_client()
+        self._peers = peer_fanout()
+        if params.mqtt_pool:
+            self._mqtt_client = pooled_client()
+        elif params.mqtt_bridge:
+            self._mqtt_client = mqtt_bridge()
+        else:
+            self._mqtt_client = mqtt_client()
         StreamRequestHandler.__init__(self, *args, **kwargs)
 
-    def connect_peer(self, ID, addr):
+    def add_peer(self, ID, addr):
         ip = addr.split(':')[0]
         port = int(params.peer_port)  # int(addr.split(':')[1])
-
-        addr = ip + str(port)
-
-        with self._peer_socks_lock:
-            if ID in self._peer_socket:
-                self._peer_socket[ID].close()
-            self._peer_socket[ID] = secure_socket()
-
-        for _ in range(5):
-            try:
-                with self._peer_socks_lock:
-                    self._peer_socket[ID].connect((ip, port), timeout=5)
-            except TimeoutError:
-                time.sleep(5)
-            except:
-                return
-            else:
-                self._logger.info("Connected to peer %s on %s." % (ID, addr))
-                return
-
-        self._logger.warning("Fail to connect to peer %s on %s." % (ID, addr))
-
-    def add_peer(self, ID, addr):
-        Thread(target=self.connect_peer, args=(ID, addr), daemon=True).start()
+        self._peers.add(ID, (ip, port))
 
     def handle(self):
         try:
@@ -86,13 +67,11 @@ class device_handler(StreamRequestHandler):
                 elif isinstance(obj, data_packet):
                     self._logger.info(
                         "Receive data packet from device:\n%s" % str(obj))
-                    self._mqtt_client.publish(obj.data)
-                    with self._peer_socks_lock:
-                        for peer_sock in self._peer_socket.values():
-                            try:
-                                peer_sock.send_obj(obj)
-                            except:
-                                pass
+                    try:
+                        self._mqtt_client.publish(obj.data)
+                    except PayloadCodecError as e:
+                        self._logger.warning("Drop data packet from device.(%s)" % str(e))
+                    self._peers.send(obj)
 
                 elif isinstance(obj, list_update_packet):
                     available_hosts = obj.available_hosts
@@ -103,16 +82,10 @@ class device_handler(StreamRequestHandler):
                         for ID, addr in available_hosts['add'].items():
                             self.add_peer(ID, addr)
                     if 'remove' in available_hosts:
-                        for ID, addr in available_hosts['remove'].items():
-                            with self._peer_socks_lock:
-                                peer_sock = self._peer_socket.pop(ID, None)
-                            if peer_sock:
-                                peer_sock.close()
+                        for ID in available_hosts['remove']:
+                            self._peers.remove(ID)
                     if 'refresh' in available_hosts:
-                        with self._peer_socks_lock:
-                            for peer_sock in self._peer_socket.values():
-                                peer_sock.close()
-                            self._peer_socket.clear()
+                        self._peers.clear()
                         for ID, addr in available_hosts['refresh'].items():
                             self.add_peer(ID, addr)
         except BaseException as e:
@@ -120,10 +93,7 @@ class device_handler(StreamRequestHandler):
             traceback.print_exc()
         finally:
             self._mqtt_client.disconnect()
-            with self._peer_socks_lock:
-                for s in self._peer_socket.values():
-                    s.close()
-                self._peer_socket.clear()
+            self._peers.clear()
             sock.close()
 
 
@@ -155,8 +125,14 @@ class device_monitor(Process):
 
             self._logger.info(
                 "Device monitor start, listening %s." % self._proxy_addr)
-            device_server = TCPServer(
-                (self._proxy_ip, self._proxy_port), device_handler)
+            if params.mqtt_pool:
+                # devices of a multi-device proxy are served at once and share the pool
+                device_server = ThreadingTCPServer(
+                    (self._proxy_ip, self._proxy_port), device_handler)
+                device_server.daemon_threads = True
+            else:
+                device_server = TCPServer(
+                    (self._proxy_ip, self._proxy_port), device_handler)
             device_server.serve_forever()
         except KeyboardInterrupt:
             self._logger.info("Device monitor receive KeyboardInterrupt.")
@@ -3,6 +3,7 @@
 from multiprocessing import Process
 from secure_socket import secure_socket
 from authentication import client_end, auth_packet
+from key_store import key_store
 from protocol import data_packet, mqtt_info_packet
 from log import get_logger
 import traceback
@@ -29,12 +30,8 @@ class device(Thread):
 
     def run(self):
         # time.sleep(5)
-        def signal_func(sig, stack):
-            raise KeyboardInterrupt
-        signal.signal(signal.SIGTERM, signal_func)
-        self._logger.info("Device simulator start.")
-        firewall_init(None)
         while True:
+            retry_after = None
             try:
                 self._sock = secure_socket()
                 if self._ID:
@@ -54,7 +51,7 @@ class device(Thread):
                 self._sock.connect((ip, port), timeout=5)
 
                 self._logger.info("Connected to %s, send auth_info..." % addr)
-                auth_obj = client_end(self._sock)
+                auth_obj = client_end(self._sock, identity=str(device_ID))
 
                 if auth_obj.auth_to_server():
                     self._sock.send_obj(mqtt_info_packet(str(device_ID), str(device_ID), str(device_ID)))
@@ -64,7 +61,8 @@ class device(Thread):
                             'Data from ' + str(device_ID)))
                         time.sleep(self._data_interval)
                 else:
-                    raise Exception
+                    retry_after = auth_obj.retry_after
+                    raise Exception("Auth failed.")
             except KeyboardInterrupt:
                 self._logger.info(
                     "Device simulator receive KeyboardInterrupt, quit.")
@@ -74,7 +72,7 @@ class device(Thread):
                 self._logger.warning(
                     "Device simulator %s fail to connect docker %s!(%s)" % (device_ID, addr, str(e)))
                 traceback.print_exc()
-                time.sleep(self._fault_interval * (1 + random.random()))
+                time.sleep((retry_after or self._fault_interval) * (1 + random.random()))
             finally:
                 self._sock.close()
                 # firewall_open_all()
@@ -82,10 +80,42 @@ class device(Thread):
     def shutdown(self):
         self._sock.close()
 
+def main(monitor_addr=None, count=1):
+    def signal_func(sig, stack):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, signal_func)
+    logger = get_logger()
+    logger.info("Device simulator start.")
+    firewall_init(None)
+
+    if count == 1:
+        simulator = device(ID=params.device_ID, addr=monitor_addr)
+        simulator.run()
+        return
+
+    # many identities in one process for load generation, their keys share
+    # one key store and are written together
+    simulators = [device(ID='%s-%d' % (params.device_ID, i), addr=monitor_addr)
+                  for i in range(count)]
+    for simulator in simulators:
+        simulator.setDaemon(True)
+        simulator.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        logger.info("Device simulator receive KeyboardInterrupt, quit.")
+    finally:
+        key_store().flush()
+
+
 if __name__ == '__main__':
     if len(sys.argv) > 1:
         monitor_addr = sys.argv[1]
     else:
         monitor_addr = None
-    simulator = device(ID=params.device_ID, addr=monitor_addr)
-    simulator.run()
+    if len(sys.argv) > 2:
+        count = int(sys.argv[2])
+    else:
+        count = 1
+    main(monitor_addr, count)
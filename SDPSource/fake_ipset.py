@@ -0,0 +1,61 @@
+"""In-memory stand-in for the ipset command, pass a runner to ipset_backend.
+
+Understands the commands ipset_backend sends, either as arguments or as
+'ipset restore' input. Calls are counted in runner.calls.
+"""
+
+import subprocess
+
+
+class runner:
+    def __init__(self):
+        self.sets = {}
+        self.calls = 0
+
+    def __call__(self, args, input=None):
+        self.calls += 1
+        if args[:2] == ['ipset', 'save']:
+            if args[2] not in self.sets:
+                self._fail(args, 'The set with the given name does not exist')
+            lines = ['create %s hash:ip' % args[2]]
+            lines.extend('add %s %s' % (args[2], ip) for ip in sorted(self.sets[args[2]]))
+            return '\n'.join(lines) + '\n'
+        if args[:2] == ['ipset', 'restore']:
+            for line in input.splitlines():
+                if line.strip():
+                    self._run(args, line.split())
+        else:
+            self._run(args, args[1:])
+        return ''
+
+    def _fail(self, args, msg):
+        raise subprocess.CalledProcessError(1, args, stderr=msg)
+
+    def _run(self, args, cmd):
+        op, name = cmd[0], cmd[1]
+        exist = '-exist' in cmd
+        if op == 'create':
+            if name in self.sets and not exist:
+                self._fail(args, 'Set %s already exists' % name)
+            self.sets.setdefault(name, set())
+            return
+        if name not in self.sets:
+            self._fail(args, 'The set with the given name does not exist')
+        if op == 'add':
+            if cmd[2] in self.sets[name] and not exist:
+                self._fail(args, 'Element is already added')
+            self.sets[name].add(cmd[2])
+        elif op == 'del':
+            if cmd[2] not in self.sets[name] and not exist:
+                self._fail(args, 'Element is missing')
+            self.sets[name].discard(cmd[2])
+        elif op == 'flush':
+            self.sets[name].clear()
+        elif op == 'swap':
+            if cmd[2] not in self.sets:
+                self._fail(args, 'The set with the given name does not exist')
+            self.sets[name], self.sets[cmd[2]] = self.sets[cmd[2]], self.sets[name]
+        elif op == 'destroy':
+            del self.sets[name]
+        else:
+            self._fail(args, 'Unknown command %s' % op)
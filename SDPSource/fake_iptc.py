@@ -0,0 +1,124 @@
+"""In-memory stand-in for the subset of python-iptables used by iptables_api.
+
+Only meant for benchmarks on hosts without iptables privileges. Like
+python-iptables, a table works on a copy loaded from the kernel: an
+autocommit table writes the whole copy back after every change and reloads
+it, an explicit commit writes it back once. Reading rules never reloads, only
+refresh() picks up changes made by others. Round trips are counted
+in Table.commits and Table.refreshes, rules written back in Table.written.
+Set Table.rule_delay to make each commit take that many seconds per rule
+written, like the kernel copying the table.
+"""
+
+import time
+
+
+class Policy:
+    ACCEPT = 'ACCEPT'
+    DROP = 'DROP'
+
+
+class Match:
+    def __init__(self, name):
+        self.name = name
+
+    def _key(self):
+        return tuple(sorted(self.__dict__.items()))
+
+
+class Rule:
+    def __init__(self):
+        self.in_interface = None
+        self.protocol = None
+        self.src = None
+        self.dst = None
+        self.target = None
+        self.matches = []
+
+    def create_match(self, name):
+        m = Match(name)
+        self.matches.append(m)
+        return m
+
+    def create_target(self, target):
+        self.target = target
+
+    def _key(self):
+        return (self.in_interface, self.protocol, self.src, self.dst, self.target,
+                tuple(m._key() for m in self.matches))
+
+    def __eq__(self, other):
+        return isinstance(other, Rule) and self._key() == other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+
+class Table:
+    FILTER = 'filter'
+    rule_delay = 0
+    _kernel = {}
+
+    def __init__(self, name):
+        self.name = name
+        self.autocommit = True
+        self.commits = 0
+        self.refreshes = 0
+        self.written = 0
+        self._chains = {}
+        self.refresh()
+
+    def refresh(self):
+        self.refreshes += 1
+        self._chains = dict((name, (list(rules), policy))
+                            for name, (rules, policy) in Table._kernel.get(self.name, {}).items())
+
+    def commit(self):
+        self.commits += 1
+        # libiptc replaces the whole table
+        written = sum(len(rules) for rules, _ in self._chains.values())
+        self.written += written
+        if self.rule_delay:
+            time.sleep(written * self.rule_delay)
+        Table._kernel[self.name] = dict((name, (list(rules), policy))
+                                        for name, (rules, policy) in self._chains.items())
+
+    def _change(self, chain, func):
+        rules, policy = self._chains.setdefault(chain, ([], Policy.ACCEPT))
+        r = func(rules)
+        if self.autocommit:
+            self.commit()
+            self.refresh()
+        return r
+
+
+class Chain:
+    def __init__(self, table, name):
+        self.table = table
+        self.name = name
+
+    @property
+    def rules(self):
+        return list(self.table._chains.get(self.name, ([], None))[0])
+
+    def insert_rule(self, rule, position=0):
+        self.table._change(self.name, lambda rules: rules.insert(position, rule))
+
+    def append_rule(self, rule):
+        self.table._change(self.name, lambda rules: rules.append(rule))
+
+    def delete_rule(self, rule):
+        self.table._change(self.name, lambda rules: rules.remove(rule))
+
+    def replace_rule(self, rule, position=0):
+        def replace(rules):
+            rules[position] = rule
+        self.table._change(self.name, replace)
+
+    def flush(self):
+        self.table._change(self.name, lambda rules: rules.clear())
+
+    def set_policy(self, policy):
+        def set_policy(rules):
+            self.table._chains[self.name] = (rules, policy)
+        self.table._change(self.name, set_policy)
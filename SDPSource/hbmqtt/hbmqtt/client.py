@@ -248,28 +248,56 @@ class MQTTClient:
             :param retain: retain flag. Defaults to ``default_retain`` config parameter or False.
         """
 
-        def get_retain_and_qos():
-            if qos:
-                assert qos in (QOS_0, QOS_1, QOS_2)
-                _qos = qos
-            else:
-                _qos = self.config['default_qos']
-                try:
-                    _qos = self.config['topics'][topic]['qos']
-                except KeyError:
-                    pass
-            if retain:
-                _retain = retain
-            else:
-                _retain = self.config['default_retain']
-                try:
-                    _retain = self.config['topics'][topic]['retain']
-                except KeyError:
-                    pass
-            return _qos, _retain
-        (app_qos, app_retain) = get_retain_and_qos()
+        (app_qos, app_retain) = self._get_retain_and_qos(topic, qos, retain)
         return (yield from self._handler.mqtt_publish(topic, message, app_qos, app_retain))
 
+    @mqtt_connected
+    @asyncio.coroutine
+    def publish_many(self, messages, qos=None, retain=None, ack_timeout=None):
+        """
+            Publish a batch of messages to the broker.
+
+            All `PUBLISH <http://docs.oasis-open.org/mqtt/mqtt/v3.1.1/os/mqtt-v3.1.1-os.html#_Toc398718037>`_ messages are encoded into one buffer and written at once, then their acknowledgments are awaited together. QOS_0 messages only take the write.
+
+            This method is a *coroutine*.
+
+            :param messages: iterable of ``(topic, message)`` tuples, ``(topic, message, qos, retain)`` tuples override ``qos`` and ``retain`` for one message.
+            :param qos: requested publish quality of service for the messages. Defaults to ``default_qos`` config parameter or QOS_0.
+            :param retain: retain flag for the messages. Defaults to ``default_retain`` config parameter or False.
+            :param ack_timeout: seconds to wait for all acknowledgments, unlimited by default.
+            :return: list of :class:`hbmqtt.session.OutgoingApplicationMessage`, in the order of ``messages``
+            :raises HBMQTTException: if the QOS_1 and QOS_2 messages need more packet IDs than are free, no message is sent then
+        """
+        batch = []
+        for item in messages:
+            if len(item) == 4:
+                topic, message, item_qos, item_retain = item
+            else:
+                (topic, message), item_qos, item_retain = item, qos, retain
+            (app_qos, app_retain) = self._get_retain_and_qos(topic, item_qos, item_retain)
+            batch.append((topic, message, app_qos, app_retain))
+        return (yield from self._handler.mqtt_publish_many(batch, ack_timeout))
+
+    def _get_retain_and_qos(self, topic, qos, retain):
+        if qos:
+            assert qos in (QOS_0, QOS_1, QOS_2)
+            _qos = qos
+        else:
+            _qos = self.config['default_qos']
+            try:
+                _qos = self.config['topics'][topic]['qos']
+            except KeyError:
+                pass
+        if retain:
+            _retain = retain
+        else:
+            _retain = self.config['default_retain']
+            try:
+                _retain = self.config['topics'][topic]['retain']
+            except KeyError:
+                pass
+        return _qos, _retain
+
     @mqtt_connected
     @asyncio.coroutine
     def subscribe(self, topics):
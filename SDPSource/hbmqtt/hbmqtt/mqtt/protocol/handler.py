@@ -7,6 +7,7 @@ import itertools
 
 import asyncio
 from asyncio import InvalidStateError
+from datetime import datetime
 
 from hbmqtt.mqtt import packet_class
 from hbmqtt.mqtt.connack import ConnackPacket
@@ -186,6 +187,89 @@ class ProtocolHandler:
 
         return message
 
+    @asyncio.coroutine
+    def mqtt_publish_many(self, messages, ack_timeout=None):
+        """
+        Sends a batch of MQTT publish messages with a single write and waits for all of their acknowledgments.
+        The PUBLISH packets are encoded into one buffer and drained once, QOS_2 PUBREL packets are sent the same way
+        once every PUBREC arrived. QOS_0 messages only take the write.
+        :param messages: list of (topic, data, qos, retain) tuples
+        :param ack_timeout: acknowledge timeout for the whole batch. If set, this method will return a TimeOut error
+        if the acknowledgments are not completed before ack_timeout second
+        :return: list of ApplicationMessage, in the order of messages
+        :raises HBMQTTException: if the batch needs more packet IDs than are free, nothing is sent then
+        """
+        acked = sum(1 for _, _, qos, _ in messages if qos in (QOS_1, QOS_2))
+        free = 65535 - len(self.session.inflight_in) - len(self.session.inflight_out)
+        if acked > free:
+            raise HBMQTTException("Batch needs %d packet IDs, only %d are free" % (acked, free))
+        app_messages = []
+        try:
+            for topic, data, qos, retain in messages:
+                if qos in (QOS_1, QOS_2):
+                    packet_id = self.session.next_packet_id
+                    if packet_id in self.session.inflight_out:
+                        raise HBMQTTException("A message with the same packet ID '%d' is already in flight" % packet_id)
+                else:
+                    packet_id = None
+                app_message = OutgoingApplicationMessage(packet_id, topic, qos, data, retain)
+                if packet_id is not None:
+                    self.session.inflight_out[packet_id] = app_message
+                app_messages.append(app_message)
+        except BaseException:
+            # nothing was sent yet, give the packet IDs of the batch back
+            for app_message in app_messages:
+                if app_message.packet_id is not None:
+                    del self.session.inflight_out[app_message.packet_id]
+            raise
+        flow = self._handle_outgoing_batch_flow(app_messages)
+        try:
+            if ack_timeout is not None and ack_timeout > 0:
+                yield from asyncio.wait_for(flow, ack_timeout, loop=self._loop)
+            else:
+                yield from flow
+        finally:
+            for app_message in app_messages:
+                if app_message.packet_id is not None:
+                    self._puback_waiters.pop(app_message.packet_id, None)
+                    self._pubrec_waiters.pop(app_message.packet_id, None)
+                    self._pubcomp_waiters.pop(app_message.packet_id, None)
+        return app_messages
+
+    @asyncio.coroutine
+    def _handle_outgoing_batch_flow(self, app_messages):
+        # waiters are set before the write, acknowledgments may come in while it drains
+        acks = {QOS_1: self._puback_waiters, QOS_2: self._pubrec_waiters}
+        waiters = []
+        for app_message in app_messages:
+            if app_message.qos in acks:
+                waiter = asyncio.Future(loop=self._loop)
+                acks[app_message.qos][app_message.packet_id] = waiter
+                waiters.append((app_message, waiter))
+            app_message.publish_packet = app_message.build_publish_packet()
+        yield from self._send_packets([m.publish_packet for m in app_messages])
+        if not waiters:
+            return
+        yield from asyncio.wait([w for _, w in waiters], loop=self._loop)
+
+        released = []
+        for app_message, waiter in waiters:
+            if app_message.qos == QOS_1:
+                app_message.puback_packet = waiter.result()
+                del self.session.inflight_out[app_message.packet_id]
+            else:
+                app_message.pubrec_packet = waiter.result()
+                app_message.pubrel_packet = PubrelPacket.build(app_message.packet_id)
+                released.append((app_message, asyncio.Future(loop=self._loop)))
+                self._pubcomp_waiters[app_message.packet_id] = released[-1][1]
+        if not released:
+            return
+        yield from self._send_packets([m.pubrel_packet for m, _ in released])
+        yield from asyncio.wait([w for _, w in released], loop=self._loop)
+        for app_message, waiter in released:
+            app_message.pubcomp_packet = waiter.result()
+            del self.session.inflight_out[app_message.packet_id]
+
     @asyncio.coroutine
     def _handle_message_flow(self, app_message):
         """
@@ -453,6 +537,30 @@ class ProtocolHandler:
             self.logger.warning("Unhandled exception: %s" % e)
             raise
 
+    @asyncio.coroutine
+    def _send_packets(self, packets):
+        """
+        Send packets with one write and one drain
+        """
+        try:
+            self.writer.write(b''.join(packet.to_bytes() for packet in packets))
+            yield from self.writer.drain()
+            now = datetime.now()
+            for packet in packets:
+                packet.protocol_ts = now
+            if self._keepalive_task:
+                self._keepalive_task.cancel()
+                self._keepalive_task = self._loop.call_later(self.keepalive_timeout, self.handle_write_timeout)
+
+            for packet in packets:
+                yield from self.plugins_manager.fire_event(EVENT_MQTT_PACKET_SENT, packet=packet, session=self.session)
+        except ConnectionResetError as cre:
+            yield from self.handle_connection_closed()
+            raise
+        except BaseException as e:
+            self.logger.warning("Unhandled exception: %s" % e)
+            raise
+
     @asyncio.coroutine
     def mqtt_deliver_next_message(self):
         if self.logger.isEnabledFor(logging.DEBUG):
@@ -15,6 +15,7 @@ from hbmqtt.mqtt.puback import PubackPacket
 from hbmqtt.mqtt.pubrec import PubrecPacket
 from hbmqtt.mqtt.pubrel import PubrelPacket
 from hbmqtt.mqtt.pubcomp import PubcompPacket
+from hbmqtt.errors import HBMQTTException
 
 formatter = "[%(asctime)s] %(name)s {%(filename)s:%(lineno)d} %(levelname)s - %(message)s"
 logging.basicConfig(level=logging.DEBUG, format=formatter)
@@ -458,3 +459,27 @@ class ProtocolHandlerTest(unittest.TestCase):
         self.loop.run_until_complete(server.wait_closed())
         if future.exception():
             raise future.exception()
+
+    def test_publish_many_no_free_packet_id(self):
+        self.session = Session()
+        self.session._packet_id = 65530
+        for packet_id in (65533, 65534, 65535):
+            self.session.inflight_out[packet_id] = OutgoingApplicationMessage(packet_id, '/topic', QOS_1, b'', False)
+        self.handler = ProtocolHandler(self.plugin_manager, loop=self.loop)
+        self.handler.attach(self.session, None, None)
+        batch = [('/topic', b'test_data', QOS_1, False)] * 3
+        with self.assertRaises(HBMQTTException):
+            self.loop.run_until_complete(self.handler.mqtt_publish_many(batch))
+        self.assertEqual(sorted(self.session.inflight_out), [65533, 65534, 65535])
+
+    def test_publish_many_too_large(self):
+        self.session = Session()
+        for packet_id in range(1, 65531):
+            self.session.inflight_out[packet_id] = OutgoingApplicationMessage(packet_id, '/topic', QOS_1, b'', False)
+        self.handler = ProtocolHandler(self.plugin_manager, loop=self.loop)
+        self.handler.attach(self.session, None, None)
+        batch = [('/topic', b'test_data', QOS_0, False)] * 10 + [('/topic', b'test_data', QOS_2, False)] * 6
+        with self.assertRaises(HBMQTTException):
+            self.loop.run_until_complete(self.handler.mqtt_publish_many(batch))
+        self.assertEqual(len(self.session.inflight_out), 65530)
+        self.assertEqual(self.session._packet_id, 0)
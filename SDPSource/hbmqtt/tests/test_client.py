@@ -246,6 +246,45 @@ class MQTTClientTest(unittest.TestCase):
         if future.exception():
             raise future.exception()
 
+    def test_publish_many(self):
+        @asyncio.coroutine
+        def test_coro():
+            try:
+                broker = Broker(broker_config, plugin_namespace="hbmqtt.test.plugins")
+                yield from broker.start()
+                client = MQTTClient()
+                yield from client.connect('mqtt://127.0.0.1/')
+                ret = yield from client.subscribe([
+                    ('test_topic', QOS_2),
+                ])
+                self.assertEqual(ret[0], QOS_2)
+                client_pub = MQTTClient()
+                yield from client_pub.connect('mqtt://127.0.0.1/')
+                sent = yield from client_pub.publish_many(
+                    [('test_topic', b'data %d' % i) for i in range(6)] +
+                    [('test_topic', b'data qos0', QOS_0, False), ('test_topic', b'data qos2', QOS_2, False)],
+                    qos=QOS_1)
+                self.assertEqual([m.qos for m in sent], [QOS_1] * 6 + [QOS_0, QOS_2])
+                self.assertTrue(all(m.puback_packet for m in sent[:6]))
+                self.assertIsNotNone(sent[7].pubcomp_packet)
+                self.assertEqual(len(client_pub.session.inflight_out), 0)
+                yield from client_pub.disconnect()
+                received = []
+                for _ in range(8):
+                    message = yield from client.deliver_message()
+                    received.append(message.data)
+                self.assertEqual(sorted(received), sorted([b'data %d' % i for i in range(6)] + [b'data qos0', b'data qos2']))
+                yield from client.disconnect()
+                yield from broker.shutdown()
+                future.set_result(True)
+            except Exception as ae:
+                future.set_exception(ae)
+
+        future = asyncio.Future(loop=self.loop)
+        self.loop.run_until_complete(test_coro())
+        if future.exception():
+            raise future.exception()
+
     def test_deliver_timeout(self):
         @asyncio.coroutine
         def test_coro():
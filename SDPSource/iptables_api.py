@@ -1,17 +1,26 @@
 import iptc
+import time
 import socket
 import threading
 import traceback
-from log import get_logger
+import contextlib
+import subprocess
+import collections
+from log import get_logger, debug_enabled
+from params import params
 
 
 FAKE_TEST = False
 FILTER_PORT = False
 
+IPSET_NAME = 'sdp-hosts'
+# host rule operations queued by firewall_worker before they are merged
+FIREWALL_QUEUE_SIZE = 64
+
 
 LOGGER = get_logger()
 
-L = threading.Lock()
+L = threading.RLock()
 
 FILTER_TABLE = iptc.Table(iptc.Table.FILTER)
 FILTER_TABLE.autocommit = True
@@ -34,6 +43,37 @@ def chain2str(chain=FILTER_INPUT_CHAIN):
     return r
 
 
+def _log_rule(action, rule, position=None):
+    if position is None:
+        LOGGER.debug('[firewall] %s rule %s' % (action, rule2str(rule)))
+    else:
+        LOGGER.info('[firewall] %s rule %s to position %d' % (action, rule2str(rule), position))
+
+
+def _log_chain():
+    # walking the chain is expensive, dump it only for debugging
+    if debug_enabled():
+        LOGGER.debug('[firewall]\n%s' % chain2str())
+
+
+@contextlib.contextmanager
+def _batch():
+    """Hold the firewall lock and commit every rule change of the block at once."""
+    with L:
+        autocommit = FILTER_TABLE.autocommit
+        FILTER_TABLE.autocommit = False
+        try:
+            yield
+            FILTER_TABLE.commit()
+        except BaseException:
+            # drop the uncommitted changes
+            FILTER_TABLE.refresh()
+            raise
+        finally:
+            FILTER_TABLE.autocommit = autocommit
+        _log_chain()
+
+
 def exception_catcher(func):
     def wrapper(*args, **kwargs):
         try:
@@ -93,43 +133,31 @@ def _get_rule(src_addr, dst_addr, filter_port=False, protocol='tcp'):
 
 def _insert_rule(src_addr, dst_addr, filter_port=False, position=0):
     rule = _get_rule(src_addr, dst_addr, filter_port=filter_port)
-    with L:
-        LOGGER.info('[firewall] Insert rule %s to position %d \n%s' % (rule2str(rule), position, chain2str()))
+    with _batch():
+        _log_rule('Insert', rule, position)
         FILTER_INPUT_CHAIN.insert_rule(rule, position=position)
 
-    if not FILTER_TABLE.autocommit:
-        FILTER_TABLE.commit()
-
 
 def _add_rule(src_addr, dst_addr, filter_port=False, protocol='tcp'):
+    # caller holds a batch
     rule = _get_rule(src_addr, dst_addr, filter_port=filter_port, protocol=protocol)
-    with L:
-        LOGGER.info('[firewall] Append rule %s\n%s' % (rule2str(rule), chain2str()))
-        FILTER_INPUT_CHAIN.append_rule(rule)
-
-    if not FILTER_TABLE.autocommit:
-        FILTER_TABLE.commit()
+    _log_rule('Append', rule)
+    FILTER_INPUT_CHAIN.append_rule(rule)
 
 
 def _remove_rule(src_addr, dst_addr, filter_port=False, protocol='tcp'):
+    # caller holds a batch
     rule = _get_rule(src_addr, dst_addr, filter_port=filter_port, protocol=protocol)
-    with L:
-        LOGGER.info('[firewall] Delete rule %s\n%s' % (rule2str(rule), chain2str()))
-        FILTER_INPUT_CHAIN.delete_rule(rule)
-
-    if not FILTER_TABLE.autocommit:
-        FILTER_TABLE.commit()
+    _log_rule('Delete', rule)
+    FILTER_INPUT_CHAIN.delete_rule(rule)
 
 
 def _replace_rule(src_addr, dst_addr, filter_port=False, position=-1):
     rule = _get_rule(src_addr, dst_addr, filter_port=filter_port)
-    with L:
-        LOGGER.info('[firewall] Replace rule %s to position %d\n%s' % (rule2str(rule), position, chain2str()))
+    with _batch():
+        _log_rule('Replace', rule, position)
         FILTER_INPUT_CHAIN.replace_rule(rule, position=position)
 
-    if not FILTER_TABLE.autocommit:
-        FILTER_TABLE.commit()
-
 
 def _add_controller(controller_addr):
     return
@@ -150,35 +178,429 @@ def remove_device(listening_addr):
     _replace_rule(None, listening_addr, filter_port=True, position=2)
 
 
+def _host_ip(host):
+    # 'ip:port' from the controller or 'ip/mask' from a rule
+    return host.split(':')[0].split('/')[0]
+
+
+class iptables_backend:
+    """One ACCEPT rule per host in the INPUT chain, after the three fixed rules.
+
+    The rules it installed are modelled as a count per IP, so a refresh only
+    touches the difference and drift of the real chain can be detected.
+    """
+
+    def __init__(self):
+        self._installed = collections.Counter()
+
+    def init(self):
+        with L:
+            self._installed = collections.Counter()
+
+    def close(self):
+        self.init()
+
+    def _apply(self, to_add, to_remove):
+        # caller holds L, to_add and to_remove are Counters of IPs
+        if not to_add and not to_remove:
+            return
+        with _batch():
+            for ip, count in to_remove.items():
+                for _ in range(count):
+                    _remove_rule(ip, None)
+            for ip, count in to_add.items():
+                for _ in range(count):
+                    _add_rule(ip, None)
+
+    def update(self, to_add, to_remove):
+        with L:
+            removed = collections.Counter()
+            for host in to_remove:
+                ip = _host_ip(host)
+                if removed[ip] < self._installed[ip]:
+                    removed[ip] += 1
+                else:
+                    LOGGER.debug('[firewall] No rule for %s to remove.' % host)
+            added = collections.Counter(_host_ip(host) for host in to_add)
+            self._apply(added, removed)
+            for ip, count in removed.items():
+                if self._installed[ip] == count:
+                    del self._installed[ip]
+                else:
+                    self._installed[ip] -= count
+            self._installed.update(added)
+
+    def refresh(self, hosts):
+        with L:
+            desired = collections.Counter(_host_ip(host) for host in hosts)
+            self._apply(desired - self._installed, self._installed - desired)
+            self._installed = desired
+
+    def flush(self):
+        self.refresh([])
+
+    def check_drift(self, repair=False):
+        with L:
+            # the table is a copy cached by iptc, reload it to see changes made by others
+            FILTER_TABLE.refresh()
+            ours = collections.defaultdict(list)
+            foreign = []
+            for rule in FILTER_INPUT_CHAIN.rules[3:]:
+                ip = _host_ip(rule.src or '0.0.0.0')
+                if rule == _get_rule(ip, None):
+                    ours[ip].append(rule)
+                else:
+                    foreign.append(rule)
+            actual = collections.Counter(dict((ip, len(rules)) for ip, rules in ours.items()))
+            missing = self._installed - actual
+            unexpected = foreign + [rule for ip, count in (actual - self._installed).items()
+                                    for rule in ours[ip][-count:]]
+            if repair and (missing or unexpected):
+                with _batch():
+                    for rule in unexpected:
+                        _log_rule('Delete', rule)
+                        FILTER_INPUT_CHAIN.delete_rule(rule)
+                    for ip, count in missing.items():
+                        for _ in range(count):
+                            _add_rule(ip, None)
+        return set(missing), set(_host_ip(rule.src or '0.0.0.0') for rule in unexpected)
+
+
+def run_command(args, input=None):
+    """Run a command, raise CalledProcessError if it fails."""
+    return subprocess.run(args, input=input, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True, check=True).stdout
+
+
+class ipset_backend:
+    """A single INPUT rule matching the source against a hash:ip set.
+
+    Host updates are set operations sent through one 'ipset restore'. A
+    refresh sends the difference to the set, or fills a second set and swaps
+    it in atomically if most entries change. The set holds IPs, hosts sharing
+    an IP are reference counted.
+    """
+
+    def __init__(self, name=IPSET_NAME, runner=run_command):
+        """
+        Args:
+            name (str): Name of the ipset.
+            runner (callable): runner(args, input=None) runs a command and
+                returns its output, replaceable for tests.
+        """
+        self._name = name
+        self._runner = runner
+        self._refs = {}
+
+    def _restore(self, lines):
+        if lines:
+            LOGGER.debug('[firewall] ipset restore:\n%s' % '\n'.join(lines))
+            self._runner(['ipset', 'restore'], input='\n'.join(lines) + '\n')
+
+    def init(self):
+        with L:
+            self._refs = {}
+            self._restore(['create %s hash:ip -exist' % self._name, 'flush %s' % self._name])
+            rule = iptc.Rule()
+            rule.in_interface = 'eth0'
+            m = rule.create_match('set')
+            m.match_set = [self._name, 'src']
+            rule.create_target(iptc.Policy.ACCEPT)
+            _log_rule('Append', rule)
+            FILTER_INPUT_CHAIN.append_rule(rule)
+
+            if not FILTER_TABLE.autocommit:
+                FILTER_TABLE.commit()
+
+    def close(self):
+        # the rule referencing the set is already flushed
+        with L:
+            self._refs = {}
+            try:
+                self._runner(['ipset', 'destroy', self._name])
+            except subprocess.CalledProcessError as e:
+                LOGGER.warning('[firewall] Destroy ipset %s failed: %s' % (self._name, e.stderr))
+
+    def update(self, to_add, to_remove):
+        with L:
+            refs = dict(self._refs)
+            lines = []
+            for host in to_remove:
+                ip = _host_ip(host)
+                count = refs.get(ip, 0) - 1
+                if count > 0:
+                    refs[ip] = count
+                elif count == 0:
+                    del refs[ip]
+                    lines.append('del %s %s -exist' % (self._name, ip))
+            for host in to_add:
+                ip = _host_ip(host)
+                count = refs.get(ip, 0)
+                if count == 0:
+                    lines.append('add %s %s -exist' % (self._name, ip))
+                refs[ip] = count + 1
+            self._restore(lines)
+            self._refs = refs
+
+    def _diff_lines(self, name, current, desired):
+        lines = ['del %s %s -exist' % (name, ip) for ip in current if not ip in desired]
+        lines.extend('add %s %s -exist' % (name, ip) for ip in desired if not ip in current)
+        return lines
+
+    def refresh(self, hosts):
+        with L:
+            refs = {}
+            for host in hosts:
+                ip = _host_ip(host)
+                refs[ip] = refs.get(ip, 0) + 1
+            lines = self._diff_lines(self._name, self._refs, refs)
+            if len(lines) > len(refs):
+                swap = self._name + '-swap'
+                lines = ['create %s hash:ip -exist' % swap, 'flush %s' % swap]
+                lines.extend('add %s %s -exist' % (swap, ip) for ip in refs)
+                lines.extend(['swap %s %s' % (swap, self._name), 'destroy %s' % swap])
+            self._restore(lines)
+            self._refs = refs
+
+    def flush(self):
+        with L:
+            self._refs = {}
+            self._restore(['flush %s' % self._name])
+
+    def check_drift(self, repair=False):
+        with L:
+            actual = set()
+            for line in self._runner(['ipset', 'save', self._name]).splitlines():
+                fields = line.split()
+                if len(fields) >= 3 and fields[0] == 'add':
+                    actual.add(fields[2])
+            missing = set(ip for ip in self._refs if not ip in actual)
+            unexpected = actual - set(self._refs)
+            if repair:
+                self._restore(self._diff_lines(self._name, actual, self._refs))
+        return missing, unexpected
+
+
+BACKENDS = {
+    'iptables': iptables_backend,
+    'ipset': ipset_backend,
+}
+
+
+def set_backend(backend):
+    """Select the host rule backend, call before firewall_init.
+
+    Args:
+        backend (str or object): A name in BACKENDS or a backend instance.
+    """
+    global BACKEND
+    if isinstance(backend, str):
+        if backend not in BACKENDS:
+            raise ValueError("Unknown firewall backend %s." % backend)
+        backend = BACKENDS[backend]()
+    BACKEND = backend
+    LOGGER.info('[firewall] Use %s.' % type(backend).__name__)
+
+
+BACKEND = None
+set_backend(params.firewall_backend)
+
+
 @exception_catcher
+def update_hosts(to_add=(), to_remove=()):
+    """Remove and add host rules with a single commit.
+
+    Args:
+        to_add (list): Addresses to accept.
+        to_remove (list): Addresses not to accept any more, removed first.
+    """
+    LOGGER.info('[firewall] Remove %d and add %d host rules.' % (len(to_remove), len(to_add)))
+    BACKEND.update(to_add, to_remove)
+
+
 def add_hosts(host_addr):
-    if isinstance(host_addr, list):
-        for host in host_addr:
-            _add_rule(host, None)
-    else:
-        _add_rule(host_addr, None)
+    if not isinstance(host_addr, list):
+        host_addr = [host_addr]
+    update_hosts(to_add=host_addr)
 
 
-@exception_catcher
 def remove_hosts(host_addr):
-    if isinstance(host_addr, list):
-        for host in host_addr:
-            _remove_rule(host, None)
-    else:
-        _remove_rule(host_addr, None)
+    if not isinstance(host_addr, list):
+        host_addr = [host_addr]
+    update_hosts(to_remove=host_addr)
 
 
 @exception_catcher
-def flush_hosts():
-    with L:
-        while len(FILTER_INPUT_CHAIN.rules) > 3:
-            to_delete = FILTER_INPUT_CHAIN.rules[-1]
-            LOGGER.info('[firewall] Delete rule %s' % rule2str(to_delete))
-            FILTER_INPUT_CHAIN.delete_rule(to_delete)
-            LOGGER.info('[firewall]\n%s' % chain2str())
+def refresh_hosts(host_addr):
+    """Replace all host rules by host_addr at once."""
+    LOGGER.info('[firewall] Refresh %d host rules.' % len(host_addr))
+    BACKEND.refresh(host_addr)
 
-        if not FILTER_TABLE.autocommit:
-            FILTER_TABLE.commit()
+
+@exception_catcher
+def flush_hosts():
+    LOGGER.info('[firewall] Flush host rules.')
+    BACKEND.flush()
+
+
+def check_drift(repair=False):
+    """Compare the host rules in the kernel with the rules installed by this module.
+
+    Args:
+        repair (bool): Restore the installed rules if they drifted.
+
+    Returns:
+        (set, set): IPs missing in the kernel and IPs not installed by this module.
+    """
+    missing, unexpected = BACKEND.check_drift(repair)
+    if missing or unexpected:
+        LOGGER.warning('[firewall] Host rules drifted, %d missing, %d unexpected%s.' % (
+            len(missing), len(unexpected), ', repaired' if repair else ''))
+    return missing, unexpected
+
+
+def start_drift_check(interval, repair=True):
+    """Run check_drift() every interval seconds in a daemon thread."""
+    def drift_loop():
+        while True:
+            time.sleep(interval)
+            try:
+                check_drift(repair)
+            except BaseException as e:
+                LOGGER.warning("Iptables error: %s." % str(e))
+
+    t = threading.Thread(target=drift_loop, name='drift_check')
+    t.setDaemon(True)
+    t.start()
+    return t
+
+
+def merge_host_ops(ops):
+    """Merge queued host rule operations into one.
+
+    Args:
+        ops (list): ('update', to_add, to_remove), ('refresh', hosts) or ('flush',) tuples.
+
+    Returns:
+        tuple: A single operation with the same effect.
+    """
+    base = None
+    delta = collections.Counter()
+    for op in ops:
+        if op[0] == 'update':
+            delta.update(op[1])
+            delta.subtract(op[2])
+        else:
+            # a refresh or flush supersedes everything before it
+            base = collections.Counter(op[1] if op[0] == 'refresh' else ())
+            delta = collections.Counter()
+    if base is None:
+        return 'update', list((+delta).elements()), list((-delta).elements())
+    return 'refresh', list((base + delta).elements())
+
+
+class firewall_worker:
+    """Applies host rule operations on its own thread so callers never wait for iptables.
+
+    Operations queued while the worker is busy are merged and applied at once.
+    Beyond max_pending queued operations they are merged when submitted, so
+    the queue stays bounded without blocking the caller.
+    """
+
+    def __init__(self, max_pending=FIREWALL_QUEUE_SIZE, threaded=True):
+        """
+        Args:
+            max_pending (int): Bound of the queue.
+            threaded (bool): Apply operations in the caller's thread if False.
+        """
+        self._cond = threading.Condition()
+        # (operation, callback)
+        self._pending = []
+        self._max_pending = max_pending
+        self._threaded = threaded
+        self._busy = False
+        self._thread = None
+        self.submitted = 0
+        self.applied = 0
+
+    def update(self, to_add=(), to_remove=(), callback=None):
+        self._submit(('update', list(to_add), list(to_remove)), callback)
+
+    def refresh(self, hosts, callback=None):
+        self._submit(('refresh', list(hosts)), callback)
+
+    def flush(self, callback=None):
+        self._submit(('flush',), callback)
+
+    def _submit(self, op, callback):
+        """Queue op, callback(error) is called once it is applied, error is None on success."""
+        if not self._threaded:
+            self.submitted += 1
+            self._apply([(op, callback)])
+            return
+        with self._cond:
+            self.submitted += 1
+            self._pending.append((op, callback))
+            if len(self._pending) > self._max_pending:
+                merged = merge_host_ops([o for o, _ in self._pending])
+                callbacks = [c for _, c in self._pending if c]
+                self._pending = [(merged, self._chain(callbacks))]
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='firewall_worker')
+                self._thread.setDaemon(True)
+                self._thread.start()
+            self._cond.notify()
+
+    @staticmethod
+    def _chain(callbacks):
+        def callback(error):
+            for c in callbacks:
+                c(error)
+        return callback
+
+    def join(self):
+        """Wait until every queued operation is applied."""
+        with self._cond:
+            while self._pending or self._busy:
+                self._cond.wait()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                batch = self._pending
+                self._pending = []
+                self._busy = True
+            try:
+                self._apply(batch)
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
+
+    def _apply(self, batch):
+        op = merge_host_ops([o for o, _ in batch])
+        error = None
+        start = time.time()
+        try:
+            if op[0] == 'update':
+                if op[1] or op[2]:
+                    BACKEND.update(op[1], op[2])
+            else:
+                BACKEND.refresh(op[1])
+        except BaseException as e:
+            LOGGER.warning("Iptables error: %s." % str(e))
+            error = e
+        self.applied += 1
+        LOGGER.info('[firewall] Applied %d operations as one %s in %.3fs.' % (len(batch), op[0], time.time() - start))
+        for _, callback in batch:
+            if callback:
+                try:
+                    callback(error)
+                except BaseException:
+                    LOGGER.error("Catch unhandled exception in firewall callback.")
+                    traceback.print_exc()
 
 
 @exception_catcher
@@ -201,6 +623,8 @@ def firewall_init(listening_addr):
     if not FILTER_TABLE.autocommit:
         FILTER_TABLE.commit()
 
+    BACKEND.init()
+
 
 @exception_catcher
 def firewall_open_all():
@@ -216,6 +640,8 @@ def firewall_open_all():
     if not FILTER_TABLE.autocommit:
         FILTER_TABLE.commit()
 
+    BACKEND.close()
+
 if __name__ == '__main__':
     firewall_init('127.0.0.1:2222')
     add_hosts(['192.168.1.1:1', '192.168.1.2:2'])
@@ -0,0 +1,83 @@
+#!/usr/bin/python3
+"""Host rule programming speed of iptables_api against fake_iptc and fake_ipset.
+
+Adding and removing N host rules one call per host, as update_lists did
+before, is compared with one batched update_hosts call, for the iptables and
+the ipset backend. A refresh of N hosts of which 1% changed shows what
+reconciling against the installed rules costs. Run with M_SDP_LOG_LEVEL=DEBUG
+to include the chain dumps.
+
+Usage: iptables_api_bench.py [host_count]
+"""
+
+import os
+os.environ.setdefault('M_SDP_LOG_LEVEL', 'ERROR')
+
+import sys
+import time
+import fake_iptc
+import fake_ipset
+sys.modules['iptc'] = fake_iptc
+import iptables_api
+
+
+def _hosts(count):
+    return ['10.%d.%d.%d:%d' % (i >> 16, (i >> 8) & 0xff, i & 0xff, 40000 + i % 20000) for i in range(count)]
+
+
+def run(count, batched, backend='iptables'):
+    runner = fake_ipset.runner()
+    if backend == 'ipset':
+        iptables_api.set_backend(iptables_api.ipset_backend(runner=runner))
+    else:
+        iptables_api.set_backend(backend)
+    iptables_api.firewall_init('127.0.0.1:4444')
+    table = iptables_api.FILTER_TABLE
+    hosts = _hosts(count)
+    commits, written = table.commits, table.written
+
+    start = time.perf_counter()
+    if batched:
+        iptables_api.update_hosts(to_add=hosts)
+        iptables_api.update_hosts(to_remove=hosts)
+    else:
+        for host in hosts:
+            iptables_api.add_hosts(host)
+        for host in hosts:
+            iptables_api.remove_hosts(host)
+    elapsed = time.perf_counter() - start
+
+    print('%-8s %-8s hosts: %5d, %9.0f rules/s, commits: %5d, rules written: %8d, ipset calls: %5d' % (
+        backend, 'batched' if batched else 'per host', count, 2 * count / elapsed,
+        table.commits - commits, table.written - written, runner.calls))
+
+
+def run_refresh(count, backend='iptables'):
+    runner = fake_ipset.runner()
+    if backend == 'ipset':
+        iptables_api.set_backend(iptables_api.ipset_backend(runner=runner))
+    else:
+        iptables_api.set_backend(backend)
+    iptables_api.firewall_init('127.0.0.1:4444')
+    table = iptables_api.FILTER_TABLE
+    hosts = _hosts(count + count // 100)
+    iptables_api.refresh_hosts(hosts[:count])
+    written = table.written
+
+    start = time.perf_counter()
+    iptables_api.refresh_hosts(hosts[count // 100:])
+    elapsed = time.perf_counter() - start
+
+    print('%-8s refresh  hosts: %5d, changed: %4d, %9.2f ms, rules written: %8d, ipset calls: %5d' % (
+        backend, count, count // 100, elapsed * 1e3, table.written - written, runner.calls))
+
+
+def main(count=1000):
+    for backend in ('iptables', 'ipset'):
+        run(count, False, backend)
+        run(count, True, backend)
+        run_refresh(count, backend)
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:2]))
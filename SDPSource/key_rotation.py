@@ -0,0 +1,67 @@
+import hmac
+import secrets
+import threading
+from params import params
+
+# random bytes of a key, 12 give 16 url-safe characters
+KEY_BYTES = 12
+
+
+def new_key():
+    return secrets.token_urlsafe(KEY_BYTES)
+
+
+class key_ring:
+    """Keys a device may authenticate with, rotated on every use.
+
+    The keys are an immutable tuple, oldest first, that is replaced as a
+    whole. Matching a key and making the next one happen outside any lock,
+    only swapping in the new tuple is checked against a concurrent rotation.
+    Besides the newest key the ring keeps the last history keys that were
+    used, so a device that lost the reply carrying its new key can still
+    come back with the key it sent. Keys handed out but never used are
+    dropped once an older key is used again.
+
+    Args:
+        key (str): Initial key.
+        history (int): Used keys accepted next to the newest one.
+    """
+
+    def __init__(self, key, history=None):
+        self._history = max(params.key_history if history is None else history, 1)
+        self._keys = (key,)
+        self._swap_lock = threading.Lock()
+
+    def _match(self, keys, key):
+        # every key is compared so the time doesn't tell which one matched
+        key = key.encode()
+        index = -1
+        for i, k in enumerate(keys):
+            if hmac.compare_digest(k.encode(), key):
+                index = i
+        return index
+
+    def rotate(self, key):
+        """
+        Returns:
+            str: The next key if key is known, False otherwise.
+        """
+        if not isinstance(key, str):
+            return False
+        while True:
+            keys = self._keys
+            i = self._match(keys, key)
+            if i < 0:
+                return False
+            nkey = new_key()
+            rotated = keys[max(i + 1 - self._history, 0):i + 1] + (nkey,)
+            with self._swap_lock:
+                if self._keys is keys:
+                    self._keys = rotated
+                    return nkey
+
+    def __contains__(self, key):
+        return isinstance(key, str) and self._match(self._keys, key) >= 0
+
+    def __len__(self):
+        return len(self._keys)
@@ -0,0 +1,64 @@
+#!/usr/bin/python3
+"""Key rotation rate of access_policy.member.auth.
+
+N members authenticate with their current key, each one gets its next key,
+for a few rounds, from one thread and then from several at once. Afterwards
+every member must refuse a key it never had, still accept the key it used
+last, and forget keys once a newer one was used.
+
+Usage: key_rotation_bench.py [member_count] [rounds] [threads]
+"""
+
+import os
+os.environ.setdefault('M_SDP_LOG_LEVEL', 'ERROR')
+
+import sys
+import time
+import threading
+from params import params
+from access_policy import member
+
+
+def _rotate(members, keys, used, start, step, rounds):
+    for _ in range(rounds):
+        for i in range(start, len(members), step):
+            new_key = members[i].auth(keys[i])
+            if not new_key:
+                raise RuntimeError("Member %d refused its key." % i)
+            used[i], keys[i] = keys[i], new_key
+
+
+def run(count, rounds, threads):
+    members = [member('bench-%d' % i) for i in range(count)]
+    keys = ['bench-%d' % i for i in range(count)]
+    used = list(keys)
+    workers = [threading.Thread(target=_rotate, args=(members, keys, used, t, threads, rounds)) for t in range(threads)]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - start
+
+    for i, m in enumerate(members):
+        if m.auth('never-handed-out'):
+            raise RuntimeError("Member %d accepted an unknown key." % i)
+        # the reply with keys[i] got lost, the device comes back with the key it used
+        retried = m.auth(used[i])
+        if not retried or keys[i] in m._keys:
+            raise RuntimeError("Member %d didn't fall back to its used key." % i)
+        if not m.auth(retried) or used[i] in m._keys:
+            raise RuntimeError("Member %d kept a key too long." % i)
+
+    print('threads %2d: %d members x %d rounds, %8.0f keys/s' % (
+        threads, count, rounds, count * rounds / elapsed))
+
+
+def main(count=10000, rounds=10, threads=8):
+    params.test_mode = False
+    run(count, rounds, 1)
+    run(count, rounds, threads)
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:4]))
@@ -0,0 +1,115 @@
+import os
+import atexit
+import pickle
+import socket
+import threading
+from log import get_logger
+
+KEY_FILE = os.path.join('.', 'keyfile')
+# seconds a new key waits for more changes before the file is written
+FLUSH_DELAY = 1
+
+
+class key_store:
+    """Keys of the device identities of this process, one store per file.
+
+    The file is read once and the keys are kept in memory. Changed keys are
+    written together after FLUSH_DELAY seconds, to a temporary file that is
+    fsynced and renamed over the key file, so the file is always complete.
+    Losing the newest key in a crash is survivable, the controller keeps
+    accepting the key it replaced until the new one has been used.
+    """
+    _instance_lock = threading.Lock()
+    _instances = {}
+
+    def __new__(cls, path=KEY_FILE, *args, **kwargs):
+        path = os.path.abspath(path)
+        with key_store._instance_lock:
+            if path not in key_store._instances:
+                key_store._instances[path] = object.__new__(cls)
+            return key_store._instances[path]
+
+    def __init__(self, path=KEY_FILE, flush_delay=FLUSH_DELAY):
+        """
+        Args:
+            path (str): Key file, shared by all identities.
+            flush_delay (float): 0 writes every change at once. Only the
+                first construction of a store for a path sets it.
+        """
+        if not hasattr(self, '_keys'):
+            self._logger = get_logger()
+            self._path = os.path.abspath(path)
+            self._flush_delay = flush_delay
+            self._l = threading.Lock()
+            # flushes write one after the other, a later snapshot always wins
+            self._write_lock = threading.Lock()
+            self._keys = self._load()
+            self._dirty = False
+            self._timer = None
+            self.writes = 0
+            atexit.register(self.flush)
+
+    def _load(self):
+        for path in (self._path, self._path + '.backup'):
+            try:
+                with open(path, 'rb') as f:
+                    keys = pickle.load(f)
+            except Exception:
+                continue
+            if isinstance(keys, dict):
+                return keys
+            # the single key of the host, written before there were identities
+            return {socket.gethostname(): keys}
+        return {}
+
+    def get(self, ID):
+        """Key of device ID, the ID itself if it never got one."""
+        with self._l:
+            return self._keys.get(ID, ID)
+
+    def set(self, ID, key):
+        with self._l:
+            if self._keys.get(ID) == key:
+                return
+            self._keys[ID] = key
+            self._dirty = True
+            if self._flush_delay > 0:
+                if self._timer is None:
+                    self._timer = threading.Timer(self._flush_delay, self.flush)
+                    self._timer.setDaemon(True)
+                    self._timer.start()
+                return
+        self.flush()
+
+    def flush(self):
+        """Write the keys now if any changed."""
+        with self._write_lock:
+            with self._l:
+                if self._timer:
+                    self._timer.cancel()
+                    self._timer = None
+                if not self._dirty:
+                    return
+                keys = dict(self._keys)
+                self._dirty = False
+            try:
+                self._write(keys)
+            except OSError as e:
+                self._logger.warning("Can't write key file %s.(%s)" % (self._path, str(e)))
+                with self._l:
+                    self._dirty = True
+
+    def _write(self, keys):
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(keys, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._path)
+        # make the rename itself durable
+        fd = os.open(os.path.dirname(self._path), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        self.writes += 1
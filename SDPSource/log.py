@@ -67,3 +67,8 @@ logging_config.dictConfig(LOGGING_DIC)
 
 def get_logger():
     return logging.getLogger(__name__)
+
+
+def debug_enabled():
+    """Whether debug records are emitted, to skip building expensive messages."""
+    return logging.getLevelName(loglevel) <= logging.DEBUG
@@ -0,0 +1,135 @@
+#!/usr/bin/python3
+"""Publish rate of the device monitor's MQTT client and of the MQTT bridge.
+
+A local hbmqtt broker runs in its own process together with a subscriber
+that counts the messages it gets. The publisher reaches the broker through
+a relay that delays every chunk by half the given round trip time, like a
+broker on another host. N device messages are published at QoS 2, one
+after the other with mqtt_client and through the bounded queue of
+mqtt_bridge. A run ends when the publisher is done and the subscriber got
+every message.
+
+Usage: mqtt_bridge_bench.py [message_count] [rtt_ms] [inflight] [qos]
+"""
+
+import os
+os.environ.setdefault('M_SDP_LOG_LEVEL', 'ERROR')
+
+import sys
+import copy
+import time
+import socket
+import asyncio
+import logging
+import multiprocessing
+from hbmqtt.broker import Broker
+from hbmqtt.client import MQTTClient
+from mqtt_client import mqtt_client, mqtt_bridge
+from mqtt_config import CONFIG_CLIENT
+
+TOPIC = 'devices/bench'
+PAYLOAD = b'x' * 64
+
+
+def _free_address():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    address = '127.0.0.1:%d' % s.getsockname()[1]
+    s.close()
+    return address
+
+
+async def _subscribe(uri, received):
+    client = MQTTClient(config={'keep_alive': 60})
+    await client.connect(uri)
+    await client.subscribe([(TOPIC, 2)])
+    while True:
+        await client.deliver_message()
+        received.value += 1
+
+
+async def _forward(reader, writer, delay):
+    # chunks are written in order, each one delay seconds after it was read
+    chunks = asyncio.Queue()
+
+    async def write():
+        while True:
+            due, data = await chunks.get()
+            if data is None:
+                writer.close()
+                return
+            await asyncio.sleep(due - time.monotonic())
+            writer.write(data)
+
+    task = asyncio.ensure_future(write())
+    try:
+        while True:
+            data = await reader.read(65536)
+            chunks.put_nowait((time.monotonic() + delay, data or None))
+            if not data:
+                break
+    finally:
+        await task
+
+
+def _relay(broker_address, delay):
+    ip, port = broker_address.split(':')
+
+    async def handle(reader, writer):
+        broker_reader, broker_writer = await asyncio.open_connection(ip, int(port))
+        await asyncio.gather(
+            _forward(reader, broker_writer, delay),
+            _forward(broker_reader, writer, delay))
+    return handle
+
+
+def _serve(address, relay_address, delay, received):
+    logging.disable(logging.CRITICAL)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    broker = Broker({
+        'listeners': {'default': {'type': 'tcp', 'bind': address}},
+        'sys_interval': 0,
+        'auth': {'allow-anonymous': True}}, loop)
+    loop.run_until_complete(broker.start())
+    ip, port = relay_address.split(':')
+    loop.run_until_complete(asyncio.start_server(_relay(address, delay), ip, int(port)))
+    asyncio.ensure_future(_subscribe('mqtt://' + address, received))
+    loop.run_forever()
+
+
+def run(name, client, count, qos, received):
+    client.connect()
+    start = time.perf_counter()
+    for _ in range(count):
+        client.publish(PAYLOAD, topic=TOPIC, qos=qos)
+    client.disconnect()
+    while received.value < count:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    received.value = 0
+    print('%-6s QoS %d: %d messages, %7.0f msg/s' % (name, qos, count, count / elapsed))
+
+
+def main(count=2000, rtt_ms=5, inflight=64, qos=2):
+    logging.disable(logging.CRITICAL)
+    address = _free_address()
+    relay_address = _free_address()
+    received = multiprocessing.Value('i', 0)
+    broker = multiprocessing.Process(
+        target=_serve, args=(address, relay_address, rtt_ms / 2000, received), daemon=True)
+    broker.start()
+    time.sleep(1)
+
+    config = copy.deepcopy(CONFIG_CLIENT)
+    config['broker']['uri'] = 'mqtt://' + relay_address
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    run('client', mqtt_client(config=config), count, qos, received)
+    run('bridge', mqtt_bridge(config=config, inflight=inflight), count, qos, received)
+
+    broker.terminate()
+    broker.join()
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:5]))
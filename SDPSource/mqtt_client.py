@@ -2,6 +2,7 @@
 
 import logging
 import asyncio
+import threading
 
 from hbmqtt.client import MQTTClient, ClientException
 from hbmqtt.mqtt.constants import QOS_0, QOS_1, QOS_2
@@ -10,23 +11,29 @@ from hbmqtt.session import ApplicationMessage
 from mqtt_config import CONFIG_CLIENT as CONFIG
 
 from params import params
-
-import pickle
+from payload_codec import encode_payload
 
 logger = logging.getLogger()
 
+# packet IDs of QoS 1 and 2 publishes are 16 bit
+MAX_INFLIGHT = 65535
+
+
+def broker_uri(config, username=None, password=None):
+    if username and password:
+        uri = CONFIG['broker']['uri']
+        header = uri.split(':')[0]
+        addr = uri.split('@')[-1]
+        return header + '://' + str(username) + ':' + str(password) + '@' + addr
+    return config['broker']['uri']
+
+
 class mqtt_client(MQTTClient):
     def __init__(self, client_id=None, config=CONFIG, loop=None):
         MQTTClient.__init__(self, client_id, config, loop)
 
     def connect(self, username=None, password=None):
-        if username and password:
-            uri = CONFIG['broker']['uri']
-            header = uri.split(':')[0]
-            addr = uri.split('@')[-1]
-            uri = header + '://' + str(username) + ':' + str(password) + '@' + addr
-        else:
-            uri = self.config['broker']['uri']
+        uri = broker_uri(self.config, username, password)
         self.logger.debug("MQTT client connect to %s" % uri)
         # yield from MQTTClient.connect(self, uri=uri)
         self._loop.run_until_complete(MQTTClient.connect(self, uri=uri))
@@ -35,18 +42,244 @@ class mqtt_client(MQTTClient):
         if not topic:
             topic = 'devices/' + self.session.username
 
-        if isinstance(message, str):
-            message = bytes(message, encoding='utf-8')
-        elif isinstance(message, object):
-             message = pickle.loads(message)
-        else:
-            message = bytes(str(message), encoding='utf-8')
+        message = encode_payload(message)
         # yield from MQTTClient.publish(self, topic, message, qos=qos, retain=retain)
         self._loop.run_until_complete(MQTTClient.publish(self, topic, message, qos=qos, retain=retain))
 
     def disconnect(self):
         self._loop.run_until_complete(MQTTClient.disconnect(self))
 
+
+class mqtt_bridge:
+    """Drop-in for mqtt_client that publishes on an event loop thread of its own.
+
+    publish() puts the message into a bounded queue and returns, up to
+    inflight messages are published at once while earlier ones wait for
+    their acknowledgements. A full queue blocks publish(), so a device that
+    sends faster than the broker acknowledges is no longer read from and is
+    slowed down by TCP. Messages may be acknowledged out of order, a failed
+    publish is logged and dropped. publish() raises ClientException unless
+    the bridge is connected, disconnect() waits for the queue to drain.
+
+    Args:
+        inflight (int): Publishes awaiting acknowledgement at once, bounded
+            by the 16 bit MQTT packet ID space.
+        queue_size (int): Messages accepted but not yet acknowledged.
+        loop (asyncio.AbstractEventLoop): Loop running in another thread to
+            use instead of one of its own, it isn't stopped on disconnect.
+    """
+
+    def __init__(self, client_id=None, config=CONFIG, inflight=None, queue_size=None, loop=None):
+        self.logger = logging.getLogger(__name__)
+        self._inflight = min(inflight or params.mqtt_inflight, MAX_INFLIGHT)
+        self._slots = threading.Semaphore(max(queue_size or params.mqtt_queue_size, self._inflight))
+        self._thread = None
+        if loop is None:
+            loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(target=loop.run_forever, daemon=True)
+            self._thread.start()
+        self._loop = loop
+        self._queue = None
+        self._connected = False
+        self._client = self._call(self._create(client_id, config))
+        # publisher coroutines, started per message up to inflight and ended
+        # when the queue is empty, an idle connection costs none
+        self._publishers = 0
+
+    @property
+    def session(self):
+        return self._client.session
+
+    def _call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    async def _create(self, client_id, config):
+        # the plugin manager and the queue take the loop of the thread they are made in
+        self._queue = asyncio.Queue()
+        return MQTTClient(client_id, config, self._loop)
+
+    async def _connect(self, uri):
+        await self._client.connect(uri=uri)
+        self._connected = True
+
+    def connect(self, username=None, password=None):
+        uri = broker_uri(self._client.config, username, password)
+        self.logger.debug("MQTT bridge connect to %s" % uri)
+        self._call(self._connect(uri))
+
+    def _enqueue(self, item):
+        self._queue.put_nowait(item)
+        if self._publishers < self._inflight:
+            self._publishers += 1
+            asyncio.ensure_future(self._publisher())
+
+    async def _publisher(self):
+        try:
+            while not self._queue.empty():
+                topic, message, qos, retain = self._queue.get_nowait()
+                try:
+                    await self._client.publish(topic, message, qos=qos, retain=retain)
+                except Exception as e:
+                    self.logger.warning("Drop message to %s.(%s)" % (topic, str(e)))
+                finally:
+                    self._queue.task_done()
+                    self._slots.release()
+        finally:
+            self._publishers -= 1
+
+    def publish(self, message, topic=None, qos=None, retain=None):
+        if not self._connected:
+            raise ClientException("MQTT bridge not connected")
+        if not topic:
+            topic = 'devices/' + self.session.username
+
+        message = encode_payload(message)
+        self._slots.acquire()
+        self._loop.call_soon_threadsafe(self._enqueue, (topic, message, qos, retain))
+
+    async def _disconnect(self):
+        if self._connected:
+            self._connected = False
+            await self._queue.join()
+            await self._client.disconnect()
+
+    def disconnect(self):
+        try:
+            self._call(self._disconnect())
+        finally:
+            if self._thread:
+                self._loop.call_soon_threadsafe(self._loop.stop)
+                self._thread.join()
+                self._loop.close()
+
+
+class _pooled:
+    def __init__(self, bridge):
+        self.bridge = bridge
+        self.refs = 1
+        # counts releases, an eviction only goes ahead if no handler came and went since
+        self.generation = 0
+        self.connected = False
+        self.lock = threading.Lock()
+
+
+class broker_pool:
+    """Broker connections shared by the device handlers of a monitor.
+
+    Handlers with the same credentials share one mqtt_bridge, so the broker
+    still checks every device's own username and password, and all bridges
+    run on one event loop thread. A connection nobody uses is closed after
+    idle_timeout seconds, a device reconnecting within that time gets its
+    old connection back.
+    """
+    _instance_lock = threading.Lock()
+
+    def __new__(cls, *args, **kwargs):
+        if not hasattr(broker_pool, "_instance"):
+            with broker_pool._instance_lock:
+                if not hasattr(broker_pool, "_instance"):
+                    broker_pool._instance = object.__new__(cls)
+        return broker_pool._instance
+
+    def __init__(self, config=CONFIG, idle_timeout=None):
+        # handler threads make their pool handles at the same time
+        with broker_pool._instance_lock:
+            if hasattr(self, '_connections'):
+                return
+            self.logger = logging.getLogger(__name__)
+            self._config = config
+            self._idle_timeout = params.mqtt_idle_timeout if idle_timeout is None else idle_timeout
+            self._l = threading.Lock()
+            self.connects = 0
+            self._loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=self._loop.run_forever, name='broker_pool', daemon=True)
+            thread.start()
+            self._connections = {}
+
+    def __len__(self):
+        with self._l:
+            return len(self._connections)
+
+    def acquire(self, username=None, password=None):
+        """
+        Returns:
+            mqtt_bridge: Connected bridge of these credentials, give it back
+                with release().
+
+        Raises:
+            ClientException: The broker refused the credentials or is down.
+        """
+        key = (username, password)
+        with self._l:
+            entry = self._connections.get(key)
+            if entry is None:
+                entry = _pooled(mqtt_bridge(config=self._config, loop=self._loop))
+                self._connections[key] = entry
+            else:
+                entry.refs += 1
+        with entry.lock:
+            if not entry.connected:
+                try:
+                    entry.bridge.connect(username, password)
+                except BaseException:
+                    self.release(entry.bridge, username, password)
+                    raise
+                entry.connected = True
+                self.connects += 1
+        return entry.bridge
+
+    def release(self, bridge, username=None, password=None):
+        key = (username, password)
+        with self._l:
+            entry = self._connections.get(key)
+            if entry is None or entry.bridge is not bridge:
+                return
+            entry.refs -= 1
+            entry.generation += 1
+            if entry.refs > 0:
+                return
+            if not entry.connected:
+                del self._connections[key]
+                return
+            generation = entry.generation
+        self._loop.call_soon_threadsafe(
+            self._loop.call_later, self._idle_timeout, self._evict, key, entry, generation)
+
+    def _evict(self, key, entry, generation):
+        with self._l:
+            if self._connections.get(key) is not entry or entry.refs or entry.generation != generation:
+                return
+            del self._connections[key]
+        self.logger.debug("Close idle broker connection of %s." % key[0])
+        asyncio.ensure_future(entry.bridge._disconnect())
+
+
+class pooled_client:
+    """A device handler's share of a broker_pool connection, used like mqtt_client."""
+
+    def __init__(self, pool=None):
+        self._pool = pool or broker_pool()
+        self._bridge = None
+        self._credentials = None
+
+    @property
+    def session(self):
+        return self._bridge.session
+
+    def connect(self, username=None, password=None):
+        self.disconnect()
+        self._bridge = self._pool.acquire(username, password)
+        self._credentials = (username, password)
+
+    def publish(self, message, topic=None, qos=None, retain=None):
+        self._bridge.publish(message, topic=topic, qos=qos, retain=retain)
+
+    def disconnect(self):
+        if self._bridge:
+            self._pool.release(self._bridge, *self._credentials)
+            self._bridge = None
+
+
 @asyncio.coroutine
 def test_coro():
     C = mqtt_client(client_id='test', config=CONFIG)
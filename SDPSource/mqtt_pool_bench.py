@@ -0,0 +1,143 @@
+#!/usr/bin/python3
+"""Broker connections and memory of the device monitor's MQTT clients, one
+client per device handler against the shared broker_pool.
+
+A local hbmqtt broker runs in its own process. N device handler sessions of
+D devices are open at once, each connects with its device's credentials and
+publishes a few messages, then all of them close and every device reconnects
+R times. Each mode runs in a fresh process, which reports its resident memory,
+thread and socket count while all sessions are open and how many broker
+connections were made in total.
+
+Usage: mqtt_pool_bench.py [session_count] [device_count] [reconnects]
+"""
+
+import os
+os.environ.setdefault('M_SDP_LOG_LEVEL', 'ERROR')
+
+import sys
+import time
+import socket
+import asyncio
+import logging
+import threading
+import multiprocessing
+from hbmqtt.broker import Broker
+import mqtt_client
+from mqtt_config import CONFIG_CLIENT
+
+TOPIC = 'devices/bench'
+MESSAGES = 5
+
+
+def _free_address():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    address = '127.0.0.1:%d' % s.getsockname()[1]
+    s.close()
+    return address
+
+
+def _serve(address):
+    logging.disable(logging.CRITICAL)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    broker = Broker({
+        'listeners': {'default': {'type': 'tcp', 'bind': address, 'max-connections': 0}},
+        'sys_interval': 0,
+        'auth': {'allow-anonymous': True}}, loop)
+    loop.run_until_complete(broker.start())
+    loop.run_forever()
+
+
+def _status():
+    status = {}
+    with open('/proc/self/status') as f:
+        for line in f:
+            k, v = line.split(':', 1)
+            status[k] = v.split()[0] if v.split() else ''
+    sockets = 0
+    for fd in os.listdir('/proc/self/fd'):
+        try:
+            sockets += os.readlink('/proc/self/fd/' + fd).startswith('socket:')
+        except OSError:
+            pass
+    return int(status['VmRSS']), threading.active_count(), sockets
+
+
+def _client(mode):
+    if mode == 'pool':
+        return mqtt_client.pooled_client()
+    # like the device monitor, whose handler thread has an event loop
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    return mqtt_client.mqtt_client(loop=loop)
+
+
+def _session(mode, ID, connected, done):
+    client = _client(mode)
+    client.connect(ID, ID)
+    for i in range(MESSAGES):
+        client.publish('message %d' % i, topic=TOPIC, qos=1)
+    connected.wait()
+    done.wait()
+    client.disconnect()
+
+
+def _run(mode, address, sessions, devices, reconnects, conn):
+    logging.disable(logging.CRITICAL)
+    CONFIG_CLIENT['broker']['uri'] = 'mqtt://bench:bench@' + address
+    rss, threads, socks = _status()
+
+    connected = threading.Barrier(sessions + 1)
+    done = threading.Event()
+    workers = [threading.Thread(target=_session, args=(mode, 'dev-%d' % (i % devices), connected, done))
+               for i in range(sessions)]
+    for w in workers:
+        w.start()
+    connected.wait()
+    rss_open, threads_open, socks_open = _status()
+    done.set()
+    for w in workers:
+        w.join()
+
+    connects = sessions
+    for _ in range(reconnects):
+        for d in range(devices):
+            client = _client(mode)
+            client.connect('dev-%d' % d, 'dev-%d' % d)
+            client.publish('reconnected', topic=TOPIC, qos=1)
+            client.disconnect()
+            connects += 1
+    if mode == 'pool':
+        connects = mqtt_client.broker_pool().connects
+    conn.send((rss_open - rss, threads_open - threads - sessions, socks_open - socks, connects))
+
+
+def run(mode, address, sessions, devices, reconnects):
+    conn, child_conn = multiprocessing.Pipe()
+    p = multiprocessing.Process(target=_run, args=(mode, address, sessions, devices, reconnects, child_conn))
+    p.start()
+    rss, threads, socks, connects = conn.recv()
+    p.join()
+    print('%-7s %d sessions of %d devices: %4d sockets, %d other threads, %7.0f kB while open, '
+          '%4d broker connects with %d reconnects each' % (
+              mode, sessions, devices, socks, threads, rss, connects, reconnects))
+
+
+def main(sessions=200, devices=20, reconnects=5):
+    logging.disable(logging.CRITICAL)
+    address = _free_address()
+    broker = multiprocessing.Process(target=_serve, args=(address,), daemon=True)
+    broker.start()
+    time.sleep(1)
+
+    run('handler', address, sessions, devices, reconnects)
+    run('pool', address, sessions, devices, reconnects)
+
+    broker.terminate()
+    broker.join()
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:4]))
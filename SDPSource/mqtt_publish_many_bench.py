@@ -0,0 +1,93 @@
+#!/usr/bin/python3
+"""Publish rate of hbmqtt's MQTTClient, one message at a time and in batches.
+
+A local hbmqtt broker runs in its own process. N messages are published at
+QoS 0, 1 and 2, awaiting each publish() before the next one, with all
+publish() calls running at once, and with publish_many() in batches of B.
+A run ends when the last message is acknowledged. The broker shares the CPU
+with the client, so the client's own CPU time per message is shown too.
+
+Usage: mqtt_publish_many_bench.py [message_count] [batch_size]
+"""
+
+import sys
+import time
+import socket
+import asyncio
+import logging
+import multiprocessing
+from hbmqtt.broker import Broker
+from hbmqtt.client import MQTTClient
+from hbmqtt.mqtt.constants import QOS_0, QOS_1, QOS_2
+
+TOPIC = 'devices/bench'
+PAYLOAD = b'x' * 64
+
+
+def _free_address():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    address = '127.0.0.1:%d' % s.getsockname()[1]
+    s.close()
+    return address
+
+
+def _serve(address):
+    logging.disable(logging.CRITICAL)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    broker = Broker({
+        'listeners': {'default': {'type': 'tcp', 'bind': address}},
+        'sys_interval': 0,
+        'auth': {'allow-anonymous': True}}, loop)
+    loop.run_until_complete(broker.start())
+    loop.run_forever()
+
+
+async def _one_by_one(client, count, qos):
+    for _ in range(count):
+        await client.publish(TOPIC, PAYLOAD, qos=qos)
+
+
+async def _concurrent(client, count, qos):
+    await asyncio.gather(*[client.publish(TOPIC, PAYLOAD, qos=qos) for _ in range(count)])
+
+
+async def _batched(client, count, qos, batch):
+    for i in range(0, count, batch):
+        await client.publish_many([(TOPIC, PAYLOAD)] * min(batch, count - i), qos=qos)
+
+
+async def _run(uri, count, batch):
+    client = MQTTClient(config={'keep_alive': 60})
+    await client.connect(uri)
+    for qos in (QOS_0, QOS_1, QOS_2):
+        results = []
+        for publish in (_one_by_one(client, count, qos), _concurrent(client, count, qos),
+                        _batched(client, count, qos, batch)):
+            start, cpu = time.perf_counter(), time.process_time()
+            await publish
+            results += [count / (time.perf_counter() - start), (time.process_time() - cpu) / count * 1e6]
+        print('QoS %d: one by one %6.0f msg/s %4.0f us/msg, all at once %6.0f msg/s %4.0f us/msg, '
+              'batches of %d %6.0f msg/s %4.0f us/msg' % ((qos,) + tuple(results[:4]) + (batch,) + tuple(results[4:])))
+    await client.disconnect()
+
+
+def main(count=5000, batch=100):
+    logging.disable(logging.CRITICAL)
+    address = _free_address()
+    broker = multiprocessing.Process(target=_serve, args=(address,), daemon=True)
+    broker.start()
+    time.sleep(1)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(_run('mqtt://' + address, count, batch))
+    loop.close()
+
+    broker.terminate()
+    broker.join()
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:3]))
@@ -0,0 +1,244 @@
+"""Device sessions multiplexed on one controller connection.
+
+A proxy opens the channel with a mux_packet of session 0 and the controller
+answers with one, a controller that doesn't know the channel answers the hello
+like a failed auth packet and the proxy connects per device instead. Every
+other mux_packet carries a packet of one device session, the first packet of
+an unknown session number opens it on the controller side.
+"""
+
+import random
+import asyncio
+from params import params
+from protocol import mux_packet
+from secure_socket import async_connect, DisconnectException
+from log import get_logger
+
+MUX_HELLO = 'mux'
+HELLO_TIMEOUT = 10
+
+# reconnects wait backoff(attempt) seconds, attempts are given up after
+# CONNECT_ATTEMPTS and start over on the next device session
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 30
+CONNECT_ATTEMPTS = 5
+
+
+def backoff(attempt, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+    """Delay before retry number attempt: exponential, capped, with full jitter
+    so that proxies losing the controller together don't retry together."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def is_hello(pack):
+    return isinstance(pack, mux_packet) and pack.session == 0 and pack.pack == MUX_HELLO
+
+
+class mux_session:
+    """One device session on a channel, used like an async_secure_stream."""
+
+    _CLOSED = object()
+
+    def __init__(self, channel, session):
+        self._channel = channel
+        self.session = session
+        self._queue = asyncio.Queue()
+        self._closed = False
+
+    def getpeername(self):
+        return self._channel.getpeername()
+
+    def getsockname(self):
+        return self._channel.getsockname()
+
+    def set_ack_reader(self):
+        # the channel answers test mode 'ACK's, sessions have none
+        pass
+
+    def feed(self, obj):
+        self._queue.put_nowait(obj)
+
+    def feed_closed(self):
+        self._closed = True
+        self._queue.put_nowait(self._CLOSED)
+
+    async def send_obj(self, obj):
+        if self._closed:
+            raise DisconnectException
+        await self._channel.send(self.session, obj)
+
+    async def recv_obj(self, control=False):
+        obj = await self._queue.get()
+        if obj is self._CLOSED:
+            # later reads fail as well
+            self._queue.put_nowait(obj)
+            raise DisconnectException
+        return obj
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._channel.close_session(self.session)
+
+
+class mux_channel:
+    """Dispatches the packets of a channel stream to its sessions.
+
+    Args:
+        stream (async_secure_stream): Connection after the hello exchange.
+        on_open (callable): on_open(session) is called with a new mux_session
+            when the peer opens one, None rejects them.
+    """
+
+    def __init__(self, stream, on_open=None):
+        self._logger = get_logger()
+        self._stream = stream
+        self._on_open = on_open
+        self._sessions = {}
+        self._send_lock = asyncio.Lock()
+        self.closed = False
+        stream.set_ack_reader()
+
+    def getpeername(self):
+        return self._stream.getpeername()
+
+    def getsockname(self):
+        return self._stream.getsockname()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def open_session(self, session):
+        s = mux_session(self, session)
+        self._sessions[session] = s
+        return s
+
+    async def send(self, session, obj, closed=False):
+        if self.closed:
+            raise DisconnectException
+        # a stream can't drain for two writers at once
+        async with self._send_lock:
+            await self._stream.send_obj(mux_packet(session, obj, closed))
+
+    def close_session(self, session):
+        if self._sessions.pop(session, None) and not self.closed:
+            asyncio.ensure_future(self._send_closed(session))
+
+    async def _send_closed(self, session):
+        try:
+            await self.send(session, None, closed=True)
+        except DisconnectException:
+            pass
+
+    async def run(self):
+        """Read the channel until it's closed, then close every session."""
+        try:
+            while True:
+                pack = await self._stream.recv_obj()
+                if not isinstance(pack, mux_packet) or pack.session == 0:
+                    # 'ACK's of test mode
+                    continue
+                s = self._sessions.get(pack.session)
+                if pack.closed:
+                    if s:
+                        del self._sessions[pack.session]
+                        s.feed_closed()
+                elif s:
+                    s.feed(pack.pack)
+                elif self._on_open:
+                    s = self.open_session(pack.session)
+                    s.feed(pack.pack)
+                    self._on_open(s)
+                else:
+                    self._logger.warning("Packet of unknown session %d." % pack.session)
+        except DisconnectException:
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        self.closed = True
+        sessions, self._sessions = self._sessions, {}
+        for s in sessions.values():
+            s.feed_closed()
+        self._stream.close()
+
+
+async def accept_channel(stream, on_open):
+    """Serve a channel whose hello was just received, controller side."""
+    await stream.send_obj(mux_packet(0, MUX_HELLO))
+    channel = mux_channel(stream, on_open)
+    await channel.run()
+
+
+class controller_channel:
+    """Persistent channel of a proxy to the controller.
+
+    The channel is connected on demand and again after it broke, with
+    exponential backoff and jitter between failed attempts. Sessions of
+    concurrent devices wait for the same connection attempt.
+    """
+
+    def __init__(self, secure=True):
+        self._logger = get_logger()
+        self._secure = secure
+        self._channel = None
+        self._connecting = None
+        self._next_session = 1
+        # None until the controller answered a hello
+        self.supported = None
+
+    async def open_session(self):
+        """
+        Returns:
+            mux_session: A new device session, None if the controller has no
+                channel support and devices have to connect by themselves.
+
+        Raises:
+            OSError: The controller can't be reached.
+        """
+        channel = self._channel
+        if channel is None or channel.closed:
+            if self.supported is False:
+                return None
+            if self._connecting is None:
+                self._connecting = asyncio.ensure_future(self._connect())
+            channel = await asyncio.shield(self._connecting)
+            if channel is None:
+                return None
+        session = self._next_session
+        self._next_session += 1
+        return channel.open_session(session)
+
+    async def _connect(self):
+        try:
+            for attempt in range(CONNECT_ATTEMPTS):
+                if attempt:
+                    delay = backoff(attempt)
+                    self._logger.warning("Retry controller channel after %.1f seconds." % delay)
+                    await asyncio.sleep(delay)
+                address = params.update_controller_addr()
+                try:
+                    stream = await async_connect(address, secure=self._secure)
+                except OSError as e:
+                    self._logger.warning("Network error.(%s)" % str(e))
+                    continue
+                try:
+                    await stream.send_obj(mux_packet(0, MUX_HELLO))
+                    reply = await asyncio.wait_for(stream.recv_obj(), HELLO_TIMEOUT)
+                except (DisconnectException, asyncio.TimeoutError):
+                    stream.close()
+                    continue
+                if not is_hello(reply):
+                    self._logger.warning("Controller on %s has no channel support." % address)
+                    self.supported = False
+                    stream.close()
+                    return None
+                self._logger.info("Controller channel to %s is up." % address)
+                self.supported = True
+                self._channel = mux_channel(stream)
+                asyncio.ensure_future(self._channel.run())
+                return self._channel
+            raise ConnectionError("Can't open a channel to the controller.")
+        finally:
+            self._connecting = None
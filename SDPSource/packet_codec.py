@@ -0,0 +1,330 @@
+import struct
+from protocol import list_update_packet, data_packet, key_update_packet, mqtt_info_packet, mux_packet
+from authentication import auth_packet, reply_packet
+
+
+class PacketCodecError(Exception):
+    pass
+
+
+_U8 = struct.Struct('!B')
+_U32 = struct.Struct('!I')
+_I64 = struct.Struct('!q')
+_F64 = struct.Struct('!d')
+
+# type ID: (class, encode, decode)
+_CODECS = {}
+# class: type ID
+_TYPE_IDS = {}
+
+
+def register_codec(type_id, cls, encode, decode):
+    """Register the codec of a packet class.
+
+    Args:
+        type_id (int): One byte ID written in front of the packet body.
+        cls (type): Packet class, matched exactly.
+        encode (callable): encode(obj, parts) appends bytes of obj to the list parts.
+        decode (callable): decode(view, offset) returns (obj, new offset).
+    """
+    if type_id in _CODECS:
+        raise ValueError("Type ID %d is already registered." % type_id)
+    _CODECS[type_id] = (cls, encode, decode)
+    _TYPE_IDS[cls] = type_id
+
+
+def find_packet_class(module, name):
+    """Returns the registered packet class of that module and name, None if there is none."""
+    for cls in _TYPE_IDS:
+        if cls.__module__ == module and cls.__qualname__ == name:
+            return cls
+    return None
+
+
+def _encode_str(s, parts):
+    data = s.encode('utf-8')
+    parts.append(_U32.pack(len(data)))
+    parts.append(data)
+
+
+def _decode_str(view, offset):
+    length, = _U32.unpack_from(view, offset)
+    offset += 4
+    return str(view[offset:offset + length], 'utf-8'), offset + length
+
+
+# Values are tagged with one byte, only plain data types are supported so that
+# decoding never constructs arbitrary objects.
+_TAG_NONE, _TAG_TRUE, _TAG_FALSE, _TAG_STR, _TAG_BYTES, _TAG_INT, _TAG_FLOAT, \
+    _TAG_LIST, _TAG_TUPLE, _TAG_DICT = b'NTFsbidltm'
+
+
+def encode_value(v, parts):
+    if v is None:
+        parts.append(b'N')
+    elif v is True:
+        parts.append(b'T')
+    elif v is False:
+        parts.append(b'F')
+    elif isinstance(v, str):
+        parts.append(b's')
+        _encode_str(v, parts)
+    elif isinstance(v, (bytes, bytearray, memoryview)):
+        parts.append(b'b')
+        parts.append(_U32.pack(len(v)))
+        parts.append(bytes(v))
+    elif isinstance(v, int):
+        parts.append(b'i')
+        try:
+            parts.append(_I64.pack(v))
+        except struct.error:
+            raise PacketCodecError("Integer out of range.")
+    elif isinstance(v, float):
+        parts.append(b'd')
+        parts.append(_F64.pack(v))
+    elif isinstance(v, (list, tuple)):
+        parts.append(b'l' if isinstance(v, list) else b't')
+        parts.append(_U32.pack(len(v)))
+        for item in v:
+            encode_value(item, parts)
+    elif isinstance(v, dict):
+        parts.append(b'm')
+        parts.append(_U32.pack(len(v)))
+        for k, item in v.items():
+            encode_value(k, parts)
+            encode_value(item, parts)
+    else:
+        raise PacketCodecError("Can't encode value of type %s." % type(v).__name__)
+
+
+def decode_value(view, offset):
+    tag = view[offset]
+    offset += 1
+    if tag == _TAG_STR:
+        return _decode_str(view, offset)
+    if tag == _TAG_NONE:
+        return None, offset
+    if tag == _TAG_TRUE:
+        return True, offset
+    if tag == _TAG_FALSE:
+        return False, offset
+    if tag == _TAG_BYTES:
+        length, = _U32.unpack_from(view, offset)
+        offset += 4
+        return view[offset:offset + length].tobytes(), offset + length
+    if tag == _TAG_INT:
+        return _I64.unpack_from(view, offset)[0], offset + 8
+    if tag == _TAG_FLOAT:
+        return _F64.unpack_from(view, offset)[0], offset + 8
+    if tag == _TAG_LIST or tag == _TAG_TUPLE:
+        count, = _U32.unpack_from(view, offset)
+        offset += 4
+        items = []
+        for _ in range(count):
+            item, offset = decode_value(view, offset)
+            items.append(item)
+        return (items if tag == _TAG_LIST else tuple(items)), offset
+    if tag == _TAG_DICT:
+        count, = _U32.unpack_from(view, offset)
+        offset += 4
+        d = {}
+        for _ in range(count):
+            k, offset = decode_value(view, offset)
+            d[k], offset = decode_value(view, offset)
+        return d, offset
+    raise PacketCodecError("Unknown value tag %d." % tag)
+
+
+def _encode_hosts(hosts, parts):
+    # {'add'|'remove'|'refresh': {ID: address}}. IDs and addresses are strings,
+    # each change set is one NUL separated blob so that joining and splitting
+    # happen in C rather than per host. A device that went offline meanwhile
+    # has no address, sent as an empty string.
+    if hosts is None:
+        parts.append(_U8.pack(0xff))
+        return
+    parts.append(_U8.pack(len(hosts)))
+    for op, d in hosts.items():
+        _encode_str(op, parts)
+        fields = []
+        for ID, addr in d.items():
+            fields.append(ID)
+            fields.append('' if addr is None else addr)
+        try:
+            blob = '\0'.join(fields)
+        except TypeError:
+            raise PacketCodecError("Host ID and address must be strings.")
+        if blob.count('\0') != len(fields) - 1 and fields:
+            raise PacketCodecError("Host ID and address can't contain NUL.")
+        parts.append(_U32.pack(len(d)))
+        _encode_str(blob, parts)
+
+
+def _decode_hosts(view, offset):
+    count = view[offset]
+    offset += 1
+    if count == 0xff:
+        return None, offset
+    hosts = {}
+    for _ in range(count):
+        op, offset = _decode_str(view, offset)
+        n, = _U32.unpack_from(view, offset)
+        blob, offset = _decode_str(view, offset + 4)
+        if n:
+            fields = blob.split('\0')
+            if len(fields) != 2 * n:
+                raise PacketCodecError("Broken host list.")
+            it = iter(fields)
+            d = hosts[op] = dict(zip(it, it))
+            if '\0\0' in blob or blob.endswith('\0'):
+                for ID, addr in d.items():
+                    if not addr:
+                        d[ID] = None
+        else:
+            hosts[op] = {}
+    return hosts, offset
+
+
+def _encode_list_update(pack, parts):
+    # The controller sends the same dict as accept and available hosts.
+    if pack.available_hosts is pack.accept_hosts:
+        parts.append(b'\x01')
+        _encode_hosts(pack.accept_hosts, parts)
+    else:
+        parts.append(b'\x00')
+        _encode_hosts(pack.accept_hosts, parts)
+        _encode_hosts(pack.available_hosts, parts)
+    encode_value(getattr(pack, 'version', None), parts)
+
+
+def _decode_list_update(view, offset):
+    same = view[offset]
+    accept_hosts, offset = _decode_hosts(view, offset + 1)
+    if same:
+        available_hosts = accept_hosts
+    else:
+        available_hosts, offset = _decode_hosts(view, offset)
+    version, offset = decode_value(view, offset)
+    return list_update_packet(accept_hosts, available_hosts, version), offset
+
+
+def _encode_data(pack, parts):
+    encode_value(pack.data, parts)
+
+
+def _decode_data(view, offset):
+    data, offset = decode_value(view, offset)
+    return data_packet(data), offset
+
+
+def _encode_key_update(pack, parts):
+    encode_value(pack.old_key, parts)
+    encode_value(pack.new_key, parts)
+
+
+def _decode_key_update(view, offset):
+    old, offset = decode_value(view, offset)
+    new, offset = decode_value(view, offset)
+    return key_update_packet(old, new), offset
+
+
+def _encode_mqtt_info(pack, parts):
+    encode_value(pack.deviceID, parts)
+    encode_value(pack.username, parts)
+    encode_value(pack.password, parts)
+
+
+def _decode_mqtt_info(view, offset):
+    deviceID, offset = decode_value(view, offset)
+    username, offset = decode_value(view, offset)
+    password, offset = decode_value(view, offset)
+    return mqtt_info_packet(deviceID, username, password), offset
+
+
+def _encode_auth(pack, parts):
+    encode_value(pack.deviceID, parts)
+    encode_value(pack.userID, parts)
+    encode_value(pack.key, parts)
+    encode_value(getattr(pack, 'sync_version', None), parts)
+
+
+def _decode_auth(view, offset):
+    deviceID, offset = decode_value(view, offset)
+    userID, offset = decode_value(view, offset)
+    key, offset = decode_value(view, offset)
+    sync_version, offset = decode_value(view, offset)
+    return auth_packet(deviceID, userID, key, sync_version), offset
+
+
+def _encode_reply(pack, parts):
+    encode_value(pack.passed, parts)
+    encode_value(pack.new_key, parts)
+    encode_value(getattr(pack, 'retry_after', None), parts)
+
+
+def _decode_reply(view, offset):
+    passed, offset = decode_value(view, offset)
+    new_key, offset = decode_value(view, offset)
+    retry_after, offset = decode_value(view, offset)
+    return reply_packet(passed, new_key, retry_after), offset
+
+
+def _encode_mux(pack, parts):
+    encode_value(pack.session, parts)
+    encode_value(pack.closed, parts)
+    # the session packet is encoded as a nested packet
+    encode_value(encode(pack.pack), parts)
+
+
+def _decode_mux(view, offset):
+    session, offset = decode_value(view, offset)
+    closed, offset = decode_value(view, offset)
+    data, offset = decode_value(view, offset)
+    return mux_packet(session, decode(data), closed), offset
+
+
+# Type ID 0 carries plain values such as heartbeats (None) and 'ACK'.
+VALUE_TYPE_ID = 0
+
+register_codec(1, list_update_packet, _encode_list_update, _decode_list_update)
+register_codec(2, data_packet, _encode_data, _decode_data)
+register_codec(3, key_update_packet, _encode_key_update, _decode_key_update)
+register_codec(4, mqtt_info_packet, _encode_mqtt_info, _decode_mqtt_info)
+register_codec(5, auth_packet, _encode_auth, _decode_auth)
+register_codec(6, reply_packet, _encode_reply, _decode_reply)
+register_codec(7, mux_packet, _encode_mux, _decode_mux)
+
+
+def encode(obj):
+    """Encode a packet or a plain value.
+
+    Raises:
+        PacketCodecError: obj has no registered codec or holds unsupported values.
+    """
+    type_id = _TYPE_IDS.get(type(obj))
+    if type_id is None:
+        parts = [_U8.pack(VALUE_TYPE_ID)]
+        encode_value(obj, parts)
+    else:
+        parts = [_U8.pack(type_id)]
+        _CODECS[type_id][1](obj, parts)
+    return b''.join(parts)
+
+
+def decode(data):
+    view = memoryview(data)
+    try:
+        type_id = view[0]
+        if type_id == VALUE_TYPE_ID:
+            obj, offset = decode_value(view, 1)
+        elif type_id in _CODECS:
+            obj, offset = _CODECS[type_id][2](view, 1)
+        else:
+            raise PacketCodecError("Unknown packet type ID %d." % type_id)
+    except (struct.error, IndexError, UnicodeDecodeError) as e:
+        raise PacketCodecError("Broken packet (%s)." % str(e))
+    finally:
+        view.release()
+    if offset != len(data):
+        raise PacketCodecError("Trailing bytes after packet.")
+    return obj
@@ -0,0 +1,50 @@
+#!/usr/bin/python3
+"""Encode/decode time and wire size of pickle against packet_codec.
+
+Usage: packet_codec_bench.py [host_count]
+"""
+
+import sys
+import pickle
+import timeit
+import packet_codec
+from protocol import list_update_packet, data_packet
+from authentication import auth_packet, reply_packet
+
+
+def sample_packets(host_count):
+    hosts = {}
+    for i in range(host_count):
+        hosts['device-%05d' % i] = '10.%d.%d.%d:%d' % (i >> 16, (i >> 8) & 0xff, i & 0xff, 40000 + i % 20000)
+    accept_hosts = {'add': hosts}
+    return [
+        ('list init (%d hosts)' % host_count, list_update_packet(accept_hosts, accept_hosts)),
+        ('list update (1 host)', list_update_packet({'add': {'device-1': '10.0.0.1:4444'}},
+                                                    {'add': {'device-1': '10.0.0.1:4444'}})),
+        ('data', data_packet('Data from device-00001')),
+        ('auth', auth_packet('device-00001', None, 'a8Fk2pQz')),
+        ('reply', reply_packet(True, new_key='b9Gl3qRa')),
+        ('heartbeat', None),
+    ]
+
+
+def measure(func, arg):
+    timer = timeit.Timer(lambda: func(arg))
+    number, _ = timer.autorange()
+    return min(timer.repeat(3, number)) / number
+
+
+def main(host_count=1000):
+    print('%-24s %8s %8s %12s %12s %12s %12s' % (
+        'packet', 'pickle B', 'codec B', 'pickle enc', 'codec enc', 'pickle dec', 'codec dec'))
+    for name, pack in sample_packets(host_count):
+        pickled = pickle.dumps(pack)
+        encoded = packet_codec.encode(pack)
+        print('%-24s %8d %8d %10.2fus %10.2fus %10.2fus %10.2fus' % (
+            name, len(pickled), len(encoded),
+            measure(pickle.dumps, pack) * 1e6, measure(packet_codec.encode, pack) * 1e6,
+            measure(pickle.loads, pickled) * 1e6, measure(packet_codec.decode, encoded) * 1e6))
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:2]))
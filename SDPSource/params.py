@@ -84,6 +84,172 @@ class params_class:
 
             self.test_group_num = 1
 
+            # negotiate the struct framed wire mode with peers supporting it
+            framing = os.getenv('M_SDP_FRAMING')
+            if framing is None:
+                self.wire_framing = True
+            else:
+                self.wire_framing = framing == 'True'
+
+            # payload codec offered on framed connections: 'compact' or 'pickle'
+            self.wire_codec = os.getenv('M_SDP_CODEC')
+            if self.wire_codec is None:
+                self.wire_codec = 'compact'
+
+            # never unpickle anything from a peer: send compact frames from the
+            # first message on and refuse legacy messages and pickled frames
+            strict = os.getenv('M_SDP_WIRE_STRICT')
+            if strict is None:
+                self.wire_strict = False
+            else:
+                self.wire_strict = strict == 'True'
+
+            # legacy messages and pickled frames may only name packet classes
+            # and plain builtin types: 'restricted', or 'full' for peers that
+            # pickle anything else
+            self.wire_pickle = os.getenv('M_SDP_WIRE_PICKLE')
+            if self.wire_pickle is None:
+                self.wire_pickle = 'restricted'
+
+            # serve devices from one asyncio event loop instead of a thread each
+            is_async = os.getenv('M_SDP_CONTROLLER_ASYNC')
+            if is_async is None:
+                self.controller_async = False
+            else:
+                self.controller_async = is_async == 'True'
+
+            # serve many devices from one asyncio event loop, the single device
+            # proxy narrows the listening rule to the connected device instead
+            is_async = os.getenv('M_SDP_PROXY_ASYNC')
+            if is_async is None:
+                self.proxy_async = False
+            else:
+                self.proxy_async = is_async == 'True'
+
+            # the multi-device proxy carries all device sessions on one controller
+            # connection, it connects per device if the controller can't
+            channel = os.getenv('M_SDP_CONTROLLER_CHANNEL')
+            if channel is None:
+                self.controller_channel = True
+            else:
+                self.controller_channel = channel == 'True'
+
+            # device sessions the controller sets up at once, 0 for no limit, and
+            # how many more may wait for a slot before devices are turned away
+            concurrency = os.getenv('M_SDP_AUTH_CONCURRENCY')
+            if concurrency is None:
+                self.auth_concurrency = 32
+            else:
+                self.auth_concurrency = int(concurrency)
+            queue_size = os.getenv('M_SDP_AUTH_QUEUE')
+            if queue_size is None:
+                self.auth_queue_size = 256
+            else:
+                self.auth_queue_size = int(queue_size)
+
+            # publish device data through mqtt_client.mqtt_bridge, with this many
+            # publishes in flight and this many accepted but unacknowledged
+            bridge = os.getenv('M_SDP_MQTT_BRIDGE')
+            if bridge is None:
+                self.mqtt_bridge = False
+            else:
+                self.mqtt_bridge = bridge == 'True'
+            inflight = os.getenv('M_SDP_MQTT_INFLIGHT')
+            if inflight is None:
+                self.mqtt_inflight = 64
+            else:
+                self.mqtt_inflight = int(inflight)
+            queue_size = os.getenv('M_SDP_MQTT_QUEUE')
+            if queue_size is None:
+                self.mqtt_queue_size = 1024
+            else:
+                self.mqtt_queue_size = int(queue_size)
+
+            # encoding of device data other than bytes and text, 'json' or 'compact'
+            self.mqtt_payload_format = os.getenv('M_SDP_MQTT_PAYLOAD')
+            if self.mqtt_payload_format is None:
+                self.mqtt_payload_format = 'json'
+
+            # share broker connections between the monitor's device handlers,
+            # one per credentials, closed after this many idle seconds
+            pool = os.getenv('M_SDP_MQTT_POOL')
+            if pool is None:
+                self.mqtt_pool = False
+            else:
+                self.mqtt_pool = pool == 'True'
+            idle = os.getenv('M_SDP_MQTT_IDLE')
+            if idle is None:
+                self.mqtt_idle_timeout = 60
+            else:
+                self.mqtt_idle_timeout = float(idle)
+
+            # data packets queued for each peer of the device monitor, what to do
+            # when a peer's queue is full: 'oldest' drops the oldest queued packet,
+            # 'newest' the new one, 'block' waits up to the block timeout for room
+            # and then drops the new one, stalling the device handler meanwhile;
+            # a peer that takes longer than the send timeout seconds for one
+            # packet is disconnected
+            queue_size = os.getenv('M_SDP_PEER_QUEUE')
+            if queue_size is None:
+                self.peer_queue_size = 256
+            else:
+                self.peer_queue_size = int(queue_size)
+            self.peer_drop_policy = os.getenv('M_SDP_PEER_DROP')
+            if self.peer_drop_policy is None:
+                self.peer_drop_policy = 'oldest'
+            timeout = os.getenv('M_SDP_PEER_SEND_TIMEOUT')
+            if timeout is None:
+                self.peer_send_timeout = 10
+            else:
+                self.peer_send_timeout = float(timeout)
+            timeout = os.getenv('M_SDP_PEER_BLOCK_TIMEOUT')
+            if timeout is None:
+                self.peer_block_timeout = 0.05
+            else:
+                self.peer_block_timeout = float(timeout)
+
+            # used device keys the controller still accepts next to the newest one
+            history = os.getenv('M_SDP_KEY_HISTORY')
+            if history is None:
+                self.key_history = 1
+            else:
+                self.key_history = int(history)
+
+            # seconds the controller waits for more access changes before sending
+            # one merged list update to a device, 0 sends every change at once
+            window = os.getenv('M_SDP_COALESCE_WINDOW')
+            if window is None:
+                self.update_coalesce_window = 0.1
+            else:
+                self.update_coalesce_window = float(window)
+
+            # seconds a proxy keeps the firewall state of a disconnected device,
+            # a reconnect within it only receives the changes since then
+            grace = os.getenv('M_SDP_SYNC_GRACE')
+            if grace is None:
+                self.proxy_sync_grace = 60
+            else:
+                self.proxy_sync_grace = float(grace)
+
+            # how the proxy installs host rules: 'iptables' or 'ipset'
+            self.firewall_backend = os.getenv('M_SDP_FIREWALL_BACKEND')
+            if self.firewall_backend is None:
+                self.firewall_backend = 'iptables'
+
+            # seconds between checks of the host rules against the kernel, 0 disables
+            interval = os.getenv('M_SDP_FIREWALL_DRIFT_INTERVAL')
+            if interval is None:
+                self.firewall_drift_interval = 60
+            else:
+                self.firewall_drift_interval = float(interval)
+
+            # apply firewall changes on a worker thread instead of the relay loop
+            is_async = os.getenv('M_SDP_FIREWALL_ASYNC')
+            if is_async is None:
+                self.firewall_async = True
+            else:
+                self.firewall_async = is_async == 'True'
+
     def update_controller_addr(self):
         self.controller_address = get_addr('M_SDP_CONTROLLER_ADDRESS', 'sdp-controller', self.controller_port)
         return self.controller_address
@@ -0,0 +1,110 @@
+"""Payloads of device data published to the broker.
+
+MQTT 3.1.1 has no content type and the broker only lets a device publish on
+devices/<username>, so the type goes into the first byte of the payload:
+
+    0x01 bytes, passed through as they are
+    0x02 UTF-8 text
+    0x03 UTF-8 JSON
+    0x04 the tagged binary value format of packet_codec
+
+Bytes and text are always sent as such, other values as JSON or in the
+compact binary format, whichever the encoder is set to.
+"""
+
+import json
+import struct
+from params import params
+from packet_codec import encode_value, decode_value, PacketCodecError
+
+CONTENT_BYTES = 0x01
+CONTENT_TEXT = 0x02
+CONTENT_JSON = 0x03
+CONTENT_COMPACT = 0x04
+
+_MARK_BYTES = bytes([CONTENT_BYTES])
+_MARK_TEXT = bytes([CONTENT_TEXT])
+_MARK_JSON = bytes([CONTENT_JSON])
+_MARK_COMPACT = bytes([CONTENT_COMPACT])
+
+_JSON_ENCODER = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False, allow_nan=False)
+
+
+class PayloadCodecError(ValueError):
+    pass
+
+
+def _encode_json(value):
+    try:
+        return _MARK_JSON + _JSON_ENCODER.encode(value).encode('utf-8')
+    except (TypeError, ValueError) as e:
+        raise PayloadCodecError("Can't encode payload as JSON.(%s)" % str(e))
+
+
+def _encode_compact(value):
+    parts = [_MARK_COMPACT]
+    try:
+        encode_value(value, parts)
+    except PacketCodecError as e:
+        raise PayloadCodecError(str(e))
+    return b''.join(parts)
+
+
+_STRUCTURED = {'json': _encode_json, 'compact': _encode_compact}
+
+
+def encode_payload(value, fmt=None):
+    """
+    Args:
+        value: Device data, bytes, str or plain data built of dicts, lists,
+            numbers, strings, booleans and None.
+        fmt (str): 'json' or 'compact' for values other than bytes and str,
+            params.mqtt_payload_format by default.
+
+    Returns:
+        bytes: Payload starting with its content type.
+
+    Raises:
+        PayloadCodecError: value can't be encoded.
+    """
+    if isinstance(value, bytes):
+        return _MARK_BYTES + value
+    if isinstance(value, str):
+        return _MARK_TEXT + value.encode('utf-8')
+    if isinstance(value, (bytearray, memoryview)):
+        return _MARK_BYTES + bytes(value)
+    try:
+        encode = _STRUCTURED[fmt or params.mqtt_payload_format]
+    except KeyError:
+        raise PayloadCodecError("Unknown payload format %s." % (fmt or params.mqtt_payload_format))
+    return encode(value)
+
+
+def decode_payload(payload):
+    """Decode a payload of encode_payload(), for subscribers.
+
+    Returns:
+        tuple: (content type, value)
+
+    Raises:
+        PayloadCodecError: Unknown content type or broken payload.
+    """
+    if not payload:
+        raise PayloadCodecError("Empty payload.")
+    content_type = payload[0]
+    view = memoryview(payload)
+    try:
+        if content_type == CONTENT_BYTES:
+            return content_type, view[1:].tobytes()
+        if content_type == CONTENT_TEXT:
+            return content_type, str(view[1:], 'utf-8')
+        if content_type == CONTENT_JSON:
+            return content_type, json.loads(str(view[1:], 'utf-8'))
+        if content_type == CONTENT_COMPACT:
+            value, offset = decode_value(view, 1)
+            if offset != len(view):
+                raise PayloadCodecError("Trailing bytes after the payload value.")
+            return content_type, value
+    except (UnicodeDecodeError, ValueError, IndexError, struct.error, PacketCodecError) as e:
+        raise PayloadCodecError("Broken payload of content type %d.(%s)" % (content_type, str(e)))
+    raise PayloadCodecError("Unknown content type %d." % content_type)
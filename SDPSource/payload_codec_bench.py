@@ -0,0 +1,49 @@
+#!/usr/bin/python3
+"""Encode/decode time and size of device data payloads, JSON against the
+compact binary format. The pickle round trip that mqtt_client.publish used
+to cost on every non-text payload is shown for comparison.
+
+Usage: payload_codec_bench.py
+"""
+
+import pickle
+import timeit
+from payload_codec import encode_payload, decode_payload
+
+
+def sample_payloads():
+    reading = {'device': 'device-00001', 'ts': 1760774400.125, 'temperature': 21.5,
+               'humidity': 43, 'battery': 3.71, 'ok': True}
+    return [
+        ('text', 'Data from device-00001'),
+        ('raw 64 B', bytes(range(64))),
+        ('raw 4 kB', bytes(4096)),
+        ('reading', reading),
+        ('reading x 10', [dict(reading, ts=reading['ts'] + i) for i in range(10)]),
+        ('samples (256 floats)', {'device': 'device-00001', 'rate': 100, 'samples': [i / 7 for i in range(256)]}),
+    ]
+
+
+def measure(func, *args):
+    timer = timeit.Timer(lambda: func(*args))
+    number, _ = timer.autorange()
+    return min(timer.repeat(3, number)) / number
+
+
+def main():
+    print('%-22s %8s %8s %8s %11s %11s %11s %11s %11s' % (
+        'payload', 'json B', 'compact B', 'pickle B', 'json enc', 'compact enc',
+        'json dec', 'compact dec', 'unpickle'))
+    for name, value in sample_payloads():
+        as_json = encode_payload(value, 'json')
+        as_compact = encode_payload(value, 'compact')
+        pickled = pickle.dumps(value)
+        print('%-22s %8d %9d %8d %9.2fus %9.2fus %9.2fus %9.2fus %9.2fus' % (
+            name, len(as_json), len(as_compact), len(pickled),
+            measure(encode_payload, value, 'json') * 1e6, measure(encode_payload, value, 'compact') * 1e6,
+            measure(decode_payload, as_json) * 1e6, measure(decode_payload, as_compact) * 1e6,
+            measure(pickle.loads, pickled) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+import socket
+import threading
+import collections
+from threading import Thread
+from secure_socket import secure_socket, shared_obj, DisconnectException
+from packet_codec import PacketCodecError
+from params import params
+from log import get_logger
+
+CONNECT_ATTEMPTS = 5
+CONNECT_RETRY_INTERVAL = 5
+CONNECT_TIMEOUT = 5
+
+DROP_OLDEST = 'oldest'
+DROP_NEWEST = 'newest'
+BLOCK = 'block'
+
+
+class peer_sender:
+    """Outbound queue of one peer, drained by its own writer thread.
+
+    The writer connects to the peer and sends whatever is queued, so a slow or
+    dead peer only fills its own queue. A full queue is handled by the drop
+    policy, a peer that takes longer than send_timeout for one packet is
+    disconnected. BLOCK waits in put() on the device handler's thread, so the
+    wait is bounded by block_timeout rather than send_timeout.
+    """
+
+    def __init__(self, ID, address, queue_size=None, policy=None, send_timeout=None,
+                 block_timeout=None, secure=True):
+        """
+        Args:
+            ID (str): Peer ID.
+            address (tuple): (ip, port) of the peer.
+            queue_size (int): Packets queued at most, params.peer_queue_size by default.
+            policy (str): DROP_OLDEST, DROP_NEWEST or BLOCK, params.peer_drop_policy by default.
+            send_timeout (float): Seconds, params.peer_send_timeout by default.
+            block_timeout (float): Seconds BLOCK waits for room, params.peer_block_timeout by default.
+            secure (bool): Connect with TLS.
+        """
+        self._logger = get_logger()
+        self.ID = ID
+        self._address = address
+        self._size = params.peer_queue_size if queue_size is None else queue_size
+        self._policy = params.peer_drop_policy if policy is None else policy
+        if self._policy not in (DROP_OLDEST, DROP_NEWEST, BLOCK):
+            raise ValueError("Unknown peer drop policy %s." % self._policy)
+        self._send_timeout = params.peer_send_timeout if send_timeout is None else send_timeout
+        self._block_timeout = params.peer_block_timeout if block_timeout is None else block_timeout
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._sock = secure_socket(secure=secure)
+        self.sent = 0
+        self.dropped = 0
+        Thread(target=self._run, daemon=True).start()
+
+    def put(self, obj):
+        """Queue obj for the peer, returns False if it was dropped."""
+        with self._cond:
+            if self._closed:
+                self.dropped += 1
+                return False
+            if len(self._queue) >= self._size:
+                if self._policy == DROP_OLDEST:
+                    self._queue.popleft()
+                    self.dropped += 1
+                elif self._policy == DROP_NEWEST or not self._cond.wait_for(
+                        lambda: self._closed or len(self._queue) < self._size, self._block_timeout) \
+                        or self._closed:
+                    self.dropped += 1
+                    return False
+            self._queue.append(obj)
+            self._cond.notify_all()
+        return True
+
+    def _connect(self):
+        for _ in range(CONNECT_ATTEMPTS):
+            try:
+                self._sock.connect(self._address, timeout=CONNECT_TIMEOUT)
+            except (socket.timeout, TimeoutError):
+                with self._cond:
+                    if self._cond.wait_for(lambda: self._closed, CONNECT_RETRY_INTERVAL):
+                        return False
+            except:
+                return False
+            else:
+                self._logger.info("Connected to peer %s on %s:%d." % ((self.ID,) + self._address))
+                return True
+
+        self._logger.warning("Fail to connect to peer %s on %s:%d." % ((self.ID,) + self._address))
+        return False
+
+    def _run(self):
+        try:
+            if not self._connect():
+                return
+            while True:
+                with self._cond:
+                    self._cond.wait_for(lambda: self._closed or self._queue)
+                    if self._closed:
+                        return
+                    obj = self._queue.popleft()
+                    self._cond.notify_all()
+                self._sock.set_deadline(self._send_timeout)
+                try:
+                    self._sock.send_obj(obj)
+                except PacketCodecError as e:
+                    self._logger.warning("Drop a packet for peer %s.(%s)" % (self.ID, str(e)))
+                    with self._cond:
+                        self.dropped += 1
+                    continue
+                self.sent += 1
+        except (TimeoutError, DisconnectException):
+            if not self._closed:
+                self._logger.warning("Disconnect from peer %s, %d packets sent and %d dropped." % (
+                    self.ID, self.sent, self.dropped))
+        finally:
+            self.close()
+
+    def close(self):
+        with self._cond:
+            self.dropped += len(self._queue)
+            self._queue.clear()
+            self._closed = True
+            self._cond.notify_all()
+        self._sock.close()
+
+
+class peer_fanout:
+    """Peers of a device handler, each data packet is encoded once per wire
+    mode and queued for every peer."""
+
+    def __init__(self, secure=True, **options):
+        self._lock = threading.Lock()
+        self._peers = {}
+        self._secure = secure
+        self._options = options
+
+    def add(self, ID, address):
+        peer = peer_sender(ID, address, secure=self._secure, **self._options)
+        with self._lock:
+            old = self._peers.get(ID)
+            self._peers[ID] = peer
+        if old:
+            old.close()
+
+    def remove(self, ID):
+        with self._lock:
+            peer = self._peers.pop(ID, None)
+        if peer:
+            peer.close()
+
+    def clear(self):
+        with self._lock:
+            peers = list(self._peers.values())
+            self._peers.clear()
+        for peer in peers:
+            peer.close()
+
+    def send(self, obj):
+        """Queue obj for every peer, returns how many peers dropped it."""
+        with self._lock:
+            peers = list(self._peers.values())
+        if not peers:
+            return 0
+        shared = shared_obj(obj)
+        return sum(not peer.put(shared) for peer in peers)
@@ -0,0 +1,159 @@
+#!/usr/bin/python3
+"""Fan-out latency of device data to the device monitor's peers, sent one
+peer after the other as device_handler did against the per-peer queues of
+peer_fanout.
+
+A device sends a data packet every millisecond for a few seconds to P peers
+that read everything at once, with and without one more peer that accepts
+the connection and never reads. Latency is taken from the time a packet was
+due to the time a fast peer got it, packets the device never got to send
+are missing from the delivered count. The time the device spends in one
+fan-out is shown as well, it reads nothing from the device meanwhile.
+
+Usage: peer_fanout_bench.py [peer_count] [seconds] [payload_bytes]
+"""
+
+import os
+os.environ.setdefault('M_SDP_LOG_LEVEL', 'ERROR')
+
+import sys
+import time
+import socket
+import threading
+import multiprocessing
+from protocol import data_packet
+from secure_socket import secure_socket
+from peer_fanout import peer_fanout
+
+INTERVAL = 0.001
+
+
+def _listener():
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    return listener
+
+
+def _fast_peer(listener, latencies):
+    conn, _ = listener.accept()
+    sock = secure_socket(sock=conn, secure=False)
+    try:
+        while True:
+            obj = sock.recv_obj()
+            if isinstance(obj, data_packet):
+                latencies.append(time.monotonic() - obj.data[0])
+    except:
+        pass
+    finally:
+        sock.close()
+
+
+def _peers(peer_count, stalled, seconds, conn):
+    """Peers on other hosts, the stalled one is closed when the device is done."""
+    listeners = [_listener() for _ in range(peer_count)]
+    latencies = [[] for _ in range(peer_count)]
+    for listener, l in zip(listeners, latencies):
+        threading.Thread(target=_fast_peer, args=(listener, l), daemon=True).start()
+    slow = _listener() if stalled else None
+    conn.send([l.getsockname() for l in listeners] + ([slow.getsockname()] if slow else []))
+
+    if slow:
+        slow_conn, _ = slow.accept()
+    conn.recv()
+    time.sleep(seconds)
+    if slow:
+        # lets a serial fan-out stuck on the stalled peer go on
+        slow_conn.close()
+    sent = conn.recv()
+    deadline = time.monotonic() + 10
+    while any(len(l) < sent for l in latencies) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    conn.send([x for l in latencies for x in l])
+
+
+class serial_fanout:
+    """The loop of device_handler before peer_fanout."""
+
+    def __init__(self, addresses):
+        self._lock = threading.Lock()
+        self._socks = []
+        for address in addresses:
+            sock = secure_socket(secure=False)
+            sock.connect(address, timeout=5)
+            self._socks.append(sock)
+
+    def send(self, obj):
+        with self._lock:
+            for sock in self._socks:
+                try:
+                    sock.send_obj(obj)
+                except:
+                    pass
+
+    def close(self):
+        for sock in self._socks:
+            sock.close()
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))] if values else float('nan')
+
+
+def run(mode, peer_count, stalled, seconds, payload):
+    conn, child_conn = multiprocessing.Pipe()
+    peers = multiprocessing.Process(target=_peers, args=(peer_count, stalled, seconds, child_conn))
+    peers.start()
+    addresses = conn.recv()
+    if mode == 'serial':
+        fanout = serial_fanout(addresses)
+    else:
+        fanout = peer_fanout(secure=False)
+        for i, address in enumerate(addresses):
+            fanout.add('peer-%d' % i, address)
+    time.sleep(0.2)
+
+    scheduled = int(seconds / INTERVAL)
+    conn.send('start')
+    start = time.monotonic()
+    end = start + seconds
+    calls = []
+    sent = 0
+    for i in range(scheduled):
+        due = start + i * INTERVAL
+        now = time.monotonic()
+        if now >= end:
+            break
+        if due > now:
+            time.sleep(due - now)
+        t = time.perf_counter()
+        fanout.send(data_packet((due, payload)))
+        calls.append(time.perf_counter() - t)
+        sent += 1
+
+    conn.send(sent)
+    latencies = conn.recv()
+    peers.join()
+    if mode == 'serial':
+        fanout.close()
+    else:
+        fanout.clear()
+
+    print('%-6s %-12s sent %5d/%5d, delivered %6d/%6d, latency p50 %7.2f ms p99 %7.2f ms, '
+          'fan-out call p99 %7.3f ms max %7.1f ms' % (
+              mode, 'stalled peer' if stalled else 'all fast', sent, scheduled,
+              len(latencies), scheduled * peer_count,
+              _percentile(latencies, 50) * 1e3, _percentile(latencies, 99) * 1e3,
+              _percentile(calls, 99) * 1e3, max(calls) * 1e3))
+
+
+def main(peer_count=8, seconds=3, size=16384):
+    payload = bytes(size)
+    for stalled in (False, True):
+        for mode in ('serial', 'queued'):
+            run(mode, peer_count, stalled, seconds, payload)
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:4]))
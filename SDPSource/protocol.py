@@ -1,14 +1,16 @@
 class list_update_packet:
-    def __init__(self, accept_hosts=None, available_hosts=None):
+    def __init__(self, accept_hosts=None, available_hosts=None, version=None):
         """
         
         Args:
             accept_hosts (dict): May have three keys: 'add' 'remove' 'refresh', value should be a dict of {ID: address}.
             available_hosts (dict): Same as above.
+            version (tuple): Version of the access set after this update, see access_policy.
         """
 
         self.accept_hosts = accept_hosts
         self.available_hosts = available_hosts
+        self.version = version
 
     def __str__(self):
         s = '\n=====LIST UPDATE PACKET=====\n'
@@ -64,3 +66,17 @@ class mqtt_info_packet:
         s += '===========================\n'
 
         return s
+
+class mux_packet:
+    def __init__(self, session, pack=None, closed=False):
+        """
+
+        Args:
+            session (int): Number of a device session on a multiplexed
+                controller channel, chosen by the proxy. 0 is the channel itself.
+            pack: Packet of the session.
+            closed (bool): The sender ended the session.
+        """
+        self.session = session
+        self.pack = pack
+        self.closed = closed
@@ -1,13 +1,18 @@
 #!/usr/bin/python3
 
 import sys
+import ssl
 import time
+import queue
+import asyncio
+import collections
 import threading
 import traceback
 import socket
 from params import params
-from secure_socket import secure_socket, DisconnectException
+from secure_socket import secure_socket, async_secure_stream, get_ssl_context, DisconnectException
 from protocol import list_update_packet
+from mux_channel import is_hello, accept_channel
 from socketserver import ThreadingTCPServer, StreamRequestHandler
 from authentication import auth_packet, reply_packet, server_end
 from access_policy import access_table
@@ -17,25 +22,259 @@ LOGGER = get_logger()
 
 HEART_BEAT_INTERVAL = 10
 AUTH_TIMEOUT = 30
+# connections waiting to be accepted, a reconnect storm waits here and in the
+# admission queue instead of being reset by the kernel
+LISTEN_BACKLOG = 1024
+# a burst of changes never delays a list update longer than this
+COALESCE_MAX_DELAY = 1
+# bounds of the retry-after hint of a device rejected by admission control
+RETRY_AFTER_MIN = 1
+RETRY_AFTER_MAX = 60
+STATS_REPORT_INTERVAL = 10
 
 class UnknowndeviceException(Exception):pass
 
-class request_handler(StreamRequestHandler):
-    def extract_info(self, excep, members_set):
-        info = {}
-        for m in members_set:
-            if m != excep:
-                info[m.get_id()] = m.get_address()
 
-        return info
+class AdmissionRejected(Exception):pass
+
+
+def extract_info(excep, members_set):
+    info = {}
+    for m in members_set:
+        if m != excep:
+            info[m.get_id()] = m.get_address()
+
+    return info
+
+
+def delta_hosts(m, gained, lost=()):
+    """Build the accept hosts update of member m from an access set change."""
+    to_add = extract_info(m, gained)
+    to_remove = extract_info(m, lost)
+
+    accept_hosts = {}
+    if to_add:
+        accept_hosts['add'] = to_add
+    if to_remove:
+        accept_hosts['remove'] = to_remove
+
+    return accept_hosts
+
+
+def init_hosts(m, gained, lost, resumed):
+    """Build the list init update of member m.
+
+    Args:
+        gained, lost: As returned by member.watch_access_hosts().
+        resumed (bool): Whether the proxy presented a version to resume from.
+    """
+    if lost is not None:
+        return delta_hosts(m, gained, lost)
+    if resumed:
+        # the change log doesn't reach back to the proxy's version
+        return {'refresh': extract_info(m, gained)}
+    return delta_hosts(m, gained)
+
+
+class update_batch:
+    """Access set changes of one device merged into a single list update."""
+
+    def __init__(self, change):
+        self.gained, self.lost = set(change[0]), set(change[1])
+        self.version = change[2]
+        self.changes = 1
+
+    def merge(self, change):
+        """Merge a (gained, lost, version) change.
+
+        Returns:
+            bool: False if a member lost in this batch is gained again, the
+                device must see the removal before the new address.
+        """
+        gained, lost, version = change
+        if not self.lost.isdisjoint(gained):
+            return False
+        for m in lost:
+            if m in self.gained:
+                # gained and lost again within the batch
+                self.gained.discard(m)
+            else:
+                self.lost.add(m)
+        self.gained |= gained
+        self.version = version
+        self.changes += 1
+        return True
+
+
+class coalesce_counter:
+    """Counts access set changes and the list updates they were merged into."""
+
+    def __init__(self):
+        self._l = threading.Lock()
+        self.changes = 0
+        self.updates = 0
+
+    def add(self, batch):
+        with self._l:
+            self.changes += batch.changes
+            self.updates += 1
+
+    @property
+    def coalesced(self):
+        with self._l:
+            return self.changes - self.updates
+
+
+COALESCED = coalesce_counter()
+
+
+class auth_admission:
+    """Caps the device sessions being set up at once.
+
+    A session holds a slot from its auth packet until its list init packet
+    is sent. Sessions beyond the limit wait in a bounded queue, the rest are
+    rejected at once with a retry-after hint derived from the queue depth and
+    the average setup time. Threaded handlers block in enter(), coroutines
+    await enter_async(), a process only runs one kind.
+    """
+
+    def __init__(self, limit, queue_size, report_interval=STATS_REPORT_INTERVAL):
+        self._cond = threading.Condition()
+        self.limit = limit
+        self.queue_size = queue_size
+        self._report_interval = report_interval
+        self._last_report = time.time()
+        # futures of waiting coroutines, first come first served
+        self._waiters = collections.deque()
+        # moving average of seconds a slot is held
+        self._hold_time = 0.1
+        self.active = 0
+        self.waiting = 0
+        self.max_waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+
+    def _admit(self):
+        # caller holds self._cond
+        if self.limit <= 0 or self.active < self.limit:
+            self.active += 1
+            self.admitted += 1
+            return True
+        if self.waiting >= self.queue_size:
+            self.rejected += 1
+            return False
+        return None
+
+    def _wait(self):
+        self.waiting += 1
+        self.max_waiting = max(self.max_waiting, self.waiting)
+
+    def enter(self, timeout):
+        """
+        Returns:
+            bool: Whether a slot was taken, False if the queue is full or the
+                wait took longer than timeout.
+        """
+        with self._cond:
+            r = self._admit()
+            if r is not None:
+                return r
+            self._wait()
+            deadline = time.time() + timeout
+            try:
+                while self.active >= self.limit:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.rejected += 1
+                        return False
+                    self._cond.wait(remaining)
+            finally:
+                self.waiting -= 1
+            self.active += 1
+            self.admitted += 1
+            return True
+
+    async def enter_async(self, timeout):
+        with self._cond:
+            r = self._admit()
+            if r is not None:
+                return r
+            self._wait()
+        waiter = asyncio.get_event_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            # the slot is handed over by leave()
+            await asyncio.wait_for(asyncio.shield(waiter), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done():
+                # handed over just now
+                self._release()
+            else:
+                self._waiters.remove(waiter)
+                waiter.cancel()
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            with self._cond:
+                self.rejected += 1
+            return False
+        finally:
+            with self._cond:
+                self.waiting -= 1
+        with self._cond:
+            self.admitted += 1
+        return True
+
+    def _release(self):
+        with self._cond:
+            while self._waiters:
+                waiter = self._waiters.popleft()
+                if not waiter.done():
+                    waiter.set_result(None)
+                    return
+            self.active -= 1
+            self._cond.notify()
+
+    def leave(self, held):
+        """Free a slot that was held for held seconds."""
+        with self._cond:
+            self._hold_time += (held - self._hold_time) * 0.1
+        self._release()
+
+    def retry_after(self):
+        """Seconds a rejected device should wait, about the time to drain the queue."""
+        with self._cond:
+            limit = max(self.limit, 1)
+            drain = (self.waiting + self.active) / limit * self._hold_time
+        return min(max(RETRY_AFTER_MIN, drain), RETRY_AFTER_MAX)
+
+    def report(self, logger):
+        now = time.time()
+        with self._cond:
+            if now - self._last_report < self._report_interval:
+                return
+            self._last_report = now
+            stats = (self.active, self.waiting, self.max_waiting, self.admitted, self.rejected)
+            self.max_waiting = self.waiting
+        logger.critical('[auth]active=%d waiting=%d max_waiting=%d admitted=%d rejected=%d' % stats)
+
+
+ADMISSION = auth_admission(params.auth_concurrency, params.auth_queue_size)
+
+
+class controller_server(ThreadingTCPServer):
+    request_queue_size = LISTEN_BACKLOG
+
 
+class request_handler(StreamRequestHandler):
     def handle(self):
         try:
             ID = None
             m = None
+            changes = None
+            admitted = None
 
-            # this is already a sslsocket
-            sock = secure_socket(sock=self.request)
+            # this is already a sslsocket unless the server runs without TLS
+            sock = secure_socket(sock=self.request, secure=isinstance(self.request, ssl.SSLSocket))
             # get client addr
             ip, port = sock.getpeername()
             addr = ip + ':' + str(port)
@@ -45,9 +284,21 @@ class request_handler(StreamRequestHandler):
 
             LOGGER.info("Request from %s." % addr)
 
+            # the auth packet is read before a rejection so that closing the
+            # connection doesn't reset it while the reply is on its way
+            sock.set_deadline(AUTH_TIMEOUT)
+            try:
+                first = sock.recv_obj()
+            finally:
+                sock.set_deadline(None)
+
+            if not ADMISSION.enter(AUTH_TIMEOUT):
+                raise AdmissionRejected
+            admitted = time.time()
+
             # authentication
             auth_obj = server_end(sock, timeout=AUTH_TIMEOUT)
-            passed, ID = auth_obj.authenticate()
+            passed, ID = auth_obj.authenticate(first)
 
             if not passed:
                 LOGGER.warning("Auth failed!")
@@ -63,69 +314,297 @@ class request_handler(StreamRequestHandler):
                 return
 
             # athorization done, update list
-            access_members, sig = m.get_access_hosts()
+            changes = queue.Queue()
+            since = auth_obj.sync_version
+            version, gained, lost = m.watch_access_hosts(changes.put, since=since)
 
-            accept_hosts = {}
-            to_add = self.extract_info(m, access_members)
-            if to_add:
-                accept_hosts['add'] = to_add
-
-                
-            pack = list_update_packet(accept_hosts, accept_hosts)
+            accept_hosts = init_hosts(m, gained, lost, since is not None)
+            pack = list_update_packet(accept_hosts, accept_hosts, version)
             
             LOGGER.info("List init packet to %s:\n%s" % (ID, str(pack)))
             
             sock.send_obj(pack)
 
+            ADMISSION.leave(time.time() - admitted)
+            admitted = None
+
+            pending = None
             while True:
-                new_members = sig.get(HEART_BEAT_INTERVAL)
-                if new_members is None:
-                    # send test packet to manually test connection
-                    LOGGER.info("Heartbeat packet to %s." % ID)
-                    sock.send_obj(None)
-                elif new_members == 'deleted':
-                    break
+                if pending is not None:
+                    change, pending = pending, None
                 else:
-                    to_add = new_members - access_members
-                    to_remove = access_members - new_members
-                    access_members = new_members
+                    try:
+                        change = changes.get(timeout=HEART_BEAT_INTERVAL)
+                    except queue.Empty:
+                        # send test packet to manually test connection
+                        LOGGER.info("Heartbeat packet to %s." % ID)
+                        sock.send_obj(None)
+                        continue
+
+                if change == 'deleted':
+                    break
 
-                    to_add = self.extract_info(m, to_add)
-                    to_remove = self.extract_info(m, to_remove)
+                batch = update_batch(change)
+                window = params.update_coalesce_window
+                deadline = time.time() + COALESCE_MAX_DELAY
+                while window > 0:
+                    timeout = min(window, deadline - time.time())
+                    if timeout <= 0:
+                        break
+                    try:
+                        change = changes.get(timeout=timeout)
+                    except queue.Empty:
+                        break
+                    if change == 'deleted' or not batch.merge(change):
+                        pending = change
+                        break
+
+                COALESCED.add(batch)
+                accept_hosts = delta_hosts(m, batch.gained, batch.lost)
+                if not accept_hosts:
+                    continue
+
+                pack.accept_hosts = accept_hosts
+                pack.available_hosts = accept_hosts
+                pack.version = batch.version
+
+                LOGGER.info("List update packet to %s from %d changes:\n%s" % (ID, batch.changes, str(pack)))
+
+                sock.send_obj(pack)
+
+        except AdmissionRejected:
+            retry_after = ADMISSION.retry_after()
+            LOGGER.warning("Too many devices authenticating, %s retries after %.1f seconds." % (addr, retry_after))
+            try:
+                sock.send_obj(reply_packet(False, retry_after=retry_after))
+            except DisconnectException:
+                pass
+        except UnknowndeviceException:
+            LOGGER.warning("Unknown device on %s." % addr)
+        except TimeoutError:
+            LOGGER.warning("Auth timeout on %s." % addr)
+        except DisconnectException:
+            if ID is None:
+                ID = 'unknown'
+            LOGGER.info("Member %s connection interrupted." % ID)
+        except BaseException:
+            LOGGER.error("Catch unhandled exception.")
+            traceback.print_exc()
+        finally:
+            if admitted is not None:
+                ADMISSION.leave(time.time() - admitted)
+            ADMISSION.report(LOGGER)
+            if m:
+                if changes:
+                    m.unwatch_access_hosts(changes.put)
+                LOGGER.info("Member %s is offline." % ID)
+                m.offline()
+            try:
+                sock.close()
+            except:
+                pass
 
-                    accept_hosts = {}
-                    if to_add:
-                        accept_hosts['add'] = to_add
-                    if to_remove:
-                        accept_hosts['remove'] = to_remove
 
-                    pack.accept_hosts = accept_hosts
-                    pack.available_hosts = accept_hosts
+class async_request_handler:
+    """request_handler protocol served by one coroutine per device."""
 
-                    LOGGER.info("List update packet to %s:\n%s" % (ID, str(pack)))
+    def __init__(self, loop):
+        self._loop = loop
 
-                    sock.send_obj(pack)
+    async def _read_until_closed(self, sock, changes):
+        # Nothing is expected after authentication, reading just consumes
+        # control frames and notices a closed connection before the next heartbeat.
+        try:
+            while True:
+                await sock.recv_obj()
+        except DisconnectException:
+            changes.put_nowait('disconnected')
+
+    async def handle(self, reader, writer):
+        sock = async_secure_stream(reader, writer)
+        try:
+            first = await asyncio.wait_for(sock.recv_obj(), AUTH_TIMEOUT)
+        except (DisconnectException, asyncio.TimeoutError):
+            sock.close()
+            return
+        if is_hello(first):
+            # a proxy multiplexing its devices, each session is served like a connection
+            LOGGER.info("Channel from %s." % str(sock.getpeername()))
+            await accept_channel(sock, lambda s: asyncio.ensure_future(self.serve(s)))
+        else:
+            await self.serve(sock, first)
+
+    async def serve(self, sock, first=None):
+        ID = None
+        m = None
+        on_change = None
+        reader_task = None
+        admitted = None
+        addr = 'unknown'
+        try:
+            ip, port = sock.getpeername()[:2]
+            addr = ip + ':' + str(port)
+
+            LOGGER.info("Request from %s." % addr)
+
+            if not await ADMISSION.enter_async(AUTH_TIMEOUT):
+                raise AdmissionRejected
+            admitted = self._loop.time()
+
+            # authentication
+            auth_obj = server_end(sock, timeout=AUTH_TIMEOUT)
+            passed, ID = await auth_obj.authenticate_async(first)
+
+            if not passed:
+                LOGGER.warning("Auth failed!")
+                raise UnknowndeviceException
 
+            LOGGER.info("Auth passed %s, %s." % (ID, addr))
+
+            a_table = access_table()
+            m = a_table.get_member(ID)
+            if not m.online(addr):
+                LOGGER.warning("Mimicry attack of device %s on %s." % (ID, addr))
+                m = None
+                return
+
+            changes = asyncio.Queue()
+
+            def on_change(change):
+                self._loop.call_soon_threadsafe(changes.put_nowait, change)
+
+            since = auth_obj.sync_version
+            version, gained, lost = m.watch_access_hosts(on_change, since=since)
+
+            accept_hosts = init_hosts(m, gained, lost, since is not None)
+            pack = list_update_packet(accept_hosts, accept_hosts, version)
+
+            LOGGER.info("List init packet to %s:\n%s" % (ID, str(pack)))
+
+            await sock.send_obj(pack)
+
+            ADMISSION.leave(self._loop.time() - admitted)
+            admitted = None
+
+            sock.set_ack_reader()
+            reader_task = asyncio.ensure_future(self._read_until_closed(sock, changes))
+
+            pending = None
+            while True:
+                if pending is not None:
+                    change, pending = pending, None
+                else:
+                    try:
+                        change = await asyncio.wait_for(changes.get(), HEART_BEAT_INTERVAL)
+                    except asyncio.TimeoutError:
+                        # send test packet to manually test connection
+                        LOGGER.info("Heartbeat packet to %s." % ID)
+                        await sock.send_obj(None)
+                        continue
+
+                if change == 'disconnected':
+                    raise DisconnectException
+                elif change == 'deleted':
+                    break
+
+                batch = update_batch(change)
+                window = params.update_coalesce_window
+                deadline = self._loop.time() + COALESCE_MAX_DELAY
+                while window > 0:
+                    timeout = min(window, deadline - self._loop.time())
+                    if timeout <= 0:
+                        break
+                    try:
+                        change = await asyncio.wait_for(changes.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                    if isinstance(change, str) or not batch.merge(change):
+                        pending = change
+                        break
+
+                COALESCED.add(batch)
+                accept_hosts = delta_hosts(m, batch.gained, batch.lost)
+                if not accept_hosts:
+                    continue
+
+                pack = list_update_packet(accept_hosts, accept_hosts, batch.version)
+
+                LOGGER.info("List update packet to %s from %d changes:\n%s" % (ID, batch.changes, str(pack)))
+
+                await sock.send_obj(pack)
+
+        except AdmissionRejected:
+            retry_after = ADMISSION.retry_after()
+            LOGGER.warning("Too many devices authenticating, %s retries after %.1f seconds." % (addr, retry_after))
+            try:
+                await sock.send_obj(reply_packet(False, retry_after=retry_after))
+            except DisconnectException:
+                pass
         except UnknowndeviceException:
             LOGGER.warning("Unknown device on %s." % addr)
+        except TimeoutError:
+            LOGGER.warning("Auth timeout on %s." % addr)
         except DisconnectException:
             if ID is None:
                 ID = 'unknown'
             LOGGER.info("Member %s connection interrupted." % ID)
+        except asyncio.CancelledError:
+            raise
         except BaseException:
             LOGGER.error("Catch unhandled exception.")
             traceback.print_exc()
         finally:
+            if admitted is not None:
+                ADMISSION.leave(self._loop.time() - admitted)
+            ADMISSION.report(LOGGER)
+            if reader_task:
+                reader_task.cancel()
             if m:
+                if on_change:
+                    m.unwatch_access_hosts(on_change)
                 LOGGER.info("Member %s is offline." % ID)
                 m.offline()
-            try:
-                sock.close()
-            except:
-                pass
+            sock.close()
+
 
+def async_main(address=None, secure=True):
+    try:
+        LOGGER.info("Server up.")
+        if address is None:
+            ip = socket.gethostbyname(socket.gethostname())
+            port = params.controller_port
+
+            address = ip + ':' + str(port)
 
-def main(address=None):
+        LOGGER.info("Server listening address %s." % address)
+
+        ip = address.split(':')[0]
+        port = int(address.split(':')[1])
+
+        loop = asyncio.get_event_loop()
+        handler = async_request_handler(loop)
+        server = loop.run_until_complete(asyncio.start_server(
+            handler.handle, ip, port, ssl=get_ssl_context(server_side=True) if secure else None,
+            backlog=LISTEN_BACKLOG))
+        LOGGER.info("server is running at %s." % address)
+
+        loop.run_forever()
+    except KeyboardInterrupt:
+        LOGGER.info("Receive keyboard interrupt, shut down...")
+    except BaseException:
+        LOGGER.error("Catch unhandled exception.")
+        traceback.print_exc()
+    finally:
+        try:
+            LOGGER.info("Close socket...")
+            server.close()
+            loop.run_until_complete(server.wait_closed())
+        except:
+            pass
+        LOGGER.info("Server down.")
+
+
+def main(address=None, secure=True):
     try:
         LOGGER.info("Server up.")
         if address is None:
@@ -139,8 +618,8 @@ def main(address=None):
         ip = address.split(':')[0]
         port = int(address.split(':')[1])
 
-        server = ThreadingTCPServer((ip, port), request_handler)
-        server.socket = secure_socket(sock=server.socket, server_side=True)
+        server = controller_server((ip, port), request_handler)
+        server.socket = secure_socket(sock=server.socket, secure=secure, server_side=True)
         server.daemon_threads = True
 
         LOGGER.info("Creating work thread...")
@@ -184,5 +663,8 @@ if __name__ == '__main__':
         a_table = access_table()
         for i in range(params.test_group_num):
             a_table.add_group(name=str(i))
-    
-    main(addr)
+
+    if params.controller_async:
+        async_main(addr)
+    else:
+        main(addr)
@@ -0,0 +1,160 @@
+#!/usr/bin/python3
+"""Heartbeat lateness of connected devices while many more reconnect at once.
+
+The controller runs in test mode with a short heartbeat interval, so every
+device coming online changes the access sets of the connected ones in its
+group. An observer process keeps N devices connected and measures how late
+their heartbeats are, counted from the last packet before them. Then M
+devices connect at once, a rejected device waits for the retry-after hint
+and tries again. Runs with admission control off and on, without TLS.
+
+Usage: sdp_controller_admission_bench.py [connected] [reconnecting] [concurrency] [mode]
+"""
+
+import os
+os.environ.setdefault('M_SDP_LOG_LEVEL', 'ERROR')
+
+import sys
+import time
+import random
+import collections
+import socket
+import asyncio
+import multiprocessing
+import sdp_controller
+from params import params
+from access_policy import access_table
+from authentication import auth_packet
+from secure_socket import async_connect, DisconnectException
+
+HEART_BEAT_INTERVAL = 0.5
+GROUPS = 100
+CONCURRENT_CONNECTS = 512
+
+
+def _serve(address, concurrency, mode):
+    params.test_mode = True
+    params.test_group_num = GROUPS
+    sdp_controller.HEART_BEAT_INTERVAL = HEART_BEAT_INTERVAL
+    sdp_controller.ADMISSION.limit = concurrency
+    a_table = access_table()
+    for i in range(GROUPS):
+        a_table.add_group(name=str(i))
+    if mode == 'async':
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        sdp_controller.async_main(address, secure=False)
+    else:
+        sdp_controller.main(address, secure=False)
+
+
+def _free_address():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    address = '127.0.0.1:%d' % s.getsockname()[1]
+    s.close()
+    return address
+
+
+async def _connect(address, ID, sem, failures, lateness, measuring):
+    while True:
+        reply = None
+        async with sem:
+            try:
+                sock = await async_connect(address, secure=False)
+            except OSError:
+                sock = None
+            try:
+                if sock:
+                    await sock.send_obj(auth_packet(ID, None, ID))
+                    reply = await sock.recv_obj()
+                    if reply.passed:
+                        await sock.recv_obj()
+                        # keep reading like a device, test mode sends wait for the 'ACK'
+                        return sock, asyncio.ensure_future(_observe(sock, lateness, measuring))
+            except DisconnectException:
+                pass
+            if sock:
+                sock.close()
+        failures['rejected' if reply else 'dropped'] += 1
+        retry_after = getattr(reply, 'retry_after', None) or 1
+        await asyncio.sleep(retry_after * random.uniform(0.5, 1.5))
+
+
+async def _observe(sock, lateness, measuring):
+    last = time.perf_counter()
+    try:
+        while True:
+            pack = await sock.recv_obj()
+            now = time.perf_counter()
+            if pack is None and measuring[0]:
+                lateness.append(now - last - HEART_BEAT_INTERVAL)
+            last = now
+    except DisconnectException:
+        pass
+
+
+def _observer(address, count, conn):
+    params.test_mode = True
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    sem = asyncio.Semaphore(CONCURRENT_CONNECTS)
+    lateness = []
+    measuring = [False]
+    loop.run_until_complete(asyncio.gather(
+        *[_connect(address, 'connected-%d' % i, sem, collections.Counter(), lateness, measuring) for i in range(count)]))
+    loop.run_until_complete(asyncio.sleep(1))
+    conn.send('ready')
+    measuring[0] = True
+    while not conn.poll():
+        loop.run_until_complete(asyncio.sleep(0.05))
+    conn.send(lateness)
+
+
+def run(mode, connected, reconnecting, concurrency):
+    params.test_mode = True
+    address = _free_address()
+    server = multiprocessing.Process(target=_serve, args=(address, concurrency, mode), daemon=True)
+    server.start()
+    time.sleep(1)
+
+    conn, child_conn = multiprocessing.Pipe()
+    observer = multiprocessing.Process(target=_observer, args=(address, connected, child_conn), daemon=True)
+    observer.start()
+    conn.recv()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    sem = asyncio.Semaphore(CONCURRENT_CONNECTS)
+    failures = collections.Counter()
+    start = time.perf_counter()
+    devices = loop.run_until_complete(asyncio.gather(
+        *[_connect(address, 'storm-%d' % i, sem, failures, [], [False]) for i in range(reconnecting)]))
+    elapsed = time.perf_counter() - start
+    loop.run_until_complete(asyncio.sleep(HEART_BEAT_INTERVAL * 4))
+
+    conn.send('stop')
+    lateness = sorted(conn.recv())
+    for sock, reader in devices:
+        reader.cancel()
+        sock.close()
+    loop.run_until_complete(asyncio.sleep(0.1))
+    loop.close()
+    observer.terminate()
+    server.terminate()
+    observer.join()
+    server.join()
+
+    n = len(lateness)
+    print('%-8s limit %4s: storm of %d done in %5.1f s, rejected %5d, dropped %5d, %d heartbeats late by p50/p99/max: %6.1f/%7.1f/%7.1f ms' % (
+        mode, concurrency or 'off', reconnecting, elapsed, failures['rejected'], failures['dropped'], n,
+        lateness[n // 2] * 1e3, lateness[int(n * 0.99)] * 1e3, lateness[-1] * 1e3))
+
+
+def main(connected=200, reconnecting=2000, concurrency=16, mode='threaded'):
+    run(mode, connected, reconnecting, 0)
+    run(mode, connected, reconnecting, concurrency)
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    main(*[int(a) if a.isdigit() else a for a in args])
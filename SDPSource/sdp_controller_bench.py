@@ -0,0 +1,117 @@
+#!/usr/bin/python3
+"""Load test of the controller with N simulated devices.
+
+Every device connects, authenticates and waits for its list init packet. The
+connection setup rate and the memory and thread count per connection of the
+controller process are reported for the threaded and the asyncio controller.
+Runs in test mode without TLS.
+
+Usage: sdp_controller_bench.py [device_count] [threaded|async|both] [group_count]
+"""
+
+import os
+os.environ.setdefault('M_SDP_LOG_LEVEL', 'ERROR')
+
+import sys
+import time
+import socket
+import asyncio
+import multiprocessing
+import sdp_controller
+from params import params
+from access_policy import access_table
+from authentication import auth_packet
+from secure_socket import async_connect
+
+CONCURRENT_CONNECTS = 64
+
+
+def _serve(address, mode, groups):
+    params.test_mode = True
+    params.test_group_num = groups
+    a_table = access_table()
+    for i in range(groups):
+        a_table.add_group(name=str(i))
+    if mode == 'async':
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        sdp_controller.async_main(address, secure=False)
+    else:
+        sdp_controller.main(address, secure=False)
+
+
+def _proc_status(pid):
+    status = {}
+    with open('/proc/%d/status' % pid) as f:
+        for line in f:
+            k, v = line.split(':', 1)
+            status[k] = v.split()[0] if v.split() else ''
+    return int(status['VmRSS']), int(status['Threads'])
+
+
+def _free_address():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    address = '127.0.0.1:%d' % s.getsockname()[1]
+    s.close()
+    return address
+
+
+async def _device(address, ID, sem):
+    async with sem:
+        for _ in range(50):
+            try:
+                sock = await async_connect(address, secure=False)
+                break
+            except OSError:
+                await asyncio.sleep(0.1)
+        await sock.send_obj(auth_packet(ID, None, ID))
+        reply = await sock.recv_obj()
+        if not reply.passed:
+            raise RuntimeError("Device %s failed to authenticate." % ID)
+        await sock.recv_obj()
+    return sock
+
+
+async def _connect_all(address, count):
+    sem = asyncio.Semaphore(CONCURRENT_CONNECTS)
+    return await asyncio.gather(*[_device(address, 'bench-%d' % i, sem) for i in range(count)])
+
+
+def run(mode, count, groups):
+    params.test_mode = True
+    address = _free_address()
+    server = multiprocessing.Process(target=_serve, args=(address, mode, groups), daemon=True)
+    server.start()
+    time.sleep(1)
+    rss_before, threads_before = _proc_status(server.pid)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    start = time.perf_counter()
+    socks = loop.run_until_complete(_connect_all(address, count))
+    elapsed = time.perf_counter() - start
+    time.sleep(1)
+    rss_after, threads_after = _proc_status(server.pid)
+
+    for sock in socks:
+        sock.close()
+    loop.run_until_complete(asyncio.sleep(0.1))
+    loop.close()
+    server.terminate()
+    server.join()
+
+    print('%-8s devices: %d, setup: %7.0f conn/s, memory: %6.1f kB/conn, threads: %d -> %d' % (
+        mode, count, count / elapsed, (rss_after - rss_before) / count, threads_before, threads_after))
+
+
+def main(count=1000, mode='both', groups=None):
+    if groups is None:
+        groups = count
+    modes = ['threaded', 'async'] if mode == 'both' else [mode]
+    for m in modes:
+        run(m, count, groups)
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    main(*[int(a) if a.isdigit() else a for a in args])
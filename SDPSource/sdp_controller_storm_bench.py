@@ -0,0 +1,85 @@
+#!/usr/bin/python3
+"""Reconnect storm against the controller with and without update coalescing.
+
+N devices of one group connect at once, as after a controller restart. Every
+device reads list updates until it knows all other devices. The number of
+list update packets the fleet received and the time until the last device
+converged are reported for each coalescing window.
+
+Usage: sdp_controller_storm_bench.py [device_count] [threaded|async] [window ...]
+"""
+
+import os
+os.environ.setdefault('M_SDP_LOG_LEVEL', 'ERROR')
+
+import sys
+import time
+import asyncio
+import multiprocessing
+from params import params
+from authentication import auth_packet
+from secure_socket import async_connect
+from sdp_controller_bench import _serve, _free_address, CONCURRENT_CONNECTS
+
+
+async def _device(address, ID, count, sem, received):
+    async with sem:
+        for _ in range(50):
+            try:
+                sock = await async_connect(address, secure=False)
+                break
+            except OSError:
+                await asyncio.sleep(0.1)
+        await sock.send_obj(auth_packet(ID, None, ID))
+        reply = await sock.recv_obj()
+        if not reply.passed:
+            raise RuntimeError("Device %s failed to authenticate." % ID)
+        pack = await sock.recv_obj()
+
+    known = set(pack.accept_hosts.get('add', {}))
+    while len(known) < count - 1:
+        pack = await sock.recv_obj()
+        if pack is None:
+            continue
+        received[0] += 1
+        known |= set(pack.accept_hosts.get('add', {}))
+        known -= set(pack.accept_hosts.get('remove', {}))
+    return sock
+
+
+def run(mode, count, window):
+    params.test_mode = True
+    params.update_coalesce_window = window
+    address = _free_address()
+    server = multiprocessing.Process(target=_serve, args=(address, mode, 1), daemon=True)
+    server.start()
+    time.sleep(1)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    sem = asyncio.Semaphore(CONCURRENT_CONNECTS)
+    received = [0]
+    start = time.perf_counter()
+    socks = loop.run_until_complete(asyncio.gather(
+        *[_device(address, 'storm-%d' % i, count, sem, received) for i in range(count)]))
+    elapsed = time.perf_counter() - start
+
+    for sock in socks:
+        sock.close()
+    loop.run_until_complete(asyncio.sleep(0.1))
+    loop.close()
+    server.terminate()
+    server.join()
+
+    print('%-8s devices: %d, window: %5.3f s, updates: %7d (%6.1f/device), converged: %6.2f s' % (
+        mode, count, window, received[0], received[0] / count, elapsed))
+
+
+def main(count=300, mode='async', *windows):
+    for window in windows or (0, params.update_coalesce_window):
+        run(mode, count, float(window))
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    main(*[int(a) if a.isdigit() else a for a in args])
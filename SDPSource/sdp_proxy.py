@@ -3,8 +3,10 @@
 import os
 import sys
 import time
+import asyncio
 import traceback
 import threading
+import collections
 import socketserver
 import socket
 import select
@@ -12,9 +14,11 @@ from params import params
 from socket import timeout as SOCKET_TIMEOUT
 from protocol import *
 from iptables_api import *
-from authentication import client_end
-from secure_socket import secure_socket, DisconnectException, valid_ip
+from authentication import client_end, auth_packet, reply_packet
+from secure_socket import secure_socket, DisconnectException, valid_ip, CONTROL_FRAME, \
+    async_secure_stream, async_connect, get_ssl_context
 from access_policy import monitored_dict
+from mux_channel import controller_channel, backoff
 from log import get_logger
 import device_simulator
 import signal
@@ -45,6 +49,136 @@ def check_addr(addr):
     return False
 
 
+# firewall changes are applied off the relay loop
+FIREWALL = firewall_worker(threaded=params.firewall_async)
+
+
+class sync_state:
+    """Firewall state of the last device, kept for a grace period after it
+    disconnected so that a reconnect resumes from the last access set version.
+
+    A shared state is one of many on the same firewall. It never refreshes or
+    flushes the whole firewall, it only adds and removes its own hosts, and
+    the refcounting backends keep a host that another state still needs.
+    """
+
+    def __init__(self, firewall=FIREWALL, shared=False):
+        self._l = threading.Lock()
+        self._firewall = firewall
+        self._shared = shared
+        self.accept_hosts = monitored_dict()
+        self.deviceID = None
+        # version of the last list update the firewall has applied
+        self.version = None
+        self._timer = None
+        # bumped on reset, completions of older updates are ignored
+        self._generation = 0
+        # a firewall update failed, the state is unknown until a refresh
+        self._stale = False
+
+    def apply(self, pack):
+        """Update the host table from a list update and queue its firewall changes."""
+        accept_hosts = pack.accept_hosts
+        version = getattr(pack, 'version', None)
+        generation = self._generation
+        if self._shared and 'refresh' in accept_hosts:
+            old = collections.Counter(self.accept_hosts.values())
+
+        # removals go first, a host may be removed and added with a new address
+        to_remove = accept_hosts.get('remove', {})
+        to_add = accept_hosts.get('add', {})
+        addrs = list(
+            self.accept_hosts[k] for k in to_remove.keys() if k in self.accept_hosts)
+        if to_remove:
+            self.accept_hosts.remove(to_remove)
+        if to_add:
+            self.accept_hosts.update(to_add)
+
+        if 'refresh' in accept_hosts and self._shared:
+            # diff against this state's own hosts, addresses in both cancel out
+            to_refresh = accept_hosts['refresh']
+            new = collections.Counter(to_refresh.values())
+            self.accept_hosts.refresh(to_refresh)
+            self._firewall.update(to_add=list((new - old).elements()),
+                                  to_remove=list((old - new).elements()),
+                                  callback=lambda error: self._applied(generation, version, error, True))
+        elif 'refresh' in accept_hosts:
+            if addrs or to_add:
+                self._firewall.update(to_add=list(to_add.values()), to_remove=addrs)
+            to_refresh = accept_hosts['refresh']
+            self.accept_hosts.refresh(to_refresh)
+            self._firewall.refresh(list(to_refresh.values()),
+                                   callback=lambda error: self._applied(generation, version, error, True))
+        else:
+            # queued even if empty so the version follows the applied changes
+            self._firewall.update(to_add=list(to_add.values()), to_remove=addrs,
+                                  callback=lambda error: self._applied(generation, version, error, False))
+
+    def _applied(self, generation, version, error, full):
+        with self._l:
+            if generation != self._generation:
+                return
+            if error:
+                get_logger().warning("Firewall update failed, the proxy won't resume from it.")
+                self._stale = True
+            elif full:
+                self._stale = False
+            self.version = None if self._stale else version
+
+    def resume(self):
+        """Stop the grace period.
+
+        Returns:
+            tuple: (deviceID, version) of the kept state, None if there is none.
+        """
+        with self._l:
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+            if self.version is None:
+                return None
+            return self.deviceID, self.version
+
+    def suspend(self, grace):
+        """Keep the state for grace seconds, then flush the firewall."""
+        with self._l:
+            if self.version is None or grace <= 0:
+                self._reset()
+                return
+            self._timer = threading.Timer(grace, self._expire)
+            self._timer.setDaemon(True)
+            self._timer.start()
+
+    def _expire(self):
+        with self._l:
+            # resumed or suspended again meanwhile
+            if self._timer is not threading.current_thread():
+                return
+            self._timer = None
+            get_logger().info("Sync grace period is over.")
+            self._reset()
+
+    def reset(self):
+        with self._l:
+            self._reset()
+
+    def _reset(self):
+        if self._shared:
+            if self.accept_hosts:
+                self._firewall.update(to_remove=list(self.accept_hosts.values()))
+        else:
+            get_logger().info("Flush hosts in firewall.")
+            self._firewall.flush()
+        dict.clear(self.accept_hosts)
+        self.deviceID = None
+        self.version = None
+        self._generation += 1
+        self._stale = False
+
+
+SYNC = sync_state()
+
+
 class request_handler(socketserver.StreamRequestHandler):
     def __init__(self, *args, **kwargs):
         self._logger = get_logger()
@@ -58,11 +192,10 @@ class request_handler(socketserver.StreamRequestHandler):
 
         self.proxy_address = params.proxy_address_inside
 
-        self._accept_hosts = monitored_dict()
+        self._accept_hosts = SYNC.accept_hosts
         self._availiable_hosts = monitored_dict()
 
         self._retry_times = 5
-        self._retry_interval = 5
 
         socketserver.StreamRequestHandler.__init__(self, *args, **kwargs)
 
@@ -96,23 +229,7 @@ class request_handler(socketserver.StreamRequestHandler):
         self._logger.info("Updating firewall policy...\n" + str(pack))
 
         try:
-            accept_hosts = pack.accept_hosts
-
-            if 'add' in accept_hosts:
-                to_add = accept_hosts['add']
-                add_hosts(list(to_add.values()))
-                self._accept_hosts.update(to_add)
-            if 'remove' in accept_hosts:
-                to_remove = accept_hosts['remove']
-                addrs = list(
-                    self._accept_hosts[k] for k in to_remove.keys() if k in self._accept_hosts)
-                remove_hosts(addrs)
-                self._accept_hosts.remove(to_remove)
-            if 'refresh' in accept_hosts:
-                to_refresh = accept_hosts['refresh']
-                flush_hosts()
-                add_hosts(list(to_refresh.values()))
-                self._accept_hosts.refresh(to_refresh)
+            SYNC.apply(pack)
 
             """available_hosts = pack.available_hosts
 
@@ -145,9 +262,10 @@ class request_handler(socketserver.StreamRequestHandler):
                 self._logger.info(
                     "Connected to controller timeout, retrying...")
             except BaseException as e:
+                delay = backoff(i)
                 self._logger.warning(
-                    "Network error, retry after %d seconds.(%s)" % (self._retry_interval, str(e)))
-                time.sleep(self._retry_interval)
+                    "Network error, retry after %.1f seconds.(%s)" % (delay, str(e)))
+                time.sleep(delay)
             else:
                 self._logger.info("Connected to controller succeed.")
                 self._accept_hosts['controller'] = self.controller_address
@@ -174,17 +292,25 @@ class request_handler(socketserver.StreamRequestHandler):
 
             add_device(device_addr, self_addr)
 
+            sync = SYNC.resume()
+
             sock_controller = self.connect_to_controller()
 
             if sock_controller is None:
                 raise ControllerFault
 
-            auth_obj = client_end(sock_controller, device_sock=sock_device)
+            auth_obj = client_end(sock_controller, device_sock=sock_device, sync=sync)
             if not auth_obj.auth_to_server():
                 raise UnknowndeviceException
 
             self._logger.info("Auth to controller passed.")
 
+            resuming = sync is not None and sync[0] == auth_obj.deviceID
+            if not resuming:
+                SYNC.reset()
+                self._accept_hosts['controller'] = self.controller_address
+            SYNC.deviceID = auth_obj.deviceID
+
             proxy_ip = self.proxy_address.split(':')[0]
             proxy_port = int(self.proxy_address.split(':')[1])
 
@@ -198,20 +324,28 @@ class request_handler(socketserver.StreamRequestHandler):
             self._logger.info(
                 "Connected to local service for device on %s." % self.proxy_address)
 
+            relay_socks = [sock_controller, sock_device, proxy_socket]
             while True:
-                ready_for_read, _, _ = select.select(
-                    [sock_controller, sock_device, proxy_socket], [], [], 5)
+                ready_for_read = [s for s in relay_socks if s.pending_data()]
+                if not ready_for_read:
+                    ready_for_read, _, _ = select.select(relay_socks, [], [], 5)
                 # print(sock_controller)
                 # print(sock_device)
                 # print(proxy_socket)
                 for sock in ready_for_read:
                     # self._logger.info("Data coming in on %s." % str(sock))
-                    pack = sock.recv_obj()
+                    pack = sock.recv_obj(control=True)
+                    if pack is CONTROL_FRAME:
+                        continue
                     if sock is sock_controller:
                         if pack is None:
                             self._logger.info("Receive heartbeat packet.")
                         elif isinstance(pack, list_update_packet):
                             self._logger.info("Receive list update packet.")
+                            if resuming and getattr(pack, 'version', None) is None:
+                                # the controller can't resume, this is a full list
+                                SYNC.reset()
+                            resuming = False
                             self.update_lists(pack)
                             proxy_socket.send_obj(pack)
                         else:
@@ -230,6 +364,8 @@ class request_handler(socketserver.StreamRequestHandler):
                 "No controller detected on %s." % self.controller_address)
         except UnknowndeviceException:
             self._logger.warning("Unknown device on %s." % device_addr)
+        except TimeoutError:
+            self._logger.warning("Auth timeout on %s." % device_addr)
         except LocalServiceFault:
             self._logger.warning("No service detected on %s." %
                                  self.proxy_address)
@@ -247,13 +383,256 @@ class request_handler(socketserver.StreamRequestHandler):
             proxy_socket.close()
 
             remove_device(self_addr)
-            self._logger.info("Flush hosts in firewall.")
-            flush_hosts()
+            SYNC.suspend(params.proxy_sync_grace)
 
             self._logger.info("Device offline.")
             time.sleep(10)
 
 
+class async_proxy:
+    """Serves many devices from one asyncio event loop.
+
+    Every device gets its own controller and monitor connection and its own
+    shared sync_state, so the firewall holds the union of the hosts of all
+    devices and one device leaving only removes what nobody else needs. The
+    listening rule stays open to any source instead of pinning one device.
+    """
+
+    def __init__(self, loop, secure=True, firewall=FIREWALL, channel=None):
+        self._logger = get_logger()
+        self._loop = loop
+        self._secure = secure
+        self._firewall = firewall
+        if channel is None:
+            channel = params.controller_channel
+        # device sessions share one controller connection
+        self._channel = controller_channel(secure=secure) if channel else None
+        self._retry_times = 5
+        self._auth_timeout = 10
+        # deviceID: sync_state of disconnected devices within their grace period
+        self._states = {}
+        self._expiry = {}
+
+    def _claim(self, ID):
+        handle = self._expiry.pop(ID, None)
+        if handle:
+            handle.cancel()
+        return self._states.pop(ID, None)
+
+    def _release(self, ID, state):
+        old = self._states.pop(ID, None)
+        if old:
+            # the same device had two sessions, keep the later one
+            self._expiry.pop(ID).cancel()
+            old.reset()
+        grace = params.proxy_sync_grace
+        if state.version is None or grace <= 0:
+            state.reset()
+            return
+        self._states[ID] = state
+        self._expiry[ID] = self._loop.call_later(grace, self._expire, ID)
+
+    def _expire(self, ID):
+        self._expiry.pop(ID, None)
+        state = self._states.pop(ID, None)
+        if state:
+            self._logger.info("Sync grace period of %s is over." % ID)
+            state.reset()
+
+    async def _connect_controller(self):
+        address = params.update_controller_addr()
+        self._logger.info("Connecting to %s..." % address)
+        for i in range(self._retry_times):
+            try:
+                return await async_connect(address, secure=self._secure)
+            except OSError as e:
+                delay = backoff(i)
+                self._logger.warning(
+                    "Network error, retry after %.1f seconds.(%s)" % (delay, str(e)))
+                await asyncio.sleep(delay)
+        self._logger.warning("Connected to controller failed.")
+        raise ControllerFault
+
+    async def _open_controller(self):
+        if self._channel:
+            try:
+                session = await self._channel.open_session()
+            except OSError:
+                raise ControllerFault
+            if session:
+                return session
+        return await self._connect_controller()
+
+    async def _auth(self, sock_device, sock_controller, claimed):
+        # client_end.auth_to_server on streams, states of the IDs the device
+        # tried are moved to claimed so their grace period can't expire meanwhile
+        while True:
+            ID = None
+            auth_info = await sock_device.recv_obj()
+            if isinstance(auth_info, auth_packet):
+                ID = auth_info.deviceID
+                if ID not in claimed:
+                    claimed[ID] = self._claim(ID)
+                state = claimed[ID]
+                sync = state.resume() if state else None
+                if sync:
+                    auth_info.sync_version = sync[1]
+            await sock_controller.send_obj(auth_info)
+            reply = await sock_controller.recv_obj()
+            if not isinstance(reply, reply_packet) or reply.passed == 'retry':
+                await sock_device.send_obj(reply_packet('retry'))
+            else:
+                await sock_device.send_obj(reply)
+                return ID if reply.passed else None
+
+    async def _from_controller(self, sock_controller, sock_monitor, state, resuming):
+        while True:
+            pack = await sock_controller.recv_obj()
+            if pack is None:
+                self._logger.info("Receive heartbeat packet.")
+            elif isinstance(pack, list_update_packet):
+                self._logger.info("Receive list update packet.")
+                if resuming and getattr(pack, 'version', None) is None:
+                    # the controller can't resume, this is a full list
+                    state.reset()
+                resuming = False
+                try:
+                    state.apply(pack)
+                except BaseException as e:
+                    self._logger.warning("Iptables error: %s." % str(e))
+                await sock_monitor.send_obj(pack)
+            elif not (params.test_mode and pack == 'ACK'):
+                self._logger.warning("Receive broken packet from controller.")
+
+    async def _forward(self, src, dst):
+        while True:
+            pack = await src.recv_obj()
+            # legacy 'ACK's of test mode are answers to this hop only
+            if params.test_mode and pack == 'ACK':
+                continue
+            await dst.send_obj(pack)
+
+    async def handle(self, reader, writer):
+        sock_device = async_secure_stream(reader, writer)
+        sock_controller = None
+        sock_monitor = None
+        device_addr = None
+        claimed = {}
+        tasks = []
+        try:
+            device_ip, device_port = sock_device.getpeername()[:2]
+            device_addr = device_ip + ':' + str(device_port)
+            self._logger.info("Device from %s." % device_addr)
+
+            sock_controller = await self._open_controller()
+            ID = await asyncio.wait_for(
+                self._auth(sock_device, sock_controller, claimed), self._auth_timeout)
+            if ID is None:
+                raise UnknowndeviceException
+            self._logger.info("Auth of %s to controller passed." % ID)
+
+            state = claimed.pop(ID)
+            sync = state.resume() if state else None
+            if sync is None:
+                if state:
+                    state.reset()
+                state = sync_state(firewall=self._firewall, shared=True)
+            state.deviceID = ID
+            claimed[ID] = state
+
+            try:
+                sock_monitor = await async_connect(params.proxy_address_inside, secure=False)
+            except OSError:
+                raise LocalServiceFault
+
+            for sock in (sock_device, sock_controller, sock_monitor):
+                sock.set_ack_reader()
+            tasks = [
+                asyncio.ensure_future(self._from_controller(
+                    sock_controller, sock_monitor, state, sync is not None)),
+                asyncio.ensure_future(self._forward(sock_device, sock_monitor)),
+                asyncio.ensure_future(self._forward(sock_monitor, sock_device)),
+            ]
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+        except ControllerFault:
+            self._logger.warning("No controller detected.")
+        except (UnknowndeviceException, asyncio.TimeoutError):
+            self._logger.warning("Unknown device on %s." % device_addr)
+        except LocalServiceFault:
+            self._logger.warning("No service detected on %s." %
+                                 params.proxy_address_inside)
+        except DisconnectException:
+            self._logger.info("Connection closed.")
+        except asyncio.CancelledError:
+            raise
+        except BaseException:
+            self._logger.error("Catch unhandled exception.")
+            traceback.print_exc()
+        finally:
+            for task in tasks:
+                task.cancel()
+            sock_device.close()
+            if sock_controller:
+                sock_controller.close()
+            if sock_monitor:
+                sock_monitor.close()
+            for ID, state in claimed.items():
+                if state:
+                    self._release(ID, state)
+            self._logger.info("Device offline.")
+
+
+def async_main(listening_addr, secure=True):
+    def signal_func(sig, stack):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, signal_func)
+    try:
+        server = None
+
+        main_logger = get_logger()
+        main_logger.info("SDP proxy up, serving many devices.")
+
+        if listening_addr is None or not check_addr(listening_addr):
+            listening_addr = params.proxy_address_outside
+
+        main_logger.info("Init firewall.")
+        firewall_init(listening_addr)
+        if params.firewall_drift_interval > 0:
+            start_drift_check(params.firewall_drift_interval)
+
+        listening_ip = listening_addr.split(':')[0]
+        listening_port = int(listening_addr.split(':')[1])
+
+        loop = asyncio.get_event_loop()
+        handler = async_proxy(loop, secure=secure)
+        server = loop.run_until_complete(asyncio.start_server(
+            handler.handle, listening_ip, listening_port,
+            ssl=get_ssl_context(server_side=True) if secure else None))
+
+        main_logger.info("Listening for devices at %s." % listening_addr)
+        loop.run_forever()
+
+    except KeyboardInterrupt:
+        main_logger.info("Receive KeyboardInterrupt.")
+    except FileNotFoundError:
+        main_logger.error("Can't find cert file for TLS.")
+    except BaseException:
+        main_logger.error("Catch unhandled exception.")
+        traceback.print_exc()
+    finally:
+        if server:
+            try:
+                main_logger.info("Close socket...")
+                server.close()
+                loop.run_until_complete(server.wait_closed())
+            except:
+                pass
+        firewall_open_all()
+        main_logger.info("Client down.")
+
+
 def main(listening_addr):
     def signal_func(sig, stack):
         raise KeyboardInterrupt
@@ -269,6 +648,8 @@ def main(listening_addr):
 
         main_logger.info("Init firewall.")
         firewall_init(listening_addr)
+        if params.firewall_drift_interval > 0:
+            start_drift_check(params.firewall_drift_interval)
 
         listening_ip = listening_addr.split(':')[0]
         listening_port = int(listening_addr.split(':')[1])
@@ -306,4 +687,7 @@ if __name__ == '__main__':
         addr = sys.argv[1]
     else:
         addr = None
-    main(addr)
+    if params.proxy_async:
+        async_main(addr)
+    else:
+        main(addr)
@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+"""Device to monitor relay latency of sdp_proxy during a list update storm.
+
+A relay loop like request_handler.handle forwards timestamped data packets
+from a device to the monitor, while a controller sends list updates that add
+and remove hosts. The updates are applied inline or by the firewall worker,
+against fake_iptc whose commits take time proportional to the table size.
+
+Usage: sdp_proxy_bench.py [update_count] [hosts_per_update]
+"""
+
+import os
+os.environ.setdefault('M_SDP_LOG_LEVEL', 'ERROR')
+
+import sys
+import time
+import socket
+import select
+import threading
+import fake_iptc
+sys.modules['iptc'] = fake_iptc
+import iptables_api
+import sdp_proxy
+from protocol import list_update_packet, data_packet
+from secure_socket import secure_socket, DisconnectException, CONTROL_FRAME
+
+DATA_INTERVAL = 0.002
+RULE_DELAY = 20e-6
+
+
+def _pair():
+    a, b = socket.socketpair()
+    return secure_socket(sock=a, secure=False), secure_socket(sock=b, secure=False)
+
+
+def _relay(sock_controller, sock_device, sock_monitor, state):
+    socks = [sock_controller, sock_device]
+    try:
+        while True:
+            ready = [s for s in socks if s.pending_data()]
+            if not ready:
+                ready, _, _ = select.select(socks, [], [], 5)
+            for sock in ready:
+                pack = sock.recv_obj(control=True)
+                if pack is CONTROL_FRAME:
+                    continue
+                if sock is sock_controller:
+                    state.apply(pack)
+                else:
+                    sock_monitor.send_obj(pack)
+    except DisconnectException:
+        pass
+
+
+def _monitor(sock, latencies):
+    try:
+        while True:
+            pack = sock.recv_obj()
+            latencies.append(time.perf_counter() - pack.data)
+    except DisconnectException:
+        pass
+
+
+def _controller(sock, updates, hosts_per_update):
+    for i in range(updates):
+        hosts = dict(('dev-%d-%d' % (i, j), '10.%d.%d.%d:4444' % (i >> 8, i & 0xff, j))
+                     for j in range(hosts_per_update))
+        sock.send_obj(list_update_packet({'add': hosts}, {'add': hosts}))
+        if i >= 8:
+            # keep the table at about 8 updates worth of hosts
+            old = dict(('dev-%d-%d' % (i - 8, j), None) for j in range(hosts_per_update))
+            sock.send_obj(list_update_packet({'remove': old}, {'remove': old}))
+        time.sleep(DATA_INTERVAL)
+
+
+def run(threaded, updates, hosts_per_update):
+    iptables_api.set_backend('iptables')
+    iptables_api.firewall_init('127.0.0.1:4444')
+    fake_iptc.Table.rule_delay = RULE_DELAY
+    worker = iptables_api.firewall_worker(threaded=threaded)
+    state = sdp_proxy.sync_state(firewall=worker)
+
+    ctrl_out, ctrl_in = _pair()
+    dev_out, dev_in = _pair()
+    mon_out, mon_in = _pair()
+    latencies = []
+    threads = [threading.Thread(target=_relay, args=(ctrl_in, dev_in, mon_out, state), daemon=True),
+               threading.Thread(target=_monitor, args=(mon_in, latencies), daemon=True)]
+    for t in threads:
+        t.start()
+    storm = threading.Thread(target=_controller, args=(ctrl_out, updates, hosts_per_update), daemon=True)
+    storm.start()
+    expected = updates + max(updates - 8, 0)
+    while storm.is_alive() or worker.submitted < expected:
+        dev_out.send_obj(data_packet(time.perf_counter()))
+        time.sleep(DATA_INTERVAL)
+    worker.join()
+    time.sleep(0.1)
+
+    for sock in (ctrl_out, dev_out, mon_out):
+        sock.close()
+    for t in threads:
+        t.join()
+    for sock in (ctrl_in, dev_in, mon_in):
+        sock.close()
+    fake_iptc.Table.rule_delay = 0
+
+    latencies.sort()
+    n = len(latencies)
+    print('%-8s updates: %d x %d hosts, relay latency p50/p99/max: %7.2f/%7.2f/%7.2f ms, firewall batches: %d' % (
+        'worker' if threaded else 'inline', updates, hosts_per_update,
+        latencies[n // 2] * 1e3, latencies[int(n * 0.99)] * 1e3, latencies[-1] * 1e3, worker.applied))
+
+
+def main(updates=200, hosts_per_update=50):
+    run(False, updates, hosts_per_update)
+    run(True, updates, hosts_per_update)
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:3]))
@@ -0,0 +1,159 @@
+#!/usr/bin/python3
+"""Device session setup latency of the multi-device proxy, with a controller
+connection per device and with all sessions on one controller channel.
+
+The async controller runs in its own process with TLS and test mode, so it
+accepts any device. The proxy talks TLS to the controller only. A session is
+timed from the device connecting to the proxy until the auth reply arrives,
+first for devices coming one after another, then for all of them at once.
+A self-signed certificate is made with openssl for the run.
+
+Usage: sdp_proxy_channel_bench.py [device_count]
+"""
+
+import os
+os.environ.setdefault('M_SDP_LOG_LEVEL', 'ERROR')
+
+import sys
+import time
+import shutil
+import socket
+import asyncio
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+import fake_iptc
+sys.modules['iptc'] = fake_iptc
+import iptables_api
+import secure_socket
+import sdp_controller
+import sdp_proxy
+from params import params
+from authentication import auth_packet
+from access_policy import access_table
+from secure_socket import async_secure_stream, async_connect, DisconnectException
+
+GROUPS = 10
+
+
+def _make_cert(directory):
+    secure_socket.CERT_FILE = os.path.join(directory, 'cert.crt')
+    secure_socket.KEY_FILE = os.path.join(directory, 'rsa_private.key')
+    subprocess.check_call([
+        shutil.which('openssl') or '/root/miniconda/bin/openssl', 'req', '-x509', '-newkey', 'rsa:2048',
+        '-nodes', '-days', '1', '-subj', '/CN=sdp-controller',
+        '-keyout', secure_socket.KEY_FILE, '-out', secure_socket.CERT_FILE],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def _listen():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    s.listen(1024)
+    return s, '127.0.0.1:%d' % s.getsockname()[1]
+
+
+def _free_address():
+    s, address = _listen()
+    s.close()
+    return address
+
+
+def _serve(address):
+    params.test_mode = True
+    params.test_group_num = GROUPS
+    a_table = access_table()
+    for i in range(GROUPS):
+        a_table.add_group(name=str(i))
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    sdp_controller.async_main(address)
+
+
+async def _monitor(reader, writer):
+    sock = async_secure_stream(reader, writer)
+    try:
+        while True:
+            await sock.recv_obj()
+    except DisconnectException:
+        pass
+    finally:
+        sock.close()
+
+
+async def _session(address, ID):
+    start = time.perf_counter()
+    sock = await async_connect(address, secure=False)
+    await sock.send_obj(auth_packet(ID, None, ID))
+    reply = await sock.recv_obj()
+    elapsed = time.perf_counter() - start
+    if not reply.passed:
+        raise RuntimeError("Device %s failed to authenticate." % ID)
+    return sock, elapsed
+
+
+def _start_proxy(channel):
+    proxy_listener, proxy_address = _listen()
+    proxy_loop = asyncio.new_event_loop()
+    proxy = sdp_proxy.async_proxy(proxy_loop, secure=True, channel=channel)
+    proxy_loop.run_until_complete(asyncio.start_server(proxy.handle, sock=proxy_listener))
+    threading.Thread(target=proxy_loop.run_forever, daemon=True).start()
+    return proxy_address
+
+
+def run(loop, channel, count):
+    name = 'channel' if channel else 'direct'
+    proxy_address = _start_proxy(channel)
+
+    sequential = []
+    for i in range(count):
+        sock, elapsed = loop.run_until_complete(_session(proxy_address, '%s-seq-%d' % (name, i)))
+        sequential.append(elapsed)
+        sock.close()
+    loop.run_until_complete(asyncio.sleep(0.5))
+
+    start = time.perf_counter()
+    results = loop.run_until_complete(asyncio.gather(
+        *[_session(proxy_address, '%s-burst-%d' % (name, i)) for i in range(count)]))
+    burst = time.perf_counter() - start
+    for sock, _ in results:
+        sock.close()
+    loop.run_until_complete(asyncio.sleep(0.5))
+
+    sequential.sort()
+    concurrent = sorted(elapsed for _, elapsed in results)
+    print('%-8s one by one p50/p99: %6.2f/%6.2f ms, %d at once: %7.0f sessions/s, p50/p99: %7.2f/%7.2f ms' % (
+        name, sequential[count // 2] * 1e3, sequential[int(count * 0.99)] * 1e3, count, count / burst,
+        concurrent[count // 2] * 1e3, concurrent[int(count * 0.99)] * 1e3))
+
+
+def main(count=200):
+    # the controller only accepts any device in test mode, both ends have to agree on it
+    params.test_mode = True
+    params.proxy_sync_grace = 0
+    params.firewall_drift_interval = 0
+    iptables_api.firewall_init(None)
+
+    with tempfile.TemporaryDirectory() as directory:
+        _make_cert(directory)
+        controller_address = _free_address()
+        controller = multiprocessing.Process(target=_serve, args=(controller_address,), daemon=True)
+        controller.start()
+        time.sleep(1)
+        os.environ['M_SDP_CONTROLLER_ADDRESS'] = controller_address
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        monitor_listener, params.proxy_address_inside = _listen()
+        loop.run_until_complete(asyncio.start_server(_monitor, sock=monitor_listener))
+
+        run(loop, False, count)
+        run(loop, True, count)
+
+        loop.close()
+        controller.terminate()
+        controller.join()
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:2]))
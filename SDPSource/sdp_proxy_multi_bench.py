@@ -0,0 +1,162 @@
+#!/usr/bin/python3
+"""Relay throughput of the multi-device proxy with N simulated devices.
+
+The proxy runs async_proxy on its own event loop thread. A fake controller
+accepts every device and sends it one host of its own plus one host shared by
+all devices, an echo monitor returns every data packet. Each device sends
+timestamped data packets and waits for the echo. After the devices connected
+the installed host rules are checked against the union of their hosts, and
+after half of them left, against the hosts of the remaining half. Runs without
+TLS against fake_iptc.
+
+The single device proxy serves one device at a time and sleeps 10 seconds
+after each session, so it can't take part.
+
+Usage: sdp_proxy_multi_bench.py [device_count] [messages_per_device]
+"""
+
+import os
+os.environ.setdefault('M_SDP_LOG_LEVEL', 'ERROR')
+
+import sys
+import time
+import socket
+import asyncio
+import threading
+import collections
+import fake_iptc
+sys.modules['iptc'] = fake_iptc
+import iptables_api
+import sdp_proxy
+from params import params
+from protocol import list_update_packet, data_packet
+from authentication import auth_packet, reply_packet
+from secure_socket import async_secure_stream, async_connect, DisconnectException
+
+SHARED_HOST = '10.0.0.1:4444'
+
+
+def _own_host(i):
+    return '10.1.%d.%d:4444' % (i >> 8, i & 0xff)
+
+
+def _listen():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    s.listen(1024)
+    return s, '127.0.0.1:%d' % s.getsockname()[1]
+
+
+async def _controller(reader, writer):
+    sock = async_secure_stream(reader, writer)
+    try:
+        auth = await sock.recv_obj()
+        await sock.send_obj(reply_packet(True, new_key='key'))
+        i = int(auth.deviceID.split('-')[1])
+        hosts = {auth.deviceID: _own_host(i), 'shared': SHARED_HOST}
+        await sock.send_obj(list_update_packet({'add': hosts}, {'add': hosts}))
+        while True:
+            await sock.recv_obj()
+    except DisconnectException:
+        pass
+    finally:
+        sock.close()
+
+
+async def _monitor(reader, writer):
+    sock = async_secure_stream(reader, writer)
+    try:
+        while True:
+            pack = await sock.recv_obj()
+            if isinstance(pack, data_packet):
+                await sock.send_obj(pack)
+    except DisconnectException:
+        pass
+    finally:
+        sock.close()
+
+
+async def _device(address, i):
+    sock = await async_connect(address, secure=False)
+    await sock.send_obj(auth_packet('bench-%d' % i, None, 'key'))
+    reply = await sock.recv_obj()
+    if not reply.passed:
+        raise RuntimeError("Device %d failed to authenticate." % i)
+    return sock
+
+
+async def _send(sock, count, latencies):
+    for _ in range(count):
+        await sock.send_obj(data_packet(time.perf_counter()))
+        pack = await sock.recv_obj()
+        latencies.append(time.perf_counter() - pack.data)
+
+
+def _installed_ok(devices):
+    sdp_proxy.FIREWALL.join()
+    expected = collections.Counter(iptables_api._host_ip(_own_host(i)) for i in devices)
+    if devices:
+        expected[iptables_api._host_ip(SHARED_HOST)] = len(devices)
+    return iptables_api.BACKEND._installed == expected
+
+
+def _wait_installed(devices, timeout=10):
+    deadline = time.time() + timeout
+    while not _installed_ok(devices):
+        if time.time() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def main(count=200, messages=200):
+    params.proxy_sync_grace = 0
+    iptables_api.set_backend('iptables')
+    iptables_api.firewall_init(None)
+
+    proxy_listener, proxy_address = _listen()
+    controller_listener, controller_address = _listen()
+    monitor_listener, params.proxy_address_inside = _listen()
+    os.environ['M_SDP_CONTROLLER_ADDRESS'] = controller_address
+
+    proxy_loop = asyncio.new_event_loop()
+    proxy = sdp_proxy.async_proxy(proxy_loop, secure=False, channel=False)
+    proxy_loop.run_until_complete(asyncio.start_server(
+        proxy.handle, sock=proxy_listener))
+    threading.Thread(target=proxy_loop.run_forever, daemon=True).start()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(asyncio.start_server(_controller, sock=controller_listener))
+    loop.run_until_complete(asyncio.start_server(_monitor, sock=monitor_listener))
+
+    start = time.perf_counter()
+    socks = loop.run_until_complete(asyncio.gather(*[_device(proxy_address, i) for i in range(count)]))
+    setup = time.perf_counter() - start
+    union = _wait_installed(range(count))
+
+    latencies = []
+    start = time.perf_counter()
+    loop.run_until_complete(asyncio.gather(*[_send(sock, messages, latencies) for sock in socks]))
+    elapsed = time.perf_counter() - start
+
+    for sock in socks[count // 2:]:
+        sock.close()
+    loop.run_until_complete(asyncio.sleep(0.1))
+    isolated = _wait_installed(range(count // 2))
+    for sock in socks[:count // 2]:
+        sock.close()
+    loop.run_until_complete(asyncio.sleep(0.1))
+    cleared = _wait_installed(())
+    loop.close()
+
+    latencies.sort()
+    n = len(latencies)
+    print('devices: %d, setup: %.0f devices/s, relay: %.0f msg/s, round trip p50/p99: %.2f/%.2f ms' % (
+        count, count / setup, n / elapsed, latencies[n // 2] * 1e3, latencies[int(n * 0.99)] * 1e3))
+    print('host rules: union %s, after half left %s, after all left %s' % tuple(
+        'ok' if ok else 'WRONG' for ok in (union, isolated, cleared)))
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:3]))
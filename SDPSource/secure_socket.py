@@ -1,7 +1,16 @@
+import io
 import ssl
 import socket
+import builtins
+import asyncio
+import collections
+import select
 import pickle
+import struct
+import math
+import threading
 import time
+import packet_codec
 from params import params
 from log import get_logger
 
@@ -10,12 +19,116 @@ CERT_FILE = '/home/SDPSource/openssl/cert.crt'
 KEY_FILE = '/home/SDPSource//openssl/rsa_private.key'
 
 
-LATENCY = 0
+# Framed wire mode: a fixed-size header (magic, version, flags, payload length)
+# followed by the payload, read with a single recv_into.
+FRAME_HEADER = struct.Struct('!4sBBI')
+FRAME_MAGIC = b'SDPF'
+FRAME_VERSION = 1
+FLAG_CONTROL = 0x01
+# Payload is encoded by packet_codec. In a hello or hello ack the flag
+# announces that the sender accepts such payloads.
+FLAG_COMPACT = 0x02
+# Latency probe control frames, the payload is a PROBE sequence number.
+FLAG_PROBE = 0x04
+FLAG_ECHO = 0x08
+PROBE = struct.Struct('!Q')
+
+# In test mode framed connections send a probe at most every PROBE_INTERVAL
+# seconds next to the data instead of waiting for an 'ACK' per object.
+PROBE_INTERVAL = 1
+MAX_PROBES_IN_FLIGHT = 16
+LATENCY_REPORT_INTERVAL = 10
+
+# A hello (FRAME_MAGIC, FRAME_VERSION, flags) announces framing support in
+# front of the length code of the first legacy message, old peers skip one
+# non-int pickle before the length. The hello ack, a control frame, is always
+# the first framed frame on a connection.
+
+# Initial size of the per-connection receive buffer, payloads larger than the
+# limit get a one-off buffer so the connection doesn't keep it.
+RECV_BUFFER_SIZE = 64 * 1024
+RECV_BUFFER_LIMIT = 16 * 1024 * 1024
+# Longest payload accepted from a peer, a longer length code closes the
+# connection before anything is allocated for it.
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+# The length code and hello of a legacy message are short pickles.
+MAX_LENGTH_PICKLE = 64
+
+# Returned by recv_obj(control=True) when only a control frame was read.
+CONTROL_FRAME = object()
+
+# Builtins a restricted pickle may name besides the packet classes, making
+# them runs no code.
+PICKLE_BUILTINS = frozenset(['set', 'frozenset', 'bytearray', 'complex', 'range', 'slice'])
+
+
+class PickleRefused(pickle.UnpicklingError):
+    pass
+
 
 class DisconnectException(Exception):
     pass
 
 
+class latency_histogram:
+    """Log-bucketed latency histogram, each bucket is 5% wider than the last."""
+
+    def __init__(self, low=0.001, growth=1.05, report_interval=LATENCY_REPORT_INTERVAL):
+        self._lock = threading.Lock()
+        self._low = low
+        self._growth = growth
+        self._log_growth = math.log(growth)
+        self._report_interval = report_interval
+        self._last_report = time.time()
+        self._counts = {}
+        self._n = 0
+
+    def record(self, ms):
+        if ms <= self._low:
+            i = 0
+        else:
+            i = int(math.log(ms / self._low) / self._log_growth) + 1
+        with self._lock:
+            self._counts[i] = self._counts.get(i, 0) + 1
+            self._n += 1
+
+    def _percentiles(self, ps):
+        r = []
+        seen = 0
+        buckets = sorted(self._counts.items())
+        for p in ps:
+            target = p / 100 * self._n
+            while buckets and seen + buckets[0][1] < target:
+                seen += buckets.pop(0)[1]
+            i = buckets[0][0] if buckets else 0
+            r.append(self._low * self._growth ** i)
+        return r
+
+    def percentiles(self, ps=(50, 95, 99)):
+        """Upper bounds of the buckets holding the given percentiles, in ms."""
+        with self._lock:
+            if not self._n:
+                return None
+            return self._percentiles(ps)
+
+    def report(self, logger):
+        """Log p50/p95/p99 once per report interval and start a new window."""
+        now = time.time()
+        with self._lock:
+            if now - self._last_report < self._report_interval or not self._n:
+                return
+            p50, p95, p99 = self._percentiles((50, 95, 99))
+            n = self._n
+            self._counts = {}
+            self._n = 0
+            self._last_report = now
+        logger.critical('[latency]p50=%fms p95=%fms p99=%fms n=%d' % (p50, p95, p99, n))
+
+
+# One-way latency estimated as half the round trip, shared by all connections.
+LATENCY = latency_histogram()
+
+
 def valid_ip(address):
     try:
         socket.inet_aton(address)
@@ -25,8 +138,279 @@ def valid_ip(address):
         return True
 
 
-class secure_socket():
-    def __init__(self, sock=None, secure=True, server_side=False, do_handshake_on_connect=True):
+# (server_side, cert file, key file): SSLContext, shared by every socket of the
+# process so that the cert chain is read once and sessions can be resumed.
+_SSL_CONTEXTS = {}
+_SSL_CONTEXTS_LOCK = threading.Lock()
+
+TLS_SESSION_CACHE_SIZE = 256
+
+
+def get_ssl_context(server_side=False):
+    key = (server_side, CERT_FILE, KEY_FILE) if server_side else (server_side,)
+    with _SSL_CONTEXTS_LOCK:
+        context = _SSL_CONTEXTS.get(key)
+        if context is None:
+            context = ssl.SSLContext()
+            if server_side:
+                context.load_cert_chain(CERT_FILE, KEY_FILE)
+            _SSL_CONTEXTS[key] = context
+        return context
+
+
+class tls_session_cache:
+    """Last TLS session per server address, offered again on the next connect.
+
+    A server that still knows the session skips the certificate exchange and
+    key agreement of a full handshake, otherwise it falls back to one.
+    """
+
+    def __init__(self, size=TLS_SESSION_CACHE_SIZE):
+        self._l = threading.Lock()
+        self._size = size
+        self._sessions = collections.OrderedDict()
+        self.resumed = 0
+        self.full = 0
+
+    def get(self, address):
+        with self._l:
+            return self._sessions.get(address)
+
+    def put(self, address, session):
+        if session is None:
+            return
+        with self._l:
+            self._sessions[address] = session
+            self._sessions.move_to_end(address)
+            if len(self._sessions) > self._size:
+                self._sessions.popitem(last=False)
+
+    def count(self, resumed):
+        with self._l:
+            if resumed:
+                self.resumed += 1
+            else:
+                self.full += 1
+
+    def clear(self):
+        with self._l:
+            self._sessions.clear()
+
+
+TLS_SESSIONS = tls_session_cache()
+
+
+class restricted_unpickler(pickle.Unpickler):
+    """Unpickler which only makes registered packet classes and PICKLE_BUILTINS,
+    so a peer's pickle can't call anything on load."""
+
+    def find_class(self, module, name):
+        # protocol 2 pickles name the module as Python 2 did
+        if module in ('builtins', '__builtin__') and name in PICKLE_BUILTINS:
+            return getattr(builtins, name)
+        cls = packet_codec.find_packet_class(module, name)
+        if cls is None:
+            raise PickleRefused("%s.%s" % (module, name))
+        return cls
+
+
+def restricted_loads(data):
+    return restricted_unpickler(io.BytesIO(data)).load()
+
+
+def unpickle(data):
+    """Unpickle data from a peer, restricted unless params.wire_pickle is 'full'.
+
+    Raises:
+        PickleRefused: data names a class the restricted unpickler doesn't make.
+    """
+    if params.wire_pickle == 'full':
+        return pickle.loads(data)
+    return restricted_loads(data)
+
+
+# Encodings of an object, which one a connection takes depends on what the
+# peer announced.
+WIRE_LEGACY = 0
+WIRE_FRAMED = 1
+WIRE_COMPACT = 2
+
+
+def encode_wire(obj, mode):
+    """Bytes of obj in a wire mode, without the hello of a legacy connection.
+
+    Raises:
+        PacketCodecError: obj can't be sent in compact mode, whose peer
+            refuses pickled payloads.
+    """
+    if mode == WIRE_LEGACY:
+        data = pickle.dumps(obj)
+        return pickle.dumps(len(data)) + data
+    if mode == WIRE_COMPACT:
+        flags = FLAG_COMPACT
+        data = packet_codec.encode(obj)
+    else:
+        flags = 0
+        data = pickle.dumps(obj)
+    return FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, flags, len(data)) + data
+
+
+class shared_obj:
+    """An object sent on several connections, encoded once per wire mode.
+
+    send_obj() takes it in place of the object itself.
+    """
+
+    def __init__(self, obj):
+        self.obj = obj
+        self._lock = threading.Lock()
+        self._encoded = {}
+
+    def encoded(self, mode):
+        data = self._encoded.get(mode)
+        if data is None:
+            with self._lock:
+                data = self._encoded.get(mode)
+                if data is None:
+                    data = self._encoded[mode] = encode_wire(self.obj, mode)
+        return data
+
+
+class wire_protocol:
+    """Wire mode negotiation and encoding, shared by secure_socket and async_secure_stream."""
+
+    def _init_wire(self, codec=None):
+        # Every connection starts in legacy mode.
+        self._hello_sent = False
+        self._peer_framed = False
+        self._peer_flags = 0
+        self._recv_framed = False
+        self._frame_flags = 0
+        if codec is None:
+            codec = params.wire_codec
+        self._strict = params.wire_strict
+        if self._strict:
+            # no hello, the peer gets compact frames from the first message on
+            codec = 'compact'
+            self._peer_framed = True
+            self._peer_flags = FLAG_COMPACT
+        self._local_flags = FLAG_COMPACT if codec == 'compact' else 0
+        # Probe sequence number: send time of probes waiting for their echo.
+        self._probes = {}
+        self._probe_seq = 0
+        self._last_probe = 0
+
+    def _wire_mode(self):
+        if not self._peer_framed:
+            return WIRE_LEGACY
+        if self._local_flags & self._peer_flags & FLAG_COMPACT:
+            return WIRE_COMPACT
+        return WIRE_FRAMED
+
+    def _hello(self):
+        """Returns the hello to put in front of the next legacy message, once."""
+        if self._peer_framed or self._hello_sent or not params.wire_framing:
+            return b''
+        self._hello_sent = True
+        return pickle.dumps((FRAME_MAGIC, FRAME_VERSION, self._local_flags), protocol=4)
+
+    def _encode_obj(self, obj):
+        if isinstance(obj, shared_obj):
+            data = obj.encoded(self._wire_mode())
+        else:
+            data = encode_wire(obj, self._wire_mode())
+        hello = self._hello()
+        return hello + data if hello else data
+
+    def _decode_payload(self, payload):
+        if self._frame_flags & FLAG_COMPACT:
+            return packet_codec.decode(payload)
+        try:
+            return unpickle(payload)
+        except PickleRefused as e:
+            self._logger.warning("Refuse a pickle of %s." % str(e))
+            raise DisconnectException
+
+    def _compact_only(self):
+        """Whether pickled frames are refused, in strict mode or once both
+        ends offered compact payloads."""
+        return self._strict or bool(self._local_flags & self._peer_flags & FLAG_COMPACT)
+
+    def _refuse_legacy(self):
+        # Without strict mode legacy messages may still follow a hello until
+        # its ack arrives, once a frame was received they can't be parsed.
+        if self._strict:
+            self._logger.warning("Refuse a legacy message on a compact connection.")
+            raise DisconnectException
+
+    @staticmethod
+    def _is_hello(obj):
+        return isinstance(obj, tuple) and len(obj) == 3 and obj[0] == FRAME_MAGIC \
+            and isinstance(obj[2], int)
+
+    def _accept_hello(self, hello):
+        """Returns the hello ack to send, None if framing is disabled here."""
+        if not params.wire_framing:
+            return None
+        self._peer_framed = True
+        self._peer_flags = hello[2]
+        return FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, FLAG_CONTROL | self._local_flags, 0)
+
+    def _parse_header(self, header):
+        """Returns (flags, length) of a frame header."""
+        magic, version, flags, length = FRAME_HEADER.unpack(header)
+        if magic != FRAME_MAGIC or version > FRAME_VERSION:
+            self._logger.warning("Unknown frame header %s." % bytes(header))
+            raise DisconnectException
+        self._check_length(length)
+        self._recv_framed = True
+        self._peer_framed = True
+        if not flags & FLAG_CONTROL:
+            # a peer sending compact payloads takes them as well
+            self._peer_flags |= flags & FLAG_COMPACT
+            if self._compact_only() and not flags & FLAG_COMPACT:
+                self._logger.warning("Refuse a pickled frame on a compact connection.")
+                raise DisconnectException
+            self._frame_flags = flags
+        return flags, length
+
+    def _check_length(self, length):
+        if not 0 <= length <= MAX_FRAME_SIZE:
+            self._logger.warning("Refuse a payload of %d bytes." % length)
+            raise DisconnectException
+
+    def _handle_control(self, flags, payload):
+        """Returns a frame to send back, if any."""
+        if flags & FLAG_PROBE:
+            return FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, FLAG_CONTROL | FLAG_ECHO, len(payload)) \
+                + bytes(payload)
+        if flags & FLAG_ECHO:
+            if len(payload) == PROBE.size:
+                sent = self._probes.pop(PROBE.unpack(payload)[0], None)
+                if sent is not None:
+                    LATENCY.record((time.perf_counter() - sent) * 500)
+                    LATENCY.report(self._logger)
+        else:
+            # the hello ack carries the peer's capabilities
+            self._peer_flags = flags
+        return None
+
+    def _next_probe(self):
+        """Returns a probe frame once per PROBE_INTERVAL, None otherwise."""
+        now = time.perf_counter()
+        if now - self._last_probe < PROBE_INTERVAL:
+            return None
+        self._last_probe = now
+        if len(self._probes) >= MAX_PROBES_IN_FLIGHT:
+            self._probes.pop(next(iter(self._probes)))
+        self._probe_seq += 1
+        self._probes[self._probe_seq] = now
+        return FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, FLAG_CONTROL | FLAG_PROBE, PROBE.size) \
+            + PROBE.pack(self._probe_seq)
+
+
+class secure_socket(wire_protocol):
+    def __init__(self, sock=None, secure=True, server_side=False, do_handshake_on_connect=True, codec=None):
         self._logger = get_logger()
         self._secure = secure
         if sock is None:
@@ -35,103 +419,288 @@ class secure_socket():
         if not server_side:
             sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if sock.family in (socket.AF_INET, socket.AF_INET6):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
         if secure:
             if isinstance(sock, ssl.SSLSocket):
                 self._sock = sock
             else:
-                context = ssl.SSLContext()
-                if server_side:
-                    context.load_cert_chain(CERT_FILE, KEY_FILE)
+                context = get_ssl_context(server_side)
                 self._sock = context.wrap_socket(
                     sock, server_side=server_side, do_handshake_on_connect=do_handshake_on_connect)
         else:
             self._sock = sock
 
-    def connect(self, *args, timeout=None):
+        self._init_wire(codec)
+        self._deadline = None
+        self._prefetch = b''
+        self._send_lock = threading.Lock()
+        self._header = bytearray(FRAME_HEADER.size)
+        # Receive buffer reused by every payload on this connection.
+        self._rbuf = bytearray(RECV_BUFFER_SIZE)
+
+    def connect(self, address, timeout=None):
+        tls = isinstance(self._sock, ssl.SSLSocket)
+        if tls:
+            self._address = address
+            session = TLS_SESSIONS.get(address)
+            if session:
+                try:
+                    self._sock.session = session
+                except ValueError:
+                    # made by another context
+                    pass
         self.settimeout(timeout)
-        self._sock.connect(*args)
+        self._sock.connect(address)
         self.settimeout(None)
+        if tls:
+            TLS_SESSIONS.count(self._sock.session_reused)
+            # TLS 1.3 tickets arrive after the handshake, close() stores them again
+            TLS_SESSIONS.put(address, self._sock.session)
 
 
-    def _send_obj(self, obj):
+    def set_deadline(self, timeout):
+        """Let sends and receives raise TimeoutError once timeout seconds have
+        passed, one deadline for the whole exchange. None removes it."""
+        if timeout is None:
+            self._deadline = None
+            self._sock.settimeout(None)
+        else:
+            self._deadline = time.monotonic() + timeout
+
+    def _apply_deadline(self):
+        remaining = self._deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError
+        self._sock.settimeout(remaining)
+
+    def _send_raw(self, data):
         try:
-            data = pickle.dumps(obj)
-            length = len(data)
-            length_code = pickle.dumps(length)
-            # print(length_code + data)
-            self.sendall(length_code + data)
+            with self._send_lock:
+                if self._deadline is not None:
+                    self._apply_deadline()
+                self.sendall(data)
+        except (socket.timeout, TimeoutError):
+            raise TimeoutError
         except:
             raise DisconnectException
 
+    def _send_obj(self, obj):
+        """Send obj, returns whether it went out as a framed message."""
+        if (self._hello_sent and not self._peer_framed) or self._probes:
+            self._poll_control()
+        framed = self._peer_framed
+        self._send_raw(self._encode_obj(obj))
+        return framed
+
     def send_obj(self, obj):
-        self._send_obj(obj)
+        framed = self._send_obj(obj)
 
         if params.test_mode:
-            send_time = time.time()
-            r = self._recv_obj()
-            ack_time = time.time()
-            if r == 'ACK':
-                if params.test_mode:
-                    global LATENCY
-                    l = (ack_time-send_time) * 500
-                    LATENCY = (LATENCY * 0.8) + (l * 0.2)
-                    self._logger.critical('[latency]%fms' % (LATENCY))
+            if framed:
+                probe = self._next_probe()
+                if probe:
+                    self._send_raw(probe)
+            else:
+                # legacy peers answer every object with an 'ACK'
+                send_time = time.perf_counter()
+                r = self._recv_obj()
+                if r == 'ACK':
+                    LATENCY.record((time.perf_counter() - send_time) * 500)
+                    LATENCY.report(self._logger)
 
 
     def _recv_length(self, length):
-        buffer = b''
+        """Receive exactly length bytes into the connection buffer.
+
+        Returns:
+            memoryview: Valid until the next receive on this connection.
+        """
+        if length > RECV_BUFFER_LIMIT:
+            buffer = bytearray(length)
+        else:
+            if length > len(self._rbuf):
+                self._rbuf = bytearray(max(length, 2 * len(self._rbuf)))
+            buffer = self._rbuf
+        view = memoryview(buffer)[:length]
+        self._recv_into(view)
+        return view
+
+    def pending_data(self):
+        """Whether bytes are buffered in user space, select() won't report them."""
+        if self._prefetch:
+            return True
+        return isinstance(self._sock, ssl.SSLSocket) and self._sock.pending() > 0
+
+    def _readable(self):
+        if self.pending_data():
+            return True
+        try:
+            ready, _, _ = select.select([self._sock], [], [], 0)
+        except:
+            return False
+        return bool(ready)
+
+    def _read_ahead(self, length):
+        """Append up to length bytes the socket already has to the prefetch,
+        returns whether any came."""
+        if not self._readable():
+            return False
+        timeout = self._sock.gettimeout()
+        self._sock.setblocking(False)
+        try:
+            data = self._sock.recv(length)
+        except OSError:
+            # SSLWantReadError: a TLS record without application data, such
+            # as a TLS 1.3 session ticket
+            return False
+        finally:
+            self._sock.settimeout(timeout)
+        self._prefetch += data
+        return bool(data)
+
+    def _poll_control(self):
+        # A sender which never reads would otherwise miss the hello ack and
+        # probe echoes. Only what already arrived is read, complete control
+        # frames are taken off the front and anything else is left for recv_obj.
         while True:
+            prefetch = self._prefetch
+            if prefetch[:1] not in (b'', FRAME_MAGIC[:1]):
+                return
+            need = FRAME_HEADER.size
+            if len(prefetch) >= need:
+                flags = prefetch[5]
+                if not flags & FLAG_CONTROL:
+                    return
+                flags, length = self._parse_header(prefetch[:need])
+                need += length
+                if len(prefetch) >= need:
+                    self._prefetch = prefetch[need:]
+                    reply = self._handle_control(flags, prefetch[FRAME_HEADER.size:need])
+                    if reply:
+                        self._send_raw(reply)
+                    continue
+            if not self._read_ahead(need - len(prefetch)):
+                return
+
+    def _take_prefetch(self, length):
+        data = self._prefetch[:length]
+        self._prefetch = self._prefetch[length:]
+        return data
+
+    def _recv_into(self, view):
+        received = 0
+        if self._prefetch:
+            data = self._take_prefetch(len(view))
+            received = len(data)
+            view[:received] = data
+        while received < len(view):
             try:
-                data = self.recv(length-len(buffer))
+                if self._deadline is not None:
+                    self._apply_deadline()
+                n = self._sock.recv_into(view[received:])
+            except (socket.timeout, TimeoutError):
+                raise TimeoutError
             except:
-                data=None
-            if not data:
+                n = 0
+            if not n:
                 raise DisconnectException
-            buffer += data
-            if len(buffer) >= length:
-                return buffer
+            received += n
 
-    def _recv_a_pickle(self, buffersize=1):
-        data = b''
+    def _recv_frame_header(self, first=b''):
+        header = memoryview(self._header)
+        header[:len(first)] = first
+        self._recv_into(header[len(first):])
+        flags, length = self._parse_header(self._header)
+        if flags & FLAG_CONTROL:
+            reply = self._handle_control(flags, self._recv_length(length))
+            if reply:
+                self._send_raw(reply)
+            return None
+        return length
+
+    def _recv_legacy_length(self, first):
+        length = self._recv_a_pickle(1, first)
+        if not isinstance(length, int):
+            if self._is_hello(length):
+                ack = self._accept_hello(length)
+                if ack:
+                    self._send_raw(ack)
+            length = self._recv_a_pickle(1)
+            if not isinstance(length, int):
+                return None
+        self._check_length(length)
+        return length
+
+    def _recv_a_pickle(self, buffersize=1, data=b''):
         while True:
             try:
-                new_data = self.recv(buffersize)
+                if self._deadline is not None:
+                    self._apply_deadline()
+                new_data = self._take_prefetch(buffersize) if self._prefetch else self.recv(buffersize)
+            except (socket.timeout, TimeoutError):
+                raise TimeoutError
             except:
                 new_data = None
             if not new_data:
                 raise DisconnectException
             data += new_data
+            if len(data) > MAX_LENGTH_PICKLE:
+                raise DisconnectException
             # print(data)
             try:
-                obj = pickle.loads(data)
+                obj = restricted_loads(data)
+            except PickleRefused:
+                raise DisconnectException
             except:
                 pass  # Need more data to decode into an object.
             else:
                 return obj
 
-    def _recv_obj(self):
-        length = self._recv_a_pickle(1)
-        if not isinstance(length, int):
-            length = self._recv_a_pickle(1)
-            if not isinstance(length, int):
-                return None
+    def _recv_obj(self, control=False):
+        while True:
+            if self._recv_framed:
+                length = self._recv_frame_header()
+            else:
+                first = bytes(self._recv_length(1))
+                if first[:1] == FRAME_MAGIC[:1]:
+                    length = self._recv_frame_header(first)
+                else:
+                    self._refuse_legacy()
+                    self._frame_flags = 0
+                    length = self._recv_legacy_length(first)
+                    if length is None:
+                        return None
+            if length is not None:
+                break
+            if control:
+                return CONTROL_FRAME
         try:
-            r = pickle.loads(self._recv_length(length))
+            r = self._decode_payload(self._recv_length(length))
+        except DisconnectException:
+            raise
         except:
             return None
         else:
             return r
 
-    def recv_obj(self):
-        r = self._recv_obj()
-        if params.test_mode:
+    def recv_obj(self, control=False):
+        """Receive an object, control frames are skipped unless control is set."""
+        r = self._recv_obj(control)
+        if params.test_mode and r is not CONTROL_FRAME and not self._recv_framed:
             self._send_obj('ACK')
 
         return r
 
 
     def close(self):
+        address = getattr(self, '_address', None)
+        if address:
+            try:
+                TLS_SESSIONS.put(address, self._sock.session)
+            except:
+                pass
         try:
             self._sock.shutdown(socket.SHUT_RDWR)
             self._sock.close()
@@ -142,6 +711,141 @@ class secure_socket():
         return getattr(self._sock, attr)
 
 
+class async_secure_stream(wire_protocol):
+    """asyncio counterpart of secure_socket on a StreamReader/StreamWriter pair."""
+
+    def __init__(self, reader, writer, codec=None):
+        self._logger = get_logger()
+        self._reader = reader
+        self._writer = writer
+        self._init_wire(codec)
+        # Send times of legacy objects whose 'ACK' is left to a reading task.
+        self._pending_acks = collections.deque()
+        self._ack_reader = False
+
+    def getpeername(self):
+        return self._writer.get_extra_info('peername')
+
+    def getsockname(self):
+        return self._writer.get_extra_info('sockname')
+
+    def set_ack_reader(self):
+        """Another task keeps calling recv_obj, so send_obj must not read 'ACK's itself."""
+        self._ack_reader = True
+
+    async def _send_raw(self, data):
+        try:
+            self._writer.write(data)
+            await self._writer.drain()
+        except (OSError, RuntimeError):
+            raise DisconnectException
+
+    async def send_obj(self, obj):
+        framed = self._peer_framed
+        await self._send_raw(self._encode_obj(obj))
+
+        if params.test_mode:
+            if framed:
+                probe = self._next_probe()
+                if probe:
+                    await self._send_raw(probe)
+            elif self._ack_reader:
+                self._pending_acks.append(time.perf_counter())
+            else:
+                send_time = time.perf_counter()
+                r = await self._recv_obj()
+                if r == 'ACK':
+                    LATENCY.record((time.perf_counter() - send_time) * 500)
+                    LATENCY.report(self._logger)
+
+    async def _read(self, n):
+        try:
+            return await self._reader.readexactly(n)
+        except (asyncio.IncompleteReadError, OSError):
+            raise DisconnectException
+
+    async def _recv_a_pickle(self, data=b''):
+        while True:
+            data += await self._read(1)
+            if len(data) > MAX_LENGTH_PICKLE:
+                raise DisconnectException
+            try:
+                return restricted_loads(data)
+            except PickleRefused:
+                raise DisconnectException
+            except:
+                pass  # Need more data to decode into an object.
+
+    async def _recv_legacy_length(self, first):
+        length = await self._recv_a_pickle(first)
+        if not isinstance(length, int):
+            if self._is_hello(length):
+                ack = self._accept_hello(length)
+                if ack:
+                    await self._send_raw(ack)
+            length = await self._recv_a_pickle()
+            if not isinstance(length, int):
+                return None
+        self._check_length(length)
+        return length
+
+    async def _recv_obj(self, control=False):
+        while True:
+            if self._recv_framed:
+                header = await self._read(FRAME_HEADER.size)
+            else:
+                first = await self._read(1)
+                if first != FRAME_MAGIC[:1]:
+                    self._refuse_legacy()
+                    self._frame_flags = 0
+                    length = await self._recv_legacy_length(first)
+                    if length is None:
+                        return None
+                    break
+                header = first + await self._read(FRAME_HEADER.size - 1)
+            flags, length = self._parse_header(header)
+            if not flags & FLAG_CONTROL:
+                break
+            reply = self._handle_control(flags, await self._read(length))
+            if reply:
+                await self._send_raw(reply)
+            if control:
+                return CONTROL_FRAME
+        payload = await self._read(length)
+        try:
+            return self._decode_payload(payload)
+        except DisconnectException:
+            raise
+        except:
+            return None
+
+    async def recv_obj(self, control=False):
+        """Receive an object, control frames are skipped unless control is set."""
+        r = await self._recv_obj(control)
+        if params.test_mode and r is not CONTROL_FRAME and not self._recv_framed:
+            if r == 'ACK' and self._pending_acks:
+                LATENCY.record((time.perf_counter() - self._pending_acks.popleft()) * 500)
+                LATENCY.report(self._logger)
+            else:
+                await self._send_raw(self._encode_obj('ACK'))
+
+        return r
+
+    def close(self):
+        try:
+            self._writer.close()
+        except:
+            pass
+
+
+async def async_connect(address, secure=True, codec=None):
+    ip = address.split(':')[0]
+    port = int(address.split(':')[1])
+    reader, writer = await asyncio.open_connection(
+        ip, port, ssl=get_ssl_context() if secure else None)
+    return async_secure_stream(reader, writer, codec)
+
+
 if __name__ == '__main__':
     s = secure_socket()
     pass
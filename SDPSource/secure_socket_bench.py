@@ -0,0 +1,83 @@
+#!/usr/bin/python3
+"""Loopback throughput of secure_socket in legacy and framed wire mode.
+
+Test mode is measured too: legacy connections wait for an 'ACK' per object,
+framed ones send latency probes next to the data.
+
+Usage: secure_socket_bench.py [message_count] [payload_bytes]
+"""
+
+import sys
+import socket
+import threading
+import time
+from params import params
+from protocol import data_packet
+from secure_socket import secure_socket, LATENCY
+
+
+def _receiver(listener, count, done):
+    conn, _ = listener.accept()
+    sock = secure_socket(sock=conn, secure=False)
+    for _ in range(count):
+        sock.recv_obj()
+    done.set()
+    # keep the connection open until the sender has seen the last message
+    sock.recv_obj()
+    sock.close()
+
+
+def run(framing, count, payload, test_mode=False):
+    params.wire_framing = framing
+    params.test_mode = test_mode
+
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    done = threading.Event()
+    t = threading.Thread(target=_receiver, args=(listener, count + 1, done), daemon=True)
+    t.start()
+
+    sock = secure_socket(secure=False)
+    sock.connect(listener.getsockname())
+    pack = data_packet(payload)
+    # the first message carries the hello, the ack upgrades the connection
+    sock.send_obj(pack)
+    time.sleep(0.1)
+
+    start = time.perf_counter()
+    for _ in range(count):
+        sock.send_obj(pack)
+    done.wait()
+    elapsed = time.perf_counter() - start
+
+    sock.send_obj(None)
+    t.join()
+    params.test_mode = False
+    sock.close()
+    listener.close()
+
+    return count / elapsed
+
+
+def main(count=20000, size=68):
+    payload = bytes(size)
+    legacy = run(False, count, payload)
+    framed = run(True, count, payload)
+    print('messages: %d, payload: %d bytes' % (count, len(payload)))
+    print('legacy: %10.0f msg/s' % legacy)
+    print('framed: %10.0f msg/s (x%.2f)' % (framed, framed / legacy))
+
+    count = max(count // 10, 1)
+    legacy = run(False, count, payload, test_mode=True)
+    framed = run(True, count, payload, test_mode=True)
+    print('test mode, messages: %d' % count)
+    print('legacy: %10.0f msg/s' % legacy)
+    print('framed: %10.0f msg/s (x%.2f)' % (framed, framed / legacy))
+    latency = LATENCY.percentiles()
+    if latency:
+        print('latency p50/p95/p99: %.3f/%.3f/%.3f ms' % tuple(latency))
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:3]))
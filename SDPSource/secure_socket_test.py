@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+"""secure_socket against a TLS peer that predates framing and never writes.
+
+The peer reads everything and never acks the hello. After a TLS 1.3
+handshake its session tickets make the socket readable with no application
+data behind them, which must not block the next send_obj. TLS 1.2 has no
+such tickets and is run for comparison.
+
+Usage: secure_socket_test.py
+"""
+
+import os
+os.environ.setdefault('M_SDP_LOG_LEVEL', 'ERROR')
+os.environ['M_SDP_TEST'] = 'False'
+
+import ssl
+import socket
+import tempfile
+import threading
+import secure_socket
+from protocol import data_packet
+from secure_socket_tls_bench import _make_cert
+
+SENDS = 5
+SEND_TIMEOUT = 5
+
+
+def _silent_peer(listener, max_version):
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.maximum_version = max_version
+    context.load_cert_chain(secure_socket.CERT_FILE, secure_socket.KEY_FILE)
+    conn, _ = listener.accept()
+    with context.wrap_socket(conn, server_side=True) as sock:
+        try:
+            while sock.recv(65536):
+                pass
+        except OSError:
+            pass
+
+
+def _send_to_silent_peer(max_version):
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    threading.Thread(target=_silent_peer, args=(listener, max_version), daemon=True).start()
+
+    sock = secure_socket.secure_socket()
+    sock.connect(listener.getsockname(), timeout=SEND_TIMEOUT)
+    sent = []
+
+    def send():
+        for i in range(SENDS):
+            sock.send_obj(data_packet(i))
+            sent.append(i)
+
+    sender = threading.Thread(target=send, daemon=True)
+    sender.start()
+    sender.join(SEND_TIMEOUT)
+    sock.close()
+    listener.close()
+    return len(sent)
+
+
+def test_silent_legacy_peer():
+    with tempfile.TemporaryDirectory() as directory:
+        _make_cert(directory)
+        secure_socket._SSL_CONTEXTS.clear()
+        for name, version in (('TLS 1.3', ssl.TLSVersion.TLSv1_3), ('TLS 1.2', ssl.TLSVersion.TLSv1_2)):
+            sent = _send_to_silent_peer(version)
+            print('%s: %d/%d objects sent' % (name, sent, SENDS))
+            assert sent == SENDS, '%s: send_obj blocked after %d objects' % (name, sent)
+
+
+if __name__ == '__main__':
+    test_silent_legacy_peer()
@@ -0,0 +1,92 @@
+#!/usr/bin/python3
+"""TLS connection setup rate of secure_socket clients.
+
+Each connection does the handshake, sends one object and reads the answer.
+Before: the client builds a new SSLContext per socket and never offers a
+session, as secure_socket did. After: the cached context and the session of
+the last connection to the same address are used. The server runs in its own
+process with a self-signed certificate made with openssl for the run.
+
+Usage: secure_socket_tls_bench.py [connection_count]
+"""
+
+import os
+os.environ.setdefault('M_SDP_LOG_LEVEL', 'ERROR')
+
+import sys
+import time
+import shutil
+import socket
+import tempfile
+import subprocess
+import multiprocessing
+import secure_socket
+from protocol import data_packet
+from secure_socket import secure_socket as tls_socket, TLS_SESSIONS, DisconnectException
+
+
+def _make_cert(directory):
+    secure_socket.CERT_FILE = os.path.join(directory, 'cert.crt')
+    secure_socket.KEY_FILE = os.path.join(directory, 'rsa_private.key')
+    subprocess.check_call([
+        shutil.which('openssl') or '/root/miniconda/bin/openssl', 'req', '-x509', '-newkey', 'rsa:2048',
+        '-nodes', '-days', '1', '-subj', '/CN=sdp-controller',
+        '-keyout', secure_socket.KEY_FILE, '-out', secure_socket.CERT_FILE],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def _serve(listener):
+    server = tls_socket(sock=listener, server_side=True)
+    while True:
+        try:
+            conn, _ = server.accept()
+        except OSError:
+            continue
+        sock = tls_socket(sock=conn)
+        try:
+            sock.send_obj(sock.recv_obj())
+            sock.recv_obj()
+        except DisconnectException:
+            pass
+        sock.close()
+
+
+def run(address, count, cached):
+    TLS_SESSIONS.clear()
+    TLS_SESSIONS.resumed = TLS_SESSIONS.full = 0
+    pack = data_packet('ping')
+    start = time.perf_counter()
+    for _ in range(count):
+        if not cached:
+            secure_socket._SSL_CONTEXTS.clear()
+            TLS_SESSIONS.clear()
+        sock = tls_socket()
+        sock.connect(address)
+        sock.send_obj(pack)
+        sock.recv_obj()
+        sock.close()
+    elapsed = time.perf_counter() - start
+    print('%-7s %7.0f connections/s, %5.2f ms each, resumed: %d/%d' % (
+        'after' if cached else 'before', count / elapsed, elapsed / count * 1e3,
+        TLS_SESSIONS.resumed, TLS_SESSIONS.resumed + TLS_SESSIONS.full))
+
+
+def main(count=500):
+    with tempfile.TemporaryDirectory() as directory:
+        _make_cert(directory)
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(128)
+        server = multiprocessing.Process(target=_serve, args=(listener,), daemon=True)
+        server.start()
+        address = listener.getsockname()
+
+        run(address, count, False)
+        run(address, count, True)
+
+        server.terminate()
+        server.join()
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:2]))